@@ -86,7 +86,7 @@ class TwiQueryCLI:
             # nargs=1,                                        # 1 number; removed since nargs=1 causes value to be a list
             type=int,
             default=5,
-            help="Number of tweets to query for each username (Minimum 5, Maximum 100)",
+            help="Number of tweets to query for each username (Minimum 5, paginated beyond 100)",
         )
 
 
@@ -1,14 +1,17 @@
 import os
 import sys
+import asyncio
 import logging
-import threading
 import logging.config
-from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
-from typing import List
 
 from cli.twiquery_cli import TwiQueryCLI
 from src.utils import RawConfigParser
+from src.http_client import run_with_client
+from src.metrics import MeteredRotatingFileHandler, MetricsExporter
+from src.supervisor import Supervisor
+from src.sharding import ShardedUserCollector, get_bearer_tokens
+from src.parallel_stream import ParallelStream
 from src.twitter_stream import TwitterStream
 from src.twitter_user import TwitterUser
 
@@ -26,7 +29,7 @@ if __name__ == "__main__":
     # Note that logging dictConfig can also be used to configure logging from a dict
     formatter = logging.Formatter("[%(asctime)s]:%(levelname)5s:%(message)s")
 
-    logger_file_handler = RotatingFileHandler(
+    logger_file_handler = MeteredRotatingFileHandler(
         "main.log",
         mode="a",
         maxBytes=1024 * 1024,
@@ -58,7 +61,7 @@ if __name__ == "__main__":
 
     # Check for errorneous input
     # ERROR:User Tweet Failed - Request returned an error: 400 {"errors":[{"parameters":{"max_results":["3"]},"message":"The `max_results` query parameter value [3] is not between 5 and 100"}],"title":"Invalid Request","detail":"One or more parameters to your request was invalid.","type":"https://api.twitter.com/2/problems/invalid-request"}
-    assert (5 <= args.count <= 100), main_logger.error("Count must be between 5 and 100!")
+    assert (5 <= args.count), main_logger.error("Count must be at least 5!")     # Counts above 100 are retrieved via pagination
     assert (len(args.rule) == len(args.tag)), main_logger.error("Number of rules and tags do not match!")
 
     # Save args to config
@@ -155,42 +158,48 @@ if __name__ == "__main__":
     config = RawConfigParser()
     config.read("config.ini")
     
-    # Based on config file, initialize services per thread
-    thread_list: List[threading.Thread] = []
-    
-    if config["API"]["user_tweet"] == "True":
-        thread_list.append(threading.Thread(
-            target=TwitterUser.create_thread, 
-            name="UserTweetThread",
-            kwargs={
-                "bearer_token": bearer_token, 
-                "config": config, 
-                "logger": main_logger, 
-                "formatter": formatter
-                }))
-    
-    if config["API"]["stream_tweet"] == "True":
-        thread_list.append(threading.Thread(
-            target=TwitterStream.create_thread, 
-            name="StreamTweetThread",
-            kwargs={
-                "bearer_token": bearer_token, 
-                "config": config, 
-                "logger": main_logger, 
-                "formatter": formatter
-                }))
-        
-    # Start services
-    for thread in thread_list:
-        thread.start()
-        main_logger.info(f"{thread.getName()} started")
-    
-    # Wait for services to finish
-    for thread in thread_list:
-        thread.join()
-        main_logger.info(f"{thread.getName()} joined")
+    # Based on config file, register services on a single event loop
+    # All services share one connection pool and rate-limit budgets, and a crashed service is restarted by the supervisor
+    supervisor = Supervisor.from_config(config, main_logger)
+
+    # With USERTWEET shards > 1, the usernames are split across worker processes, each using its own bearer token
+    if config["API"]["user_tweet"] == "True" and config.getint("USERTWEET", "shards", fallback=1) > 1:
+        supervisor.add("UserTweetService", lambda: ShardedUserCollector.create_service(
+            bearer_tokens=get_bearer_tokens(),
+            config=config,
+            logger=main_logger,
+            formatter=formatter))
+
+    elif config["API"]["user_tweet"] == "True":
+        supervisor.add("UserTweetService", lambda: TwitterUser.create_service(
+            bearer_token=bearer_token,
+            config=config,
+            logger=main_logger,
+            formatter=formatter))
+
+    # With STREAMTWEET connections > 1, the rules are split across stream connections in worker processes, one bearer token each
+    if config["API"]["stream_tweet"] == "True" and config.getint("STREAMTWEET", "connections", fallback=1) > 1:
+        supervisor.add("StreamTweetService", lambda: ParallelStream.create_service(
+            bearer_tokens=get_bearer_tokens(),
+            config=config,
+            logger=main_logger,
+            formatter=formatter))
+
+    elif config["API"]["stream_tweet"] == "True":
+        supervisor.add("StreamTweetService", lambda: TwitterStream.create_service(
+            bearer_token=bearer_token,
+            config=config,
+            logger=main_logger,
+            formatter=formatter))
+
+    # Run services until completion or SIGTERM / SIGINT, which cancels them after flushing their pending writes
+    # With METRICS enabled, the metrics are exported while the services run (see src/metrics.py)
+    if config.getboolean("METRICS", "enabled", fallback=False):
+        asyncio.run(run_with_client(MetricsExporter.from_config(config, main_logger).run(supervisor.run())))
+    else:
+        asyncio.run(run_with_client(supervisor.run()))
 
     # Close logging
-    main_logger.info("All threads completed")
+    main_logger.info("All services completed")
     main_logger.info("Program shutting down ...")
     logging.shutdown()
\ No newline at end of file
@@ -0,0 +1,284 @@
+import os
+import sys
+import time
+import heapq
+import zlib
+import threading
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .records import TweetRecord
+from .utils import parse_timestamp, read_json, write_json_atomic
+
+'''
+Incremental analytics of the stream, computed as tweets are written instead of by reprocessing the logs afterwards.
+Runs as a sink of the stream store (behind the deduplication), so every tweet is counted once and off the event loop.
+Per dimension (hashtags, mentions, URLs and authors), with bounded memory:
+- a Space-Saving summary of the top ANALYTICS top_k keys per hour, over the last ANALYTICS window_hours hours,
+  from which the heavy hitters of any window (last hour, last day, ...) are merged
+- a count-min sketch over all tweets ever counted, estimating the count of any key (never under-estimating)
+- the number of tweets per minute, over the same window
+Every ANALYTICS snapshot_interval seconds (and on close), the aggregates are written to FILEPATHS analytics_dir/snapshot.json
+for dashboards to read, along with the state needed to resume counting on the next run.
+'''
+
+DIMENSIONS = ("hashtags", "mentions", "urls", "authors")
+BUCKET_SECONDS = 60             # Resolution of the tweet counts
+SUMMARY_SECONDS = 60 * 60       # Resolution of the heavy hitters
+SNAPSHOT_WINDOWS = {"1h": 60 * 60, "24h": 24 * 60 * 60}
+
+
+class CountMinSketch:
+    def __init__(self, width: int = 2048, depth: int = 4, counts: Optional[array] = None):
+        self.width = width
+        self.depth = depth
+        self.counts = counts if counts is not None else array("Q", bytes(8 * width * depth))
+
+    def cells(self, key: str) -> Iterator[int]:
+        encoded = key.encode("utf8")
+        for row in range(self.depth):
+            # One crc32 per row, seeded by the row number, as independent-enough hash functions
+            yield row * self.width + zlib.crc32(encoded, row * 0x9E3779B1 & 0xFFFFFFFF) % self.width
+
+    def add(self, key: str, count: int = 1) -> None:
+        for cell in self.cells(key):
+            self.counts[cell] += count
+
+    def estimate(self, key: str) -> int:
+        return min(self.counts[cell] for cell in self.cells(key))
+
+    def to_bytes(self) -> bytes:
+        counts = array("Q", self.counts)
+        if sys.byteorder == "big":
+            counts.byteswap()       # Stored little-endian
+        return counts.tobytes()
+
+    @staticmethod
+    def from_bytes(data: bytes, width: int, depth: int) -> "CountMinSketch":
+        counts = array("Q")
+        counts.frombytes(data)
+        if sys.byteorder == "big":
+            counts.byteswap()
+        if len(counts) != width * depth:
+            return CountMinSketch(width, depth)      # Dimensions changed in config.ini, start over
+        return CountMinSketch(width, depth, counts)
+
+
+class SpaceSaving:
+    '''
+    Space-Saving summary of the heavy hitters of a stream of keys, in at most 'capacity' counters.
+    Each counter holds [count, error]: the true count of a key lies between count - error and count.
+    '''
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counters: Dict[str, List[int]] = {}
+        self.heap: List[Tuple[int, str]] = []       # (count, key), lazily updated: entries may be stale
+
+    def add(self, key: str, count: int = 1) -> None:
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+            heapq.heappush(self.heap, (count, key))
+            return
+
+        # Replace the key with the smallest count, inheriting its count as the error of the new key
+        minimum, _ = self.pop_minimum()
+        self.counters[key] = [minimum + count, minimum]
+        heapq.heappush(self.heap, (minimum + count, key))
+
+    def pop_minimum(self) -> Tuple[int, str]:
+        while True:
+            count, key = heapq.heappop(self.heap)
+            counter = self.counters.get(key)
+            if counter is None:
+                continue
+            if counter[0] != count:
+                heapq.heappush(self.heap, (counter[0], key))        # Stale entry, re-queue with the current count
+                continue
+            del self.counters[key]
+            return count, key
+
+    def top(self, k: int) -> List[Tuple[str, int, int]]:
+        return sorted(((key, count, error) for key, (count, error) in self.counters.items()), key=lambda item: (-item[1], item[0]))[:k]
+
+    def to_json(self) -> Dict[str, List[int]]:
+        return self.counters
+
+    @staticmethod
+    def from_json(counters: Dict[str, List[int]], capacity: int) -> "SpaceSaving":
+        summary = SpaceSaving(capacity)
+        for key, (count, error) in sorted(counters.items(), key=lambda item: -item[1][0])[:capacity]:
+            summary.counters[key] = [count, error]
+        summary.heap = [(count, key) for key, (count, _) in summary.counters.items()]
+        heapq.heapify(summary.heap)
+        return summary
+
+
+def extract_keys(tweet: dict) -> Dict[str, List[str]]:
+    '''
+    Returns the keys of every dimension in a tweet (case-insensitive ones lowercased)
+    '''
+    entities = tweet.get("entities", {})
+    keys = {
+        "hashtags": [hashtag["tag"].lower() for hashtag in entities.get("hashtags", []) if "tag" in hashtag],
+        "mentions": [mention["username"].lower() for mention in entities.get("mentions", []) if "username" in mention],
+        "urls": [url.get("expanded_url") or url["url"] for url in entities.get("urls", []) if "url" in url],
+        "authors": [tweet["author_id"]] if "author_id" in tweet else [],
+    }
+    return {dimension: list(dict.fromkeys(values)) for dimension, values in keys.items()}      # Once per tweet
+
+
+class StreamAnalytics:
+    def __init__(self, directory: str, top_k: int = 100, window_hours: int = 24, sketch_width: int = 2048, sketch_depth: int = 4,
+                 snapshot_interval: float = 60):
+        self.directory = directory
+        self.top_k = top_k
+        self.window = window_hours * 60 * 60
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock()        # Batches may be written from different worker threads
+        self.tweet_counts: Dict[int, int] = {}                                      # Minute -> number of tweets
+        self.summaries: Dict[int, Dict[str, SpaceSaving]] = {}                      # Hour -> dimension -> summary
+        self.sketches = {dimension: CountMinSketch(sketch_width, sketch_depth) for dimension in DIMENSIONS}
+        self.total = 0
+        self.last_snapshot = time.monotonic()
+        self.load()
+
+    @staticmethod
+    def from_config(config) -> "StreamAnalytics":
+        return StreamAnalytics(
+            config["FILEPATHS"]["analytics_dir"],
+            top_k=config.getint("ANALYTICS", "top_k", fallback=100),
+            window_hours=config.getint("ANALYTICS", "window_hours", fallback=24),
+            sketch_width=config.getint("ANALYTICS", "sketch_width", fallback=2048),
+            sketch_depth=config.getint("ANALYTICS", "sketch_depth", fallback=4),
+            snapshot_interval=config.getfloat("ANALYTICS", "snapshot_interval", fallback=60),
+        )
+
+    @property
+    def snapshot_filepath(self) -> str:
+        return os.path.join(self.directory, "snapshot.json")
+
+    @property
+    def sketch_filepath(self) -> str:
+        return os.path.join(self.directory, "sketches.bin")
+
+    def load(self) -> None:
+        '''
+        Resumes from the previous snapshot, if any
+        '''
+        snapshot = read_json(self.snapshot_filepath, default={})
+        state = snapshot.get("state", {})
+        self.total = state.get("total", 0)
+        self.tweet_counts = {int(minute): count for minute, count in state.get("tweet_counts", {}).items()}
+        self.summaries = {
+            int(hour): {dimension: SpaceSaving.from_json(counters, self.top_k) for dimension, counters in summaries.items()}
+            for hour, summaries in state.get("summaries", {}).items()
+        }
+        if os.path.exists(self.sketch_filepath):
+            with open(self.sketch_filepath, "rb") as f:
+                data = f.read()
+            size = len(data) // len(DIMENSIONS)
+            sketch = self.sketches[DIMENSIONS[0]]
+            for index, dimension in enumerate(DIMENSIONS):
+                self.sketches[dimension] = CountMinSketch.from_bytes(data[index * size:(index + 1) * size], sketch.width, sketch.depth)
+        self.evict_expired(time.time())
+
+    def add(self, message: dict, received_at: float) -> None:
+        tweet = message.get("data")
+        if not isinstance(tweet, dict) or "id" not in tweet:
+            return
+        try:
+            created_at = parse_timestamp(tweet.get("created_at"))
+        except ValueError:
+            created_at = None
+        timestamp = created_at.timestamp() if created_at is not None else received_at
+        if timestamp < time.time() - self.window:
+            timestamp = None        # Too old for the windows (e.g. backfilled), only counted in the sketches
+
+        self.total += 1
+        if timestamp is not None:
+            minute = int(timestamp // BUCKET_SECONDS) * BUCKET_SECONDS
+            self.tweet_counts[minute] = self.tweet_counts.get(minute, 0) + 1
+            hour = int(timestamp // SUMMARY_SECONDS) * SUMMARY_SECONDS
+            summaries = self.summaries.setdefault(hour, {})
+
+        for dimension, keys in extract_keys(tweet).items():
+            for key in keys:
+                self.sketches[dimension].add(key)
+                if timestamp is not None:
+                    summaries.setdefault(dimension, SpaceSaving(self.top_k)).add(key)
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        with self.lock:
+            for record in records:
+                try:
+                    self.add(record.json, record.received_at)
+                except ValueError:
+                    continue
+            if self.snapshot_interval >= 0 and time.monotonic() - self.last_snapshot >= self.snapshot_interval:
+                self.snapshot()
+
+    def evict_expired(self, now: float) -> None:
+        oldest = now - self.window
+        self.tweet_counts = {minute: count for minute, count in self.tweet_counts.items() if minute + BUCKET_SECONDS > oldest}
+        self.summaries = {hour: summaries for hour, summaries in self.summaries.items() if hour + SUMMARY_SECONDS > oldest}
+
+    def count_tweets(self, seconds: float, now: float) -> int:
+        return sum(count for minute, count in self.tweet_counts.items() if minute + BUCKET_SECONDS > now - seconds)
+
+    def top(self, dimension: str, seconds: float, now: float) -> List[Tuple[str, int, int]]:
+        '''
+        Merges the hourly summaries within the window into the top keys as (key, count, error), summing the counts and errors
+        '''
+        merged: Dict[str, List[int]] = {}
+        for hour, summaries in self.summaries.items():
+            summary = summaries.get(dimension)
+            if summary is None or hour + SUMMARY_SECONDS <= now - seconds:
+                continue
+            for key, (count, error) in summary.counters.items():
+                counter = merged.setdefault(key, [0, 0])
+                counter[0] += count
+                counter[1] += error
+        return sorted(((key, count, error) for key, (count, error) in merged.items()), key=lambda item: (-item[1], item[0]))[:self.top_k]
+
+    def estimate(self, dimension: str, key: str) -> int:
+        '''
+        Estimates the number of tweets containing 'key' (e.g. a lowercased hashtag) ever counted
+        '''
+        with self.lock:
+            return self.sketches[dimension].estimate(key)
+
+    def snapshot(self) -> None:
+        '''
+        Writes the aggregates (and the state to resume from) atomically. Called with the lock held.
+        '''
+        now = time.time()
+        self.evict_expired(now)
+        windows = {name: seconds for name, seconds in SNAPSHOT_WINDOWS.items() if seconds <= self.window}
+        write_json_atomic(self.snapshot_filepath, {
+            "generated_at": datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "tweets": {"total": self.total, **{name: self.count_tweets(seconds, now) for name, seconds in {"5m": 300, **windows}.items()}},
+            "tweets_per_minute": {datetime.fromtimestamp(minute, timezone.utc).strftime("%Y-%m-%dT%H:%MZ"): count
+                                  for minute, count in sorted(self.tweet_counts.items())},
+            "top": {dimension: {name: self.top(dimension, seconds, now) for name, seconds in windows.items()} for dimension in DIMENSIONS},
+            "state": {
+                "total": self.total,
+                "tweet_counts": self.tweet_counts,
+                "summaries": {hour: {dimension: summary.to_json() for dimension, summary in summaries.items()}
+                              for hour, summaries in self.summaries.items()},
+            },
+        })
+        temp_filepath = f"{self.sketch_filepath}.tmp"
+        with open(temp_filepath, "wb") as f:
+            for dimension in DIMENSIONS:
+                f.write(self.sketches[dimension].to_bytes())
+        os.replace(temp_filepath, self.sketch_filepath)
+        self.last_snapshot = time.monotonic()
+
+    def close(self) -> None:
+        with self.lock:
+            self.snapshot()
@@ -0,0 +1,676 @@
+import os
+import ast
+import json
+import base64
+import bisect
+import hashlib
+import sqlite3
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    from fastapi import FastAPI, HTTPException, Query, Request
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import Response, StreamingResponse
+except ImportError:     # Optional dependency, only required for the query API
+    FastAPI = None
+
+from .search_index import SearchIndex
+from .sqlite_store import to_iso
+from .tweet_store import SegmentStore
+from .utils import RawConfigParser, read_json
+
+'''
+Read-only HTTP API over the collected tweets, as the backend of the dashboard, so that it never downloads raw log files.
+Tweets are read from the SQLite database when there is one (STORE backend = sqlite or both), otherwise from the JSONL
+segments, indexed in memory as they grow. Text search goes through the search index (SEARCH enabled) and the stream
+analytics come from their snapshot (ANALYTICS enabled):
+    GET /tweets?since=&until=           tweets created within [since, until)
+    GET /tweets/tag/{tag}               tweets matching a rule tag
+    GET /tweets/author/{author_id}      tweets of an author
+    GET /search?q=                      tweets matching a search query (see search_index.py for the syntax)
+    GET /aggregates?interval=hour|day   tweet counts per interval and rule tag
+    GET /analytics                      the latest stream analytics snapshot
+Lists are newest first, one page of 'limit' tweets at a time: a page ends with a next_cursor, to pass as 'cursor' for the
+next page (keyset pagination, so that pages stay consistent and cheap while tweets are appended). Pages are streamed as
+they are read, with the stored payloads written as is.
+Every response carries an ETag derived from the request and the version of the data (the modification times of the
+database, its WAL or the segments, the search index manifest and the analytics snapshot), so that If-None-Match requests are answered
+with 304 Not Modified. A body is only sent with the ETag of the version it was read at: it is read again if data was written
+meanwhile. Responses are kept in an LRU cache, which is cleared whenever new data is written.
+
+    python -m src.api --port 8000
+Requires FastAPI and Uvicorn (pip install -r requirements-optional.txt). The settings are in the [QUERYAPI] section of config.ini.
+'''
+
+INTERVALS = {"hour": 13, "day": 10}         # Length of the created_at prefix of each interval
+HOUR_PREFIX = INTERVALS["hour"]
+VERSION_ATTEMPTS = 3                        # Reads of a response body before giving up on a consistent ETag
+STREAM_CHUNK_ROWS = 100                     # Tweets read per chunk of a streamed page
+
+
+def require_fastapi() -> None:
+    if FastAPI is None:
+        raise ImportError("The query API requires FastAPI and Uvicorn, install them with: pip install -r requirements-optional.txt")
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    '''
+    Parses a date (2022-11-20) or an ISO 8601 datetime (2022-11-20T08:15:30Z), in UTC unless stated otherwise
+    '''
+    if not value:
+        return None
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def encode_cursor(created_at: str, tweet_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, tweet_id]).encode("utf8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    created_at, tweet_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return str(created_at), int(tweet_id)
+
+
+class ResponseCache:
+    '''
+    LRU cache of response bodies by request, cleared whenever the data version changes
+    '''
+    def __init__(self, size: int = 256, max_bytes: int = 1024 * 1024):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.version = None
+        self.entries: "OrderedDict[str, Tuple[str, bytes]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def validate(self, version: str) -> None:
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+    def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key: str, version: str, etag: str, body: bytes) -> None:
+        with self.lock:
+            if version != self.version or len(body) > self.max_bytes or self.size <= 0:
+                return      # Written meanwhile, or too large to be worth keeping
+            self.entries[key] = (etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class TweetQueries:
+    '''
+    Queries over the SQLite database, read-only and one connection per thread
+    '''
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.local = threading.local()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.filepath)
+
+    def connect(self) -> sqlite3.Connection:
+        if not self.exists():
+            raise FileNotFoundError(f"No tweet database at {self.filepath}, collect tweets with STORE backend = sqlite or both")
+        connection = sqlite3.connect(f"file:{self.filepath}?mode=ro", uri=True, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = self.connect()
+        return self.local.connection
+
+    @staticmethod
+    def page_query(since: Optional[float], until: Optional[float], after: Optional[Tuple[str, int]], limit: int,
+                   tag: Optional[str] = None, author_id: Optional[str] = None) -> Tuple[str, list]:
+        '''
+        Returns the query of a page of (created_at, id, payload), newest first, after the (created_at, id) of a cursor
+        '''
+        where, params = TweetQueries.time_filter(since, until)
+        if author_id is not None:
+            where.insert(0, "t.author_id = ?")
+            params.insert(0, author_id)
+        if tag is not None:
+            # Ordered by tweet ID (time-ordered), which follows the (tag, tweet_id) index
+            sql = "SELECT t.created_at, t.id, t.payload FROM tweet_rules r JOIN tweets t ON t.id = r.tweet_id"
+            where = ["r.tag = ?"] + where
+            params = [tag] + params
+            if after is not None:
+                where.append("r.tweet_id < ?")
+                params.append(after[1])
+            order = "r.tweet_id DESC"
+        else:
+            # Ordered by (created_at, id), which follows the created_at and (author_id, created_at) indexes
+            sql = "SELECT t.created_at, t.id, t.payload FROM tweets t"
+            if after is not None:
+                where.append("(t.created_at < ? OR (t.created_at = ? AND t.id < ?))")
+                params.extend([after[0], after[0], after[1]])
+            order = "t.created_at DESC, t.id DESC"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return f"{sql} ORDER BY {order} LIMIT ?", params + [limit]
+
+    @staticmethod
+    def time_filter(since: Optional[float], until: Optional[float]) -> Tuple[List[str], list]:
+        where, params = [], []
+        if since is not None:
+            where.append("t.created_at >= ?")
+            params.append(to_iso(since))
+        if until is not None:
+            where.append("t.created_at < ?")
+            params.append(to_iso(until))
+        return where, params
+
+    def open_page(self, since: Optional[float], until: Optional[float], after: Optional[Tuple[str, int]], limit: int,
+                  tag: Optional[str] = None, author_id: Optional[str] = None) -> Tuple[Iterator[List[Tuple[str, int, str]]], Callable[[], None]]:
+        '''
+        Runs a page query on a connection of its own, as the page is then read from whichever thread streams it.
+        Returns the page in batches of STREAM_CHUNK_ROWS rows, all read from the snapshot taken by the query, and the
+        function closing the connection.
+        '''
+        connection = self.connect()
+        try:
+            rows = connection.execute(*self.page_query(since, until, after, limit, tag=tag, author_id=author_id))
+        except Exception:
+            connection.close()
+            raise
+        return iter(lambda: rows.fetchmany(STREAM_CHUNK_ROWS), []), connection.close
+
+    def get_tweets(self, tweet_ids: List[int]) -> Dict[int, str]:
+        if not tweet_ids:
+            return {}
+        rows = self.connection.execute(f"SELECT id, payload FROM tweets WHERE id IN ({','.join('?' * len(tweet_ids))})", tweet_ids)
+        return dict(rows.fetchall())
+
+    def aggregates(self, interval: str, since: Optional[float], until: Optional[float], tag: Optional[str]) -> dict:
+        '''
+        Counts the tweets per interval (by created_at prefix) and rule tag, and in total per service
+        '''
+        where, params = self.time_filter(since, until)
+        rule_where, rule_params = list(where), list(params)
+        if tag is not None:
+            rule_where.append("r.tag = ?")
+            rule_params.append(tag)
+        rule_clause = f" WHERE {' AND '.join(rule_where)}" if rule_where else ""
+        clause = f" WHERE {' AND '.join(where)}" if where else ""
+        self.connection.execute("BEGIN")       # Both counts from one snapshot
+        try:
+            counts = self.connection.execute(
+                f"SELECT substr(t.created_at, 1, {INTERVALS[interval]}) AS bucket, r.tag, COUNT(*) FROM tweet_rules r "
+                f"JOIN tweets t ON t.id = r.tweet_id{rule_clause} GROUP BY bucket, r.tag ORDER BY bucket, r.tag", rule_params).fetchall()
+            totals = self.connection.execute(f"SELECT t.source, COUNT(*) FROM tweets t{clause} GROUP BY t.source", params).fetchall()
+        finally:
+            self.connection.execute("COMMIT")
+        return {
+            "interval": interval,
+            "counts": [{"bucket": bucket, "tag": tag, "tweets": count} for bucket, tag, count in counts],
+            "totals": dict(totals),
+        }
+
+
+class SegmentEntry:
+    __slots__ = ("created_at", "author_id", "source", "tags", "filepath", "offset", "length")
+
+    def __init__(self, created_at: str, author_id: Optional[str], source: str, filepath: str, offset: int, length: int):
+        self.created_at = created_at
+        self.author_id = author_id
+        self.source = source
+        self.tags: Set[str] = set()
+        self.filepath = filepath
+        self.offset = offset
+        self.length = length
+
+
+class SegmentQueries:
+    '''
+    The same queries over the JSONL segments (STORE backend = segments), answered from an in-memory index of the tweets.
+    The index is built on the first query, then extended with the lines appended since, as segments are append-only.
+    Like the database, a tweet seen several times keeps its latest payload and the tags of every matching rule.
+    '''
+    def __init__(self, stores: List[SegmentStore]):
+        self.stores = stores
+        self.lock = threading.Lock()
+        self.offsets: Dict[str, int] = {}
+        self.entries: Dict[int, SegmentEntry] = {}
+        self.by_time: List[Tuple[str, int]] = []
+        self.by_author: Dict[str, List[Tuple[str, int]]] = {}
+        self.by_tag: Dict[str, List[int]] = {}
+        self.hour_sources: Dict[str, Dict[str, int]] = {}       # Hour (created_at prefix) -> tweets per source
+        self.hour_tags: Dict[str, Dict[str, int]] = {}          # Hour -> tweets per rule tag
+        self.sorted = True
+
+    def segments(self) -> List[Tuple[SegmentStore, str]]:
+        return [(store, filepath) for store in self.stores for filepath in store.segments()]
+
+    def refresh(self) -> None:
+        '''
+        Indexes the complete lines appended to the segments since the last refresh
+        '''
+        for store, filepath in self.segments():
+            offset = self.offsets.get(filepath, 0)
+            if os.path.getsize(filepath) <= offset:
+                continue
+            with open(filepath, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1        # A partial last line is still being written
+            start = 0
+            while start < end:
+                line_end = data.index(b"\n", start)
+                self.index_line(store, filepath, data[start:line_end], offset + start)
+                start = line_end + 1
+            self.offsets[filepath] = offset + end
+
+    def index_line(self, store: SegmentStore, filepath: str, line: bytes, offset: int) -> None:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return      # Empty line terminating a partial write, or an undecodable one
+        tweet = message.get("data") if isinstance(message, dict) else None
+        if not isinstance(tweet, dict) or "id" not in tweet:
+            return      # Not a tweet, e.g. a stream error message
+
+        tweet_id = int(tweet["id"])
+        entry = self.entries.get(tweet_id)
+        if entry is None:
+            created_at = tweet.get("created_at") or to_iso(store.segment_created_at(filepath))
+            entry = self.entries[tweet_id] = SegmentEntry(created_at, tweet.get("author_id"), store.prefix, filepath, offset, len(line))
+            self.by_time.append((created_at, tweet_id))
+            if entry.author_id is not None:
+                self.by_author.setdefault(entry.author_id, []).append((created_at, tweet_id))
+            sources = self.hour_sources.setdefault(created_at[:HOUR_PREFIX], {})
+            sources[entry.source] = sources.get(entry.source, 0) + 1
+            self.sorted = False
+        else:
+            entry.author_id = tweet.get("author_id") or entry.author_id
+            entry.filepath, entry.offset, entry.length = filepath, offset, len(line)
+        for rule in message.get("matching_rules", []):
+            tag = rule.get("tag") or ""
+            if tag not in entry.tags:
+                entry.tags.add(tag)
+                self.by_tag.setdefault(tag, []).append(tweet_id)
+                tags = self.hour_tags.setdefault(entry.created_at[:HOUR_PREFIX], {})
+                tags[tag] = tags.get(tag, 0) + 1
+                self.sorted = False
+
+    def sort(self) -> None:
+        '''
+        Sorts the orders after new tweets were appended, which is close to linear as they only have a short unsorted tail
+        '''
+        if self.sorted:
+            return
+        self.by_time.sort()
+        for keys in self.by_author.values():
+            keys.sort()
+        for tweet_ids in self.by_tag.values():
+            tweet_ids.sort()
+        self.sorted = True
+
+    def page(self, since: Optional[float], until: Optional[float], after: Optional[Tuple[str, int]], limit: int,
+             tag: Optional[str] = None, author_id: Optional[str] = None) -> List[Tuple[str, int]]:
+        '''
+        Returns the (created_at, id) of a page, newest first, following the same orders as the database queries
+        '''
+        since_iso = to_iso(since) if since is not None else None
+        until_iso = to_iso(until) if until is not None else None
+        with self.lock:
+            self.refresh()
+            self.sort()
+            if tag is not None:
+                # Ordered by tweet ID, filtered by time
+                tweet_ids = self.by_tag.get(tag, [])
+                page = []
+                for index in range(bisect.bisect_left(tweet_ids, after[1]) if after is not None else len(tweet_ids), 0, -1):
+                    entry = self.entries[tweet_ids[index - 1]]
+                    if (since_iso is None or entry.created_at >= since_iso) and (until_iso is None or entry.created_at < until_iso):
+                        if author_id is None or entry.author_id == author_id:
+                            page.append((entry.created_at, tweet_ids[index - 1]))
+                            if len(page) == limit:
+                                break
+                return page
+
+            # Ordered by (created_at, id), the time range being a slice of it
+            keys = self.by_time if author_id is None else self.by_author.get(author_id, [])
+            low = bisect.bisect_left(keys, (since_iso,)) if since_iso is not None else 0
+            high = bisect.bisect_left(keys, (until_iso,)) if until_iso is not None else len(keys)
+            if after is not None:
+                high = min(high, bisect.bisect_left(keys, after))
+            return keys[max(low, high - limit):high][::-1]
+
+    def read_payloads(self, tweet_ids: List[int]) -> Dict[int, str]:
+        with self.lock:
+            locations = [(entry.filepath, entry.offset, entry.length, tweet_id)
+                         for tweet_id, entry in ((tweet_id, self.entries.get(tweet_id)) for tweet_id in tweet_ids) if entry is not None]
+        payloads = {}
+        f, current = None, None
+        try:
+            for filepath, offset, length, tweet_id in sorted(locations):     # Reads each segment once, front to back
+                if filepath != current:
+                    if f is not None:
+                        f.close()
+                    f, current = open(filepath, "rb"), filepath
+                f.seek(offset)
+                payloads[tweet_id] = f.read(length).decode("utf8")
+        finally:
+            if f is not None:
+                f.close()
+        return payloads
+
+    def open_page(self, since: Optional[float], until: Optional[float], after: Optional[Tuple[str, int]], limit: int,
+                  tag: Optional[str] = None, author_id: Optional[str] = None) -> Tuple[Iterator[List[Tuple[str, int, str]]], Callable[[], None]]:
+        '''
+        Selects the page from the index, whose payloads are then read in batches (segments are append-only, so a payload
+        never changes once indexed)
+        '''
+        keys = self.page(since, until, after, limit, tag=tag, author_id=author_id)
+
+        def batches() -> Iterator[List[Tuple[str, int, str]]]:
+            for start in range(0, len(keys), STREAM_CHUNK_ROWS):
+                batch = keys[start:start + STREAM_CHUNK_ROWS]
+                payloads = self.read_payloads([tweet_id for _, tweet_id in batch])
+                yield [(created_at, tweet_id, payloads[tweet_id]) for created_at, tweet_id in batch if tweet_id in payloads]
+        return batches(), lambda: None
+
+    def get_tweets(self, tweet_ids: List[int]) -> Dict[int, str]:
+        with self.lock:
+            self.refresh()
+        return self.read_payloads(tweet_ids)
+
+    def aggregates(self, interval: str, since: Optional[float], until: Optional[float], tag: Optional[str]) -> dict:
+        '''
+        Sums the counts of the hours within [since, until), kept up to date as lines are indexed, and only reads the tweets
+        of the (at most two) hours the bounds fall in
+        '''
+        since_iso = to_iso(since) if since is not None else None
+        until_iso = to_iso(until) if until is not None else None
+        counts: Dict[Tuple[str, str], int] = {}
+        totals: Dict[str, int] = {}
+
+        def within(hour: str) -> bool:
+            start = f"{hour}:00:00.000Z"
+            end = to_iso(datetime.strptime(hour, "%Y-%m-%dT%H").replace(tzinfo=timezone.utc).timestamp() + 60 * 60)
+            return (since_iso is None or start >= since_iso) and (until_iso is None or end <= until_iso)
+
+        def count(bucket: str, source: str, tags, tweets: int = 1) -> None:
+            if source is not None:
+                totals[source] = totals.get(source, 0) + tweets
+            for entry_tag, tag_tweets in tags:
+                if tag is None or entry_tag == tag:
+                    counts[(bucket, entry_tag)] = counts.get((bucket, entry_tag), 0) + tag_tweets
+
+        with self.lock:
+            self.refresh()
+            self.sort()
+            for hour, sources in self.hour_sources.items():
+                if within(hour):
+                    for source, tweets in sources.items():
+                        count(hour[:INTERVALS[interval]], source, (), tweets)
+                    count(hour[:INTERVALS[interval]], None, self.hour_tags.get(hour, {}).items())
+
+            for hour in {bound[:HOUR_PREFIX] for bound in (since_iso, until_iso) if bound is not None}:
+                if within(hour):
+                    continue
+                start = max(f"{hour}:00:00.000Z", since_iso or "")
+                end = min(f"{hour}:59:59.999Z~", until_iso or "~")
+                for created_at, tweet_id in self.by_time[bisect.bisect_left(self.by_time, (start,)):bisect.bisect_left(self.by_time, (end,))]:
+                    entry = self.entries[tweet_id]
+                    count(created_at[:INTERVALS[interval]], entry.source, ((entry_tag, 1) for entry_tag in entry.tags))
+        return {
+            "interval": interval,
+            "counts": [{"bucket": bucket, "tag": entry_tag, "tweets": tweets} for (bucket, entry_tag), tweets in sorted(counts.items())],
+            "totals": totals,
+        }
+
+
+class QueryAPI:
+    def __init__(self, db_filepath: str, segment_stores: List[SegmentStore], search_index_dir: str, analytics_dir: str,
+                 page_size: int = 100, max_page_size: int = 1000, cache_size: int = 256, cache_max_bytes: int = 1024 * 1024):
+        self.database = TweetQueries(db_filepath)
+        self.segments = SegmentQueries(segment_stores)
+        self.search_index_dir = search_index_dir
+        self.search_index = None
+        self.search_lock = threading.Lock()
+        self.snapshot_filepath = os.path.join(analytics_dir, "snapshot.json")
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.cache = ResponseCache(cache_size, cache_max_bytes)
+
+    @staticmethod
+    def from_config(config: RawConfigParser) -> "QueryAPI":
+        return QueryAPI(
+            config["FILEPATHS"]["tweets_db_file"],
+            [SegmentStore(config["FILEPATHS"][f"{service}_tweet_store_dir"], service) for service in ("user", "stream")],
+            config.get("FILEPATHS", "search_index_dir", fallback="data/search_index"),
+            config.get("FILEPATHS", "analytics_dir", fallback="data/analytics"),
+            page_size=config.getint("QUERYAPI", "page_size", fallback=100),
+            max_page_size=config.getint("QUERYAPI", "max_page_size", fallback=1000),
+            cache_size=config.getint("QUERYAPI", "cache_size", fallback=256),
+            cache_max_bytes=config.getint("QUERYAPI", "cache_max_bytes", fallback=1024 * 1024),
+        )
+
+    @property
+    def queries(self):
+        '''
+        The tweets are read from the database when there is one, otherwise from the segments
+        '''
+        return self.database if self.database.exists() else self.segments
+
+    def data_version(self) -> str:
+        '''
+        Identifies the current data by the size and modification time of every file the responses are read from
+        '''
+        state = []
+        filepaths = [self.database.filepath, f"{self.database.filepath}-wal", os.path.join(self.search_index_dir, "index.json"), self.snapshot_filepath]
+        if not self.database.exists():
+            filepaths.extend(filepath for _, filepath in self.segments.segments())
+        for filepath in filepaths:
+            try:
+                stat = os.stat(filepath)
+                state.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+            except FileNotFoundError:
+                state.append("-")
+        return hashlib.sha1(";".join(state).encode("utf8")).hexdigest()
+
+    def search(self, query: str, since: Optional[float], until: Optional[float], before: Optional[int], limit: int) -> List[int]:
+        with self.search_lock:
+            if self.search_index is None:
+                self.search_index = SearchIndex(self.search_index_dir)
+            self.search_index.refresh()     # Picks up the segments written by the collector since the last query
+            return [int(tweet_id) for tweet_id in self.search_index.search(query, since=since, until=until, before=before, limit=limit)]
+
+    def page_limit(self, limit: Optional[int]) -> int:
+        return max(1, min(limit or self.page_size, self.max_page_size))
+
+    def create_app(self, cors_origins: Optional[List[str]] = None) -> "FastAPI":
+        require_fastapi()
+        app = FastAPI(title="TwitterScraper Query API")
+        if cors_origins:
+            app.add_middleware(CORSMiddleware, allow_origins=cors_origins, allow_methods=["GET"], allow_headers=["If-None-Match"],
+                               expose_headers=["ETag"])
+
+        def parse_times(since: Optional[str], until: Optional[str]) -> Tuple[Optional[float], Optional[float]]:
+            try:
+                return parse_time(since), parse_time(until)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid date - {e}")
+
+        async def respond(request: Request, build) -> Response:
+            '''
+            Answers from the cache or with 304 when possible, otherwise with the body built by 'build': JSON bytes, or the
+            async chunks of a page and the function closing it.
+            The body is only sent with the ETag of a version if the version was unchanged once the body (or the snapshot the
+            page is read from) was taken, otherwise it is built again. Data written to continuously is sent without ETag.
+            '''
+            key = str(request.url)
+            for attempt in range(VERSION_ATTEMPTS):
+                version = await asyncio.to_thread(self.data_version)
+                self.cache.validate(version)
+                etag = f'"{hashlib.sha1(f"{version}:{key}".encode("utf8")).hexdigest()}"'
+                headers = {"ETag": etag, "Cache-Control": "no-cache"}       # Cached by the client, but always revalidated
+
+                if_none_match = request.headers.get("if-none-match", "")
+                if if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+                    return Response(status_code=304, headers=headers)
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return Response(cached[1], media_type="application/json", headers=headers)
+
+                try:
+                    body = await build()
+                except FileNotFoundError as e:
+                    raise HTTPException(status_code=503, detail=str(e))
+                except (ValueError, sqlite3.OperationalError) as e:
+                    raise HTTPException(status_code=400, detail=f"Invalid request - {e}")
+                if await asyncio.to_thread(self.data_version) == version:
+                    break
+                if attempt + 1 < VERSION_ATTEMPTS:
+                    if not isinstance(body, bytes):
+                        body[1]()       # Written meanwhile, the page may be newer than the ETag
+                    continue
+                version, headers = None, {"Cache-Control": "no-store"}
+
+            if isinstance(body, bytes):
+                if version is not None:
+                    self.cache.put(key, version, etag, body)
+                return Response(body, media_type="application/json", headers=headers)
+
+            async def stream() -> AsyncIterator[bytes]:
+                chunks = []
+                async for chunk in body[0]:
+                    chunks.append(chunk)
+                    yield chunk
+                if version is not None:
+                    self.cache.put(key, version, etag, b"".join(chunks))
+            return StreamingResponse(stream(), media_type="application/json", headers=headers)
+
+        async def stream_page(since: Optional[float], until: Optional[float], after: Optional[Tuple[str, int]], limit: int,
+                              tag: Optional[str], author_id: Optional[str]):
+            '''
+            Starts the page query, then returns its chunks, {"data": [<payload>, ...], "next_cursor": ...}, and the function
+            closing the page if the chunks are never read
+            '''
+            batches, close = await asyncio.to_thread(self.queries.open_page, since, until, after, limit, tag=tag, author_id=author_id)
+
+            async def chunks() -> AsyncIterator[bytes]:
+                count, last = 0, None
+                try:
+                    yield b'{"data":['
+                    while True:
+                        batch = await asyncio.to_thread(next, batches, None)
+                        if batch is None:
+                            break
+                        if not batch:
+                            continue        # Only possible for the segments, whose batches skip unreadable payloads
+                        yield ("," if count else "").encode("utf8") + ",".join(payload for _, _, payload in batch).encode("utf8")
+                        count += len(batch)
+                        last = batch[-1]
+                finally:
+                    close()
+                next_cursor = encode_cursor(last[0], last[1]) if count == limit else None
+                yield f'],"next_cursor":{json.dumps(next_cursor)}}}'.encode("utf8")
+            return chunks(), close
+
+        async def list_tweets(request: Request, since: Optional[str], until: Optional[str], cursor: Optional[str], limit: Optional[int],
+                              tag: Optional[str] = None, author_id: Optional[str] = None) -> Response:
+            since_time, until_time = parse_times(since, until)
+            limit = self.page_limit(limit)
+            try:
+                after = decode_cursor(cursor) if cursor is not None else None
+            except (ValueError, TypeError) as e:
+                raise HTTPException(status_code=400, detail=f"Invalid cursor - {e}")
+            return await respond(request, lambda: stream_page(since_time, until_time, after, limit, tag, author_id))
+
+        @app.get("/tweets")
+        async def tweets(request: Request, since: Optional[str] = None, until: Optional[str] = None, cursor: Optional[str] = None,
+                         limit: Optional[int] = Query(None, ge=1)) -> Response:
+            return await list_tweets(request, since, until, cursor, limit)
+
+        @app.get("/tweets/tag/{tag}")
+        async def tweets_by_tag(request: Request, tag: str, since: Optional[str] = None, until: Optional[str] = None,
+                                cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1)) -> Response:
+            return await list_tweets(request, since, until, cursor, limit, tag=tag)
+
+        @app.get("/tweets/author/{author_id}")
+        async def tweets_by_author(request: Request, author_id: str, since: Optional[str] = None, until: Optional[str] = None,
+                                   cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1)) -> Response:
+            return await list_tweets(request, since, until, cursor, limit, author_id=author_id)
+
+        @app.get("/search")
+        async def search(request: Request, q: str, since: Optional[str] = None, until: Optional[str] = None, cursor: Optional[str] = None,
+                         limit: Optional[int] = Query(None, ge=1)) -> Response:
+            since_time, until_time = parse_times(since, until)
+            limit = self.page_limit(limit)
+            try:
+                before = decode_cursor(cursor)[1] if cursor is not None else None
+            except (ValueError, TypeError) as e:
+                raise HTTPException(status_code=400, detail=f"Invalid cursor - {e}")
+
+            async def build() -> bytes:
+                tweet_ids = await asyncio.to_thread(self.search, q, since_time, until_time, before, limit)
+                payloads = await asyncio.to_thread(self.queries.get_tweets, tweet_ids)
+                data = ",".join(payloads.get(tweet_id) or json.dumps({"data": {"id": str(tweet_id)}}) for tweet_id in tweet_ids)
+                next_cursor = encode_cursor("", tweet_ids[-1]) if len(tweet_ids) == limit else None
+                return f'{{"data":[{data}],"next_cursor":{json.dumps(next_cursor)}}}'.encode("utf8")
+            return await respond(request, build)
+
+        @app.get("/aggregates")
+        async def aggregates(request: Request, interval: str = Query("day", pattern="^(hour|day)$"), since: Optional[str] = None,
+                             until: Optional[str] = None, tag: Optional[str] = None) -> Response:
+            since_time, until_time = parse_times(since, until)
+
+            async def build() -> bytes:
+                result = await asyncio.to_thread(self.queries.aggregates, interval, since_time, until_time, tag)
+                return json.dumps(result).encode("utf8")
+            return await respond(request, build)
+
+        @app.get("/analytics")
+        async def analytics(request: Request) -> Response:
+            async def build() -> bytes:
+                snapshot = await asyncio.to_thread(read_json, self.snapshot_filepath)
+                if snapshot is None:
+                    raise FileNotFoundError(f"No analytics snapshot at {self.snapshot_filepath}, enable the [ANALYTICS] section")
+                snapshot.pop("state", None)     # Only needed to resume the analytics
+                return json.dumps(snapshot).encode("utf8")
+            return await respond(request, build)
+
+        return app
+
+
+def create_app(config: RawConfigParser) -> "FastAPI":
+    return QueryAPI.from_config(config).create_app(ast.literal_eval(config.get("QUERYAPI", "cors_origins", fallback="[]")))
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog="api", description="Serve the read API over the collected tweets")
+    arg_parser.add_argument("--config", default="config.ini", help="Config file")
+    arg_parser.add_argument("--host", default=None, help="Defaults to QUERYAPI host")
+    arg_parser.add_argument("--port", type=int, default=None, help="Defaults to QUERYAPI port")
+    args = arg_parser.parse_args()
+
+    require_fastapi()
+    import uvicorn
+
+    config = RawConfigParser()
+    config.read(args.config)
+    uvicorn.run(
+        create_app(config),
+        host=args.host or config.get("QUERYAPI", "host", fallback="127.0.0.1"),
+        port=args.port or config.getint("QUERYAPI", "port", fallback=8000),
+    )
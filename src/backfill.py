@@ -0,0 +1,164 @@
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional
+
+from .checkpoints import Checkpoints
+from .http_client import SharedClient
+from .records import TweetRecord
+from .utils import gather_bounded, RawConfigParser
+from .writer import AsyncWriter
+
+'''
+Closes the gaps left by stream disconnects and by the time between scheduled runs.
+The newest tweet ID and created_at received per rule tag are checkpointed as tweets are written. On (re)connect, and
+before any live tweet is written, the gap from each rule's checkpoint to the time of connection is recorded as pending
+(under the key gaps:<tag>, apart from the live checkpoint which the stream keeps advancing). The recent search endpoint is
+then queried for every pending gap, concurrently and page by page, and the results are put on the same writer as the stream,
+where the deduplication drops anything already received.
+A gap is only cleared once it has been searched completely: a failed search (or a stream dropped mid-backfill) leaves it
+pending for the next connection, and a search cut short by STREAMTWEET backfill_max_pages keeps its older remainder pending.
+Recent search only covers the last 7 days, so older gaps are clamped to that window.
+'''
+
+SEARCH_WINDOW = timedelta(days=7) - timedelta(minutes=1)
+SEARCH_PAGE_MAX = 100
+
+
+def format_time(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def gap_key(tag: str) -> str:
+    return f"gaps:{tag}"
+
+
+class Backfill:
+    def __init__(self, config: RawConfigParser, auth: Callable, writer: AsyncWriter, checkpoints: Checkpoints, logger: logging.Logger):
+        self.config = config
+        self.auth = auth
+        self.writer = writer
+        self.checkpoints = checkpoints
+        self.logger = logger
+
+    def record_received(self, records: List[TweetRecord]) -> None:
+        '''
+        Advances the per-tag checkpoints with the written tweets. Run by the writer, after the records are stored.
+        '''
+        for record in records:
+            try:
+                message = record.json
+            except ValueError:
+                continue
+            tweet = message.get("data")
+            if not isinstance(tweet, dict) or "id" not in tweet:
+                continue
+            for rule in message.get("matching_rules", []):
+                self.checkpoints.advance(rule.get("tag") or "", tweet["id"], created_at=tweet.get("created_at"), received_at=record.received_at)
+
+    def open_gaps(self, rules: List[Dict[str, str]]) -> None:
+        '''
+        Records the gap of every rule from its checkpoint to now as pending. Called on connection, before any live tweet
+        is written, since the live tweets move the checkpoint past the gap.
+        '''
+        now = format_time(datetime.now(timezone.utc))
+        for rule in rules:
+            checkpoint = self.checkpoints.get(rule["tag"])
+            if "newest_id" not in checkpoint:
+                continue        # Nothing received for this rule yet, so there is no gap to close
+
+            gaps = [gap for gap in self.checkpoints.get(gap_key(rule["tag"])).get("gaps", []) if gap["since_id"] != checkpoint["newest_id"]]
+            # A gap starting at the same tweet (nothing streamed since the last connection) is searched again up to now
+            gaps.append({
+                "since_id": checkpoint["newest_id"],
+                "received_at": checkpoint.get("received_at") or checkpoint.get("updated_at", 0),
+                "end_time": now,
+            })
+            self.checkpoints.set(gap_key(rule["tag"]), {"gaps": gaps})
+
+    def get_search_params(self, query: str, gap: dict, next_token: Optional[str]) -> dict:
+        tweetfields_section = self.config["TWEETFIELDS"]
+        tweetsfields = [key for key in tweetfields_section if tweetfields_section[key] == "True"]
+        params = {"query": query, "tweet.fields": ",".join(tweetsfields), "max_results": SEARCH_PAGE_MAX}
+
+        oldest_allowed = datetime.now(timezone.utc) - SEARCH_WINDOW
+        received_at = datetime.fromtimestamp(gap["received_at"], timezone.utc)
+        if received_at > oldest_allowed:
+            params["since_id"] = gap["since_id"]
+        else:
+            params["start_time"] = format_time(oldest_allowed)
+        if "until_id" in gap:
+            params["until_id"] = gap["until_id"]        # The newer part of the gap was already searched
+        else:
+            params["end_time"] = gap["end_time"]
+        if next_token is not None:
+            params["next_token"] = next_token
+        return params
+
+    async def backfill_gap(self, rule: str, tag: str, gap: dict) -> int:
+        '''
+        Searches the tweets of one rule within a gap, newest first, returning the number of tweets put on the writer.
+        If STREAMTWEET backfill_max_pages is reached first, the gap is narrowed to its remainder (older than the oldest
+        tweet found), which stays pending.
+        '''
+        session = SharedClient.get(self.config)
+        max_pages = self.config.getint("STREAMTWEET", "backfill_max_pages", fallback=10)
+        next_token = None
+        oldest_id = None
+        count = 0
+
+        for _ in range(max_pages):
+            response = await session.get(self.config["LINKS"]["twitter_search_recent_link"], auth=self.auth,
+                params=self.get_search_params(rule, gap, next_token))
+            response.raise_for_status()
+            search_response = response.json()
+
+            for tweet in search_response.get("data", []):
+                await self.writer.put(TweetRecord.from_json({"data": tweet, "matching_rules": [{"tag": tag}]}))
+                oldest_id = tweet["id"] if oldest_id is None or int(tweet["id"]) < int(oldest_id) else oldest_id
+                count += 1
+            next_token = search_response.get("meta", {}).get("next_token")
+            if next_token is None:
+                gap["done"] = True
+                break
+
+        if next_token is not None and oldest_id is not None:
+            gap["until_id"] = oldest_id
+            self.logger.warning(f"Backfill: Reached {max_pages} pages for rule {tag}, tweets older than {oldest_id} "
+                                f"are left pending for the next connection")
+        return count
+
+    async def backfill_rule(self, rule: str, tag: str) -> int:
+        '''
+        Searches the pending gaps of one rule, clearing each once it has been searched completely.
+        Returns the number of tweets put on the writer.
+        '''
+        gaps = self.checkpoints.get(gap_key(tag)).get("gaps", [])
+        count = 0
+        try:
+            for gap in gaps:
+                count += await self.backfill_gap(rule, tag, gap)
+        finally:
+            # Also on failure or cancellation, so that the searched gaps are not searched again
+            remaining = [gap for gap in gaps if not gap.pop("done", False)]
+            if remaining:
+                self.checkpoints.set(gap_key(tag), {"gaps": remaining})
+            else:
+                self.checkpoints.remove(gap_key(tag))
+        return count
+
+    async def run(self, rules: List[Dict[str, str]]) -> None:
+        '''
+        Backfills the pending gaps of every rule concurrently. A failing rule is logged without affecting the others or
+        the stream, and its gaps stay pending.
+        '''
+        started = time.monotonic()
+        concurrency = self.config.getint("STREAMTWEET", "backfill_concurrency", fallback=4)
+        counts = await gather_bounded((self.backfill_rule(rule["value"], rule["tag"]) for rule in rules), concurrency)
+
+        for rule, count in zip(rules, counts):
+            if isinstance(count, BaseException):
+                self.logger.error(f"Backfill Failed for rule {rule['tag']} - {count}")
+            elif count:
+                self.logger.info(f"Backfill: Recovered {count} tweets for rule {rule['tag']}")
+        self.logger.info(f"Backfill: Completed in {time.monotonic() - started:.1f} seconds")
@@ -0,0 +1,51 @@
+import time
+from typing import Dict, Optional
+
+from .utils import read_json, write_json_atomic
+
+'''
+Persistent checkpoints of the newest tweet ID seen per key (e.g. per user ID), kept between runs.
+Tweet IDs are time-ordered snowflakes, so a checkpoint only ever moves forward.
+'''
+
+
+class Checkpoints:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.entries: Dict[str, dict] = read_json(filepath, default={})
+
+    def get(self, key: str) -> dict:
+        return self.entries.get(key, {})
+
+    def get_newest_id(self, key: str) -> Optional[str]:
+        return self.get(key).get("newest_id")
+
+    def advance(self, key: str, newest_id: Optional[str], **fields) -> bool:
+        '''
+        Moves the checkpoint of 'key' to 'newest_id' (with any extra fields) if it is newer than the current one.
+        Returns whether the checkpoint moved.
+        '''
+        if not newest_id:
+            return False
+        current_id = self.get_newest_id(key)
+        if current_id is not None and int(current_id) >= int(newest_id):
+            return False
+        self.entries[key] = {**self.get(key), **fields, "newest_id": str(newest_id), "updated_at": time.time()}
+        return True
+
+    def set(self, key: str, entry: dict) -> None:
+        self.entries[key] = entry
+
+    def remove(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+    def merge(self, other: "Checkpoints") -> None:
+        '''
+        Advances the checkpoints with those of 'other' (e.g. written by another process)
+        '''
+        for key, entry in other.entries.items():
+            fields = {field: value for field, value in entry.items() if field not in ("newest_id", "updated_at")}
+            self.advance(key, entry.get("newest_id"), **fields)
+
+    def save(self) -> None:
+        write_json_atomic(self.filepath, self.entries)
@@ -0,0 +1,210 @@
+import os
+import sys
+import bisect
+import threading
+from array import array
+from typing import List, Optional
+
+from .records import TweetRecord
+
+'''
+Drops tweets which were already written, across stream reconnects, timeline re-polls and separate runs.
+Tweet IDs are 64-bit, time-ordered snowflakes, so the seen IDs are kept as:
+- an exact set of the most recent IDs (up to STORE dedup_window), absorbing the burst of duplicates after a reconnect
+- a sorted array of unsigned 64-bit integers (8 bytes per ID) holding up to STORE dedup_capacity older IDs
+- Bloom filters of the IDs evicted from the array, checked for the IDs below the eviction floor
+When the array is full, the smallest (oldest) IDs are evicted into the current Bloom filter (10 bits per ID of capacity) and
+the eviction floor is raised. Once the current filter holds as many IDs as the capacity, it becomes the previous one and
+a new filter is started, so the false positive rate stays below about 2% while memory stays bounded. Old tweets received late
+(e.g. deep timeline pages or the backfill of a newly added account) are therefore still written, unless they collide with
+an evicted ID (and IDs evicted two generations ago are forgotten, so such a tweet would be written again).
+The floor and the array are persisted as one binary file between runs, and the Bloom filters alongside it (<file>.bloom).
+Without these files (they are not committed, so every GitHub Actions run starts without them), the seen IDs are instead
+seeded from the most recent tweets of the service's stores, which are committed.
+'''
+
+BLOOM_BITS_PER_ID = 10
+BLOOM_HASHES = 7
+MASK_64 = (1 << 64) - 1
+
+
+class BloomFilter:
+    def __init__(self, bits: int, hashes: int = BLOOM_HASHES, data: Optional[bytearray] = None):
+        self.data = data if data is not None else bytearray((bits + 7) // 8)
+        self.bits = len(self.data) * 8
+        self.hashes = hashes
+
+    def positions(self, value: int) -> List[int]:
+        # Double hashing of the ID with two multiplicative hashes
+        first = (value * 0x9E3779B97F4A7C15) & MASK_64
+        second = (((value ^ (value >> 31)) * 0xBF58476D1CE4E5B9) & MASK_64) | 1
+        return [(first + index * second) % self.bits for index in range(self.hashes)]
+
+    def add(self, value: int) -> None:
+        for position in self.positions(value):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: int) -> bool:
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+
+
+class TweetDeduplicator:
+    def __init__(self, filepath: str, capacity: int = 1000000, window: int = 10000):
+        self.filepath = filepath
+        self.capacity = capacity
+        self.window = window
+        self.lock = threading.Lock()
+        self.floor = 0
+        self.ids = array("Q")
+        self.recent = set()
+        self.evicted = [self.new_bloom_filter()]       # Current filter first, then the previous one
+        self.evicted_count = 0                          # IDs added to the current filter
+        self.duplicates = 0
+        self.load()
+
+    def new_bloom_filter(self) -> BloomFilter:
+        return BloomFilter(max(self.capacity, 1) * BLOOM_BITS_PER_ID)
+
+    def evict(self, tweet_id: int) -> None:
+        if self.evicted_count >= self.capacity:
+            self.evicted = [self.new_bloom_filter(), self.evicted[0]]
+            self.evicted_count = 0
+        self.evicted[0].add(tweet_id)
+        self.evicted_count += 1
+
+    @property
+    def bloom_filepath(self) -> str:
+        return f"{self.filepath}.bloom"
+
+    def load(self) -> None:
+        if not os.path.exists(self.filepath):
+            return
+        stored = array("Q")
+        with open(self.filepath, "rb") as f:
+            stored.frombytes(f.read())
+        if sys.byteorder == "big":
+            stored.byteswap()       # Stored little-endian
+        if stored:
+            self.floor = stored[0]
+            self.ids = stored[1:]
+        if os.path.exists(self.bloom_filepath):
+            with open(self.bloom_filepath, "rb") as f:
+                header = array("Q", f.read(8))
+                data = f.read()
+            if sys.byteorder == "big":
+                header.byteswap()
+            self.evicted_count = header[0]
+            size = len(self.evicted[0].data)
+            self.evicted = [BloomFilter(0, data=bytearray(data[start:start + size])) for start in range(0, len(data), size)]
+
+    def seed(self, tweet_ids: List[int]) -> None:
+        '''
+        Records already written IDs as seen without a saved state, e.g. in a fresh checkout where only the tweets are kept
+        '''
+        with self.lock:
+            self.recent.update(tweet_ids)
+            self.compact()
+
+    def save(self) -> None:
+        with self.lock:
+            self.compact()
+            stored = array("Q", [self.floor])
+            stored.extend(self.ids)
+            if sys.byteorder == "big":
+                stored.byteswap()
+            os.makedirs(os.path.dirname(self.filepath) or ".", exist_ok=True)
+            temp_filepath = f"{self.filepath}.tmp"
+            with open(temp_filepath, "wb") as f:
+                stored.tofile(f)
+            os.replace(temp_filepath, self.filepath)
+            if self.floor:
+                header = array("Q", [self.evicted_count])
+                if sys.byteorder == "big":
+                    header.byteswap()
+                with open(temp_filepath, "wb") as f:
+                    header.tofile(f)
+                    for bloom_filter in self.evicted:
+                        f.write(bloom_filter.data)
+                os.replace(temp_filepath, self.bloom_filepath)
+
+    def compact(self) -> None:
+        '''
+        Merges the recent IDs into the sorted array, evicting the oldest IDs beyond the capacity
+        '''
+        if not self.recent:
+            return
+        merged = sorted(set(self.ids).union(self.recent)) if len(self.ids) < len(self.recent) * 8 else self.merge_sorted(sorted(self.recent))
+        if len(merged) > self.capacity:
+            self.floor = max(self.floor, merged[len(merged) - self.capacity - 1])
+            for tweet_id in merged[:len(merged) - self.capacity]:
+                self.evict(tweet_id)
+            merged = merged[len(merged) - self.capacity:]
+        self.ids = array("Q", merged)
+        self.recent = set()
+
+    def merge_sorted(self, new_ids: List[int]) -> List[int]:
+        merged = []
+        i = j = 0
+        while i < len(self.ids) and j < len(new_ids):
+            if self.ids[i] < new_ids[j]:
+                merged.append(self.ids[i])
+                i += 1
+            elif self.ids[i] > new_ids[j]:
+                merged.append(new_ids[j])
+                j += 1
+            else:
+                merged.append(self.ids[i])
+                i += 1
+                j += 1
+        merged.extend(self.ids[i:])
+        merged.extend(new_ids[j:])
+        return merged
+
+    def seen(self, tweet_id: int) -> bool:
+        if tweet_id in self.recent:
+            return True
+        if tweet_id <= self.floor:
+            return any(tweet_id in bloom_filter for bloom_filter in self.evicted)
+        position = bisect.bisect_left(self.ids, tweet_id)
+        return position < len(self.ids) and self.ids[position] == tweet_id
+
+    def add(self, tweet_id: int) -> bool:
+        '''
+        Records the ID, returning False if it was already seen
+        '''
+        if self.seen(tweet_id):
+            return False
+        self.recent.add(tweet_id)
+        if len(self.recent) >= self.window:
+            self.compact()
+        return True
+
+    def filter(self, records: List[TweetRecord]) -> List[TweetRecord]:
+        '''
+        Returns the records whose tweets were not seen before (nor earlier in the batch), without recording them:
+        the IDs are only recorded by commit(), once the records are written. Messages which are not tweets are always kept.
+        '''
+        kept = []
+        batch_ids = set()
+        with self.lock:
+            for record in records:
+                tweet_id = record.tweet_id
+                if tweet_id is None:
+                    kept.append(record)
+                elif int(tweet_id) in batch_ids or self.seen(int(tweet_id)):
+                    self.duplicates += 1
+                else:
+                    batch_ids.add(int(tweet_id))
+                    kept.append(record)
+        return kept
+
+    def commit(self, records: List[TweetRecord]) -> None:
+        '''
+        Records the IDs of written records as seen
+        '''
+        with self.lock:
+            for record in records:
+                tweet_id = record.tweet_id
+                if tweet_id is not None:
+                    self.add(int(tweet_id))
@@ -0,0 +1,476 @@
+import os
+import re
+import sys
+import json
+import heapq
+import bisect
+import operator
+import itertools
+import argparse
+import threading
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .records import TweetRecord
+from .utils import read_json, write_json_atomic
+
+'''
+User interaction graph, built incrementally from the collected tweets of both services.
+An edge links the author of a tweet to another user, per kind of interaction:
+- reply: the tweet replies to in_reply_to_user_id
+- mention: the tweet mentions the user in entities.mentions (except in retweets, whose mentions belong to the original)
+- retweet / quote: the tweet retweets or quotes a tweet of the user (referenced_tweets). The user is taken from the
+  message's includes when present, otherwise from the "RT @user:" mention or the quoted tweet's URL.
+Users are identified by their user ID, or by "@username" when only the username is known.
+
+User IDs are interned into consecutive integers, and the edges are held in compressed sparse row (CSR) arrays sorted by
+(source, target, kind), with the in-edges grouped by target and an edge order by weight. New batches go into a small delta of
+weights, which is merged into the existing arrays once it exceeds GRAPH compact_threshold edges, so neither a batch nor a
+compaction requires a full rebuild. The arrays (indexes included) and the delta are persisted in FILEPATHS graph_dir, and
+the graph is shared by the services of a process.
+
+    python -m src.graph stats
+    python -m src.graph neighbours 44196397 --direction in --kind mention
+    python -m src.graph top --k 20 --kind reply
+'''
+
+KINDS = ("mention", "reply", "quote", "retweet")
+STATUS_URL_PATTERN = re.compile(r"^https?://(?:mobile\.)?(?:twitter|x)\.com/(?P<username>\w+)/status/(?P<id>\d+)")
+EDGE_TYPECODES = (("sources", "I"), ("targets", "I"), ("kinds", "B"), ("weights", "I"))
+ARRAY_TYPECODES = EDGE_TYPECODES + (("offsets", "Q"), ("in_offsets", "Q"), ("in_sources", "I"), ("in_kinds", "B"),
+                                    ("rank_sources", "I"), ("rank_targets", "I"), ("rank_kinds", "B"), ("rank_weights", "I"))
+
+Edge = Tuple[int, int, int]     # (source, target, kind), as interned user indices and kind index
+
+
+def extract_interactions(message: dict) -> List[Tuple[str, str, str]]:
+    '''
+    Returns the (author, user, kind) interactions of a tweet message
+    '''
+    tweet = message.get("data")
+    if not isinstance(tweet, dict) or not tweet.get("author_id"):
+        return []
+    author = tweet["author_id"]
+    authors = {included["id"]: included.get("author_id") for included in message.get("includes", {}).get("tweets", []) if "id" in included}
+    references = {reference.get("type"): reference.get("id") for reference in tweet.get("referenced_tweets", [])}
+    entities = tweet.get("entities", {})
+    mentions = [mention.get("id") or f"@{mention['username'].lower()}" for mention in entities.get("mentions", []) if "username" in mention]
+    interactions = []
+
+    if tweet.get("in_reply_to_user_id"):
+        interactions.append((author, tweet["in_reply_to_user_id"], "reply"))
+
+    if "retweeted" in references:
+        user = authors.get(references["retweeted"]) or (mentions[0] if mentions else None)     # "RT @user: ..."
+        if user:
+            interactions.append((author, user, "retweet"))
+    else:
+        interactions.extend((author, user, "mention") for user in dict.fromkeys(mentions))
+
+    if "quoted" in references:
+        user = authors.get(references["quoted"])
+        for url in entities.get("urls", []):
+            match = STATUS_URL_PATTERN.match(url.get("expanded_url") or "")
+            if user is None and match is not None and match.group("id") == references["quoted"]:
+                user = f"@{match.group('username').lower()}"
+        if user:
+            interactions.append((author, user, "quote"))
+
+    return [interaction for interaction in interactions if interaction[0] != interaction[1]]
+
+
+def bisect_row(offsets: array, firsts: array, seconds: array, row: int, key: Tuple[int, int]) -> int:
+    '''
+    Returns the position of 'key' within a CSR row sorted by (first, second), or where it would be inserted
+    '''
+    if row + 1 >= len(offsets):
+        return offsets[-1]      # A user added since the last compaction, whose row is empty and at the end
+    low, high = offsets[row], offsets[row + 1]
+    while low < high:
+        middle = (low + high) // 2
+        if (firsts[middle], seconds[middle]) < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def insert_rows(arrays: List[array], positions: List[int], rows: List[tuple]) -> List[array]:
+    '''
+    Returns the parallel arrays with the rows inserted before their (non-decreasing) positions.
+    The runs between insertions are copied as slices, and the rows inserted at the same position are copied at once.
+    '''
+    columns = list(zip(*rows))
+    merged = [array(values.typecode) for values in arrays]
+    previous = start = 0
+    for position, group in itertools.groupby(positions):
+        end = start + sum(1 for _ in group)
+        for values, copy, column in zip(arrays, merged, columns):
+            copy.extend(values[previous:position])
+            copy.extend(column[start:end])
+        previous, start = position, end
+    for values, copy in zip(arrays, merged):
+        copy.extend(values[previous:])
+    return merged
+
+
+def shift_offsets(offsets: array, rows: List[int], count: int) -> array:
+    '''
+    Returns the CSR offsets of 'count' rows after inserting one entry into each row of 'rows'
+    '''
+    if len(offsets) < count + 1:
+        offsets = offsets + array("Q", [offsets[-1]]) * (count + 1 - len(offsets))
+    inserted = array("Q", bytes(8 * (count + 1)))
+    for row in rows:
+        inserted[row + 1] += 1
+    return array("Q", map(operator.add, offsets, itertools.accumulate(inserted)))
+
+
+class InteractionGraph:
+    _graphs: Dict[str, "InteractionGraph"] = {}
+    _graphs_lock = threading.Lock()
+
+    def __init__(self, directory: str, compact_threshold: int = 100000):
+        self.directory = directory
+        self.compact_threshold = compact_threshold
+        self.lock = threading.RLock()       # Batches may be written from different worker threads
+        self.users: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.sources = array("I")
+        self.targets = array("I")
+        self.kinds = array("B")
+        self.weights = array("I")
+        self.offsets = array("Q", [0])      # Source -> first edge position (CSR)
+        self.in_offsets = array("Q", [0])   # Target -> first position in the in-edges
+        self.in_sources = array("I")        # In-edges as (source, kind), grouped by target and sorted
+        self.in_kinds = array("B")
+        self.rank_sources = array("I")      # Edges with their weight at the time, lightest first (see top_edges)
+        self.rank_targets = array("I")
+        self.rank_kinds = array("B")
+        self.rank_weights = array("I")
+        self.generation = 0                 # Compactions so far, identifying which arrays a saved delta applies to
+        self.compacted = False              # Whether the arrays changed since they were last saved
+        self.delta: Dict[Edge, int] = {}
+        self.delta_out: Dict[int, set] = {}
+        self.delta_in: Dict[int, set] = {}
+        self.load()
+
+    @classmethod
+    def shared(cls, directory: str, compact_threshold: int = 100000) -> "InteractionGraph":
+        '''
+        Returns the graph of 'directory' shared by every sink of the process, so that services never overwrite each other
+        '''
+        with cls._graphs_lock:
+            if directory not in cls._graphs:
+                cls._graphs[directory] = InteractionGraph(directory, compact_threshold)
+            return cls._graphs[directory]
+
+    @staticmethod
+    def from_config(config) -> "InteractionGraph":
+        return InteractionGraph.shared(config["FILEPATHS"]["graph_dir"], compact_threshold=config.getint("GRAPH", "compact_threshold", fallback=100000))
+
+    @property
+    def meta_filepath(self) -> str:
+        return os.path.join(self.directory, "graph.json")
+
+    @property
+    def edges_filepath(self) -> str:
+        return os.path.join(self.directory, "edges.bin")
+
+    @property
+    def delta_filepath(self) -> str:
+        return os.path.join(self.directory, "delta.bin")
+
+    def intern(self, user: str) -> int:
+        position = self.index.get(user)
+        if position is None:
+            position = self.index[user] = len(self.users)
+            self.users.append(user)
+        return position
+
+    def find(self, edge: Edge) -> Optional[int]:
+        '''
+        Returns the position of an edge in the arrays, by binary search within its source's row
+        '''
+        source, target, kind = edge
+        position = bisect_row(self.offsets, self.targets, self.kinds, source, (target, kind))
+        if position < len(self.targets) and self.sources[position] == source and self.targets[position] == target and self.kinds[position] == kind:
+            return position
+        return None
+
+    def add(self, source: str, target: str, kind: str, weight: int = 1) -> None:
+        with self.lock:
+            self.add_edge((self.intern(source), self.intern(target), KINDS.index(kind)), weight)
+            if len(self.delta) >= self.compact_threshold:
+                self.compact()
+
+    def add_edge(self, edge: Edge, weight: int) -> None:
+        self.delta[edge] = self.delta.get(edge, 0) + weight
+        self.delta_out.setdefault(edge[0], set()).add(edge)
+        self.delta_in.setdefault(edge[1], set()).add(edge)
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        with self.lock:
+            for record in records:
+                try:
+                    interactions = extract_interactions(record.json)
+                except ValueError:
+                    continue
+                for source, target, kind in interactions:
+                    self.add(source, target, kind)
+
+    def compact(self) -> None:
+        '''
+        Merges the delta into the arrays: the weights of known edges are updated in place, and the new edges are inserted
+        into the edge arrays, the in-edges and the weight order at the positions found by binary search.
+        The weight order keeps the previous entries of updated edges (skipped as stale by top_edges), and is only
+        re-sorted once they outnumber the edges, so that a compaction never sorts the whole graph.
+        '''
+        with self.lock:
+            if not self.delta:
+                return
+            new_edges = []
+            ranked = []
+            for edge, weight in sorted(self.delta.items()):
+                position = self.find(edge)
+                if position is None:
+                    new_edges.append(edge)
+                else:
+                    weight += self.weights[position]
+                    self.weights[position] = weight
+                ranked.append((weight, edge))
+
+            users = len(self.users)
+            positions = [bisect_row(self.offsets, self.targets, self.kinds, source, (target, kind)) for source, target, kind in new_edges]
+            self.sources, self.targets, self.kinds, self.weights = insert_rows(
+                [self.sources, self.targets, self.kinds, self.weights], positions,
+                [(source, target, kind, self.delta[(source, target, kind)]) for source, target, kind in new_edges])
+            self.offsets = shift_offsets(self.offsets, [source for source, _, _ in new_edges], users)
+
+            new_edges.sort(key=lambda edge: (edge[1], edge[0], edge[2]))
+            positions = [bisect_row(self.in_offsets, self.in_sources, self.in_kinds, target, (source, kind)) for source, target, kind in new_edges]
+            self.in_sources, self.in_kinds = insert_rows([self.in_sources, self.in_kinds], positions,
+                                                         [(source, kind) for source, _, kind in new_edges])
+            self.in_offsets = shift_offsets(self.in_offsets, [target for _, target, _ in new_edges], users)
+
+            if len(self.rank_weights) + len(ranked) > 2 * len(self.weights):
+                self.build_rank()
+            else:
+                ranked.sort()
+                positions = [bisect.bisect_right(self.rank_weights, weight) for weight, _ in ranked]
+                self.rank_sources, self.rank_targets, self.rank_kinds, self.rank_weights = insert_rows(
+                    [self.rank_sources, self.rank_targets, self.rank_kinds, self.rank_weights], positions,
+                    [(source, target, kind, weight) for weight, (source, target, kind) in ranked])
+
+            self.delta = {}
+            self.delta_out = {}
+            self.delta_in = {}
+            self.generation += 1
+            self.compacted = True
+
+    def build_indexes(self) -> None:
+        '''
+        Builds the CSR offsets and the in-edges (a counting sort by target) from the edge arrays, for graphs saved without them
+        '''
+        users = len(self.users)
+        counts = array("Q", bytes(8 * (users + 1)))
+        in_counts = array("Q", bytes(8 * (users + 1)))
+        for position in range(len(self.sources)):
+            counts[self.sources[position] + 1] += 1
+            in_counts[self.targets[position] + 1] += 1
+        for user in range(users):
+            counts[user + 1] += counts[user]
+            in_counts[user + 1] += in_counts[user]
+        self.offsets = counts
+
+        self.in_offsets = array("Q", in_counts)
+        self.in_sources = array("I", bytes(4 * len(self.sources)))
+        self.in_kinds = array("B", bytes(len(self.sources)))
+        for position in range(len(self.sources)):     # In source order, so each target's in-edges stay sorted by (source, kind)
+            target = self.targets[position]
+            self.in_sources[in_counts[target]] = self.sources[position]
+            self.in_kinds[in_counts[target]] = self.kinds[position]
+            in_counts[target] += 1
+        self.build_rank()
+
+    def build_rank(self) -> None:
+        '''
+        Sorts the edges by weight, dropping the stale entries of the weight order
+        '''
+        order = sorted(range(len(self.weights)), key=self.weights.__getitem__)
+        self.rank_sources = array("I", (self.sources[position] for position in order))
+        self.rank_targets = array("I", (self.targets[position] for position in order))
+        self.rank_kinds = array("B", (self.kinds[position] for position in order))
+        self.rank_weights = array("I", (self.weights[position] for position in order))
+
+    def row(self, position: int, direction: str) -> Iterator[Tuple[Edge, int]]:
+        '''
+        Yields the out-edges or in-edges of a user within the arrays, with their weight (none for users added since the last compaction)
+        '''
+        if direction == "out":
+            if position + 1 < len(self.offsets):
+                for edge_position in range(self.offsets[position], self.offsets[position + 1]):
+                    yield (position, self.targets[edge_position], self.kinds[edge_position]), self.weights[edge_position]
+        elif position + 1 < len(self.in_offsets):
+            for index in range(self.in_offsets[position], self.in_offsets[position + 1]):
+                edge = (self.in_sources[index], position, self.in_kinds[index])
+                yield edge, self.weights[self.find(edge)]
+
+    def neighbours(self, user: str, direction: str = "out", kind: Optional[str] = None) -> List[Tuple[str, str, int]]:
+        '''
+        Returns the (user, kind, weight) neighbours of a user, heaviest first.
+        'direction' is "out" for the users it interacted with, or "in" for the users who interacted with it.
+        '''
+        with self.lock:
+            position = self.index.get(user)
+            if position is None:
+                return []
+            kind_index = KINDS.index(kind) if kind is not None else None
+            other = 1 if direction == "out" else 0
+
+            weights: Dict[Edge, int] = dict(self.row(position, direction))
+            for edge in (self.delta_out if direction == "out" else self.delta_in).get(position, ()):
+                weights[edge] = weights.get(edge, 0) + self.delta[edge]
+
+            neighbours = [(self.users[edge[other]], KINDS[edge[2]], weight) for edge, weight in weights.items()
+                          if kind_index is None or edge[2] == kind_index]
+            return sorted(neighbours, key=lambda neighbour: (-neighbour[2], neighbour[0], neighbour[1]))
+
+    def top_edges(self, k: int, kind: Optional[str] = None) -> List[Tuple[str, str, str, int]]:
+        '''
+        Returns the k heaviest (source, target, kind, weight) edges.
+        The edges changed by the delta compete with the heaviest unchanged edges, read in weight order. An entry of the
+        weight order is stale once its edge got heavier (weights only grow), hence skipped.
+        '''
+        with self.lock:
+            kind_index = KINDS.index(kind) if kind is not None else None
+            candidates: Dict[Edge, int] = {}
+            for edge, weight in self.delta.items():
+                if kind_index is None or edge[2] == kind_index:
+                    position = self.find(edge)
+                    candidates[edge] = weight + (self.weights[position] if position is not None else 0)
+
+            unchanged = 0
+            for index in range(len(self.rank_weights) - 1, -1, -1):
+                if unchanged >= k and self.rank_weights[index] < lightest:
+                    break       # Read past the k-th weight's ties, so that ties are broken by edge like the candidates
+                edge = (self.rank_sources[index], self.rank_targets[index], self.rank_kinds[index])
+                if (kind_index is None or edge[2] == kind_index) and edge not in self.delta and edge not in candidates:
+                    if self.weights[self.find(edge)] == self.rank_weights[index]:
+                        candidates[edge] = lightest = self.rank_weights[index]
+                        unchanged += 1
+
+            top = heapq.nsmallest(k, candidates.items(), key=lambda item: (-item[1], item[0]))
+            return [(self.users[edge[0]], self.users[edge[1]], KINDS[edge[2]], weight) for edge, weight in top]
+
+    @staticmethod
+    def read_arrays(f, typecodes: Tuple[Tuple[str, str], ...]) -> Tuple[int, Dict[str, array]]:
+        '''
+        Reads the arrays written by write_arrays: a header of the generation and every array's length, then the arrays
+        '''
+        header = array("Q")
+        header.fromfile(f, len(typecodes) + 1)
+        if sys.byteorder == "big":
+            header.byteswap()       # Stored little-endian
+        arrays = {}
+        for (name, typecode), count in zip(typecodes, header[1:]):
+            values = array(typecode)
+            values.fromfile(f, count)
+            if sys.byteorder == "big":
+                values.byteswap()
+            arrays[name] = values
+        return header[0], arrays
+
+    @staticmethod
+    def write_arrays(filepath: str, generation: int, arrays: List[array]) -> None:
+        temp_filepath = f"{filepath}.tmp"
+        with open(temp_filepath, "wb") as f:
+            for values in [array("Q", [generation] + [len(values) for values in arrays])] + arrays:
+                values = array(values.typecode, values)
+                if sys.byteorder == "big":
+                    values.byteswap()
+                values.tofile(f)
+        os.replace(temp_filepath, filepath)
+
+    def load(self) -> None:
+        meta = read_json(self.meta_filepath, default={})
+        if not meta or not os.path.exists(self.edges_filepath):
+            return
+        self.users = meta["users"]
+        self.index = {user: position for position, user in enumerate(self.users)}
+        with open(self.edges_filepath, "rb") as f:
+            if "edges" in meta:
+                # Saved before the indexes were persisted: only the edge arrays, up to the edge count of graph.json
+                for name, typecode in EDGE_TYPECODES:
+                    values = array(typecode)
+                    values.fromfile(f, meta["edges"])
+                    if sys.byteorder == "big":
+                        values.byteswap()
+                    setattr(self, name, values)
+                self.build_indexes()
+                self.compacted = True
+            else:
+                self.generation, arrays = self.read_arrays(f, ARRAY_TYPECODES)
+                for name, values in arrays.items():
+                    setattr(self, name, values)
+
+        if os.path.exists(self.delta_filepath):
+            with open(self.delta_filepath, "rb") as f:
+                generation, delta = self.read_arrays(f, EDGE_TYPECODES)
+            if generation == self.generation:      # Otherwise the delta was already merged into the arrays
+                for source, target, kind, weight in zip(delta["sources"], delta["targets"], delta["kinds"], delta["weights"]):
+                    self.add_edge((source, target, kind), weight)
+
+    def save(self) -> None:
+        '''
+        Writes the users, the arrays if they were compacted since they were last saved, and the delta, which is merged
+        later (once it exceeds GRAPH compact_threshold) rather than on every save.
+        The users are written first: they are only ever appended, so the arrays never refer to an unknown user. A delta is
+        tagged with the generation of the arrays, so that a delta already merged into newer arrays is never applied twice.
+        '''
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            write_json_atomic(self.meta_filepath, {"kinds": KINDS, "users": self.users})
+            if self.compacted or not os.path.exists(self.edges_filepath):
+                self.write_arrays(self.edges_filepath, self.generation, [getattr(self, name) for name, _ in ARRAY_TYPECODES])
+                self.compacted = False
+            delta = sorted(self.delta.items())
+            self.write_arrays(self.delta_filepath, self.generation, [
+                array("I", (edge[0] for edge, _ in delta)),
+                array("I", (edge[1] for edge, _ in delta)),
+                array("B", (edge[2] for edge, _ in delta)),
+                array("I", (weight for _, weight in delta)),
+            ])
+
+    def close(self) -> None:
+        self.save()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog="graph", description="Query the user interaction graph")
+    arg_parser.add_argument("--dir", default="data/graph", help="Directory of the graph")
+    subparsers = arg_parser.add_subparsers(dest="subcommand", required=True)
+    subparsers.add_parser("stats", help="Print the number of users and edges per kind")
+    neighbours_parser = subparsers.add_parser("neighbours", help="Print the neighbours of a user ID (or @username)")
+    neighbours_parser.add_argument("user")
+    neighbours_parser.add_argument("--direction", choices=("out", "in"), default="out")
+    neighbours_parser.add_argument("--kind", choices=KINDS, default=None)
+    neighbours_parser.add_argument("--k", type=int, default=20)
+    top_parser = subparsers.add_parser("top", help="Print the heaviest edges")
+    top_parser.add_argument("--kind", choices=KINDS, default=None)
+    top_parser.add_argument("--k", type=int, default=20)
+    args = arg_parser.parse_args()
+
+    graph = InteractionGraph(args.dir)
+    if args.subcommand == "stats":
+        graph.compact()     # Counts the edges of the delta too, without saving
+        per_kind = {kind: 0 for kind in KINDS}
+        for kind_index in graph.kinds:
+            per_kind[KINDS[kind_index]] += 1
+        print(json.dumps({"users": len(graph.users), "edges": len(graph.sources), "per_kind": per_kind}, sort_keys=True))
+    elif args.subcommand == "neighbours":
+        for user, kind, weight in graph.neighbours(args.user, args.direction, args.kind)[:args.k]:
+            print(f"{user}\t{kind}\t{weight}")
+    else:
+        for source, target, kind, weight in graph.top_edges(args.k, args.kind):
+            print(f"{source}\t{target}\t{kind}\t{weight}")
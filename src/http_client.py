@@ -0,0 +1,91 @@
+import time
+import httpx
+import asyncio
+import weakref
+import logging
+
+from .utils import RawConfigParser
+from .retry import ID_SEGMENT_PATTERN, rate_limits
+from .metrics import http_request_seconds
+
+'''
+Provides a single long-lived HTTP client per event loop, shared by TwitterStream and TwitterUser.
+The client keeps connections alive and multiplexes requests over HTTP/2, so repeated lookups and rule calls
+no longer pay a fresh TCP + TLS handshake each time. Pool limits are configured in the HTTPCLIENT section of config.ini.
+'''
+
+
+async def start_timer(request: httpx.Request) -> None:
+    '''
+    Request hook: marks the start of the request, once its rate-limit budget is available
+    '''
+    request.extensions["started_at"] = time.perf_counter()
+
+
+async def observe_latency(response: httpx.Response) -> None:
+    '''
+    Response hook: records the time until the response headers, per endpoint (IDs in the path collapsed) and status code
+    '''
+    request = response.request
+    started_at = request.extensions.get("started_at")
+    if started_at is not None:
+        endpoint = f"{request.method} {ID_SEGMENT_PATTERN.sub('/:id', request.url.path)}"
+        http_request_seconds.observe(time.perf_counter() - started_at, endpoint, str(response.status_code))
+
+
+class SharedClient:
+    # httpx.AsyncClient is bound to the event loop it was first used on, hence one client per loop
+    _clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def create_client(config: RawConfigParser) -> httpx.AsyncClient:
+        '''
+        Creates a pooled client using the limits defined in the HTTPCLIENT section of config.ini.
+        Every request waits for its endpoint's rate-limit budget, which is updated from every response, and its latency is recorded.
+        '''
+        limits = httpx.Limits(
+            max_connections=config.getint("HTTPCLIENT", "max_connections", fallback=100),
+            max_keepalive_connections=config.getint("HTTPCLIENT", "max_keepalive_connections", fallback=20),
+            keepalive_expiry=config.getfloat("HTTPCLIENT", "keepalive_expiry", fallback=30),
+        )
+        return httpx.AsyncClient(
+            http2=config.getboolean("HTTPCLIENT", "http2", fallback=True),
+            limits=limits,
+            timeout=config.getfloat("HTTPCLIENT", "timeout", fallback=30),
+            event_hooks={"request": [rate_limits.wait, start_timer], "response": [rate_limits.update, observe_latency]},
+        )
+
+    @classmethod
+    def get(cls, config: RawConfigParser) -> httpx.AsyncClient:
+        '''
+        Returns the client of the running event loop, creating it on first use
+        '''
+        loop = asyncio.get_running_loop()
+        client = cls._clients.get(loop)
+        if client is None or client.is_closed:
+            client = cls.create_client(config)
+            cls._clients[loop] = client
+        return client
+
+    @classmethod
+    async def aclose(cls) -> None:
+        '''
+        Closes the client of the running event loop, if any
+        '''
+        client = cls._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None and not client.is_closed:
+            await client.aclose()
+
+
+async def run_with_client(coroutine) -> None:
+    '''
+    Runs a service coroutine and closes the shared client of the loop once it completes (or fails).
+    Intended as the target of asyncio.run(), since the client cannot outlive its event loop.
+    '''
+    try:
+        return await coroutine
+    finally:
+        try:
+            await SharedClient.aclose()
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Failed to close shared client - {e}")
@@ -0,0 +1,218 @@
+import os
+import sys
+import mmap
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .utils import read_json, write_json_atomic
+
+'''
+Fast reader and indexer for the rotated '[asctime]: LEVEL:message' log files (e.g. data/prev_data/twitter_stream_data.log*).
+Files are memory-mapped and split into newline-aligned byte ranges, which are parsed in parallel across a process pool.
+Each line is classified as either a tweet record (a JSON message) or a control record (Get Rules, Set Rules, Delete Rules, ...),
+and a persistent offset index (tweet ID -> file and byte offset) allows random access to any tweet without rescanning.
+
+Files are identified by a fingerprint of their first bytes, so the index survives rotations (twitter_stream_data.log becoming
+twitter_stream_data.log.1) and only rescans the bytes appended since the previous build.
+JSONL segments (one message per line, no log prefix) are read the same way.
+
+    python -m src.log_reader build data/prev_data/twitter_stream_data.log*
+    python -m src.log_reader get 1594459418048937984
+    python -m src.log_reader controls data/prev_data/twitter_stream_data.log
+'''
+
+CONTROL_PREFIXES = (b"Get Rules", b"Set Rules", b"Delete All Rules", b"Delete Rules")
+FINGERPRINT_BYTES = 4096
+RANGE_BYTES = 8 * 1024 * 1024
+
+
+def fingerprint(filepath: str) -> str:
+    with open(filepath, "rb") as f:
+        return hashlib.sha1(f.read(FINGERPRINT_BYTES)).hexdigest()
+
+
+def split_message(line: bytes) -> Tuple[Optional[bytes], bytes]:
+    '''
+    Splits a log line into (asctime, message). Lines without the log prefix (JSONL) are returned whole as the message.
+    '''
+    if line.startswith(b"["):
+        end = line.find(b"]:")
+        level_end = line.find(b":", end + 2) if end != -1 else -1
+        if level_end != -1:
+            return line[1:end], line[level_end + 1:]
+    return None, line
+
+
+def split_ranges(filepath: str, start: int, range_bytes: int = RANGE_BYTES) -> List[Tuple[str, int, int]]:
+    '''
+    Splits the bytes of a file from 'start' onwards into ranges ending on line boundaries
+    '''
+    size = os.path.getsize(filepath)
+    if size <= start:
+        return []
+
+    ranges = []
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < size:
+            end = mm.find(b"\n", min(start + range_bytes, size) - 1)
+            end = size if end == -1 else end + 1
+            ranges.append((filepath, start, end))
+            start = end
+    return ranges
+
+
+def scan_range(filepath: str, start: int, end: int) -> dict:
+    '''
+    Parses the lines within [start, end) of a file. Run in a worker process.
+    Returns the tweet offsets, the control records and the number of other (e.g. error) lines.
+    '''
+    tweets: List[Tuple[str, int]] = []
+    controls: List[Tuple[int, str, str]] = []
+    others = 0
+
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = start
+        while position < end:
+            line_end = mm.find(b"\n", position, end)
+            line_end = end if line_end == -1 else line_end
+            line = mm[position:line_end].rstrip(b"\r")
+            offset = position
+            position = line_end + 1
+            if not line:
+                continue
+
+            asctime, message = split_message(line)
+            if message.startswith(b"{"):
+                try:
+                    tweet = json.loads(message).get("data")
+                except ValueError:
+                    others += 1
+                    continue
+                if isinstance(tweet, dict) and "id" in tweet:
+                    tweets.append((tweet["id"], offset))
+                else:
+                    others += 1
+            elif message.startswith(CONTROL_PREFIXES):
+                kind = message.split(b":", 1)[0].decode("utf8")
+                controls.append((offset, kind, asctime.decode("utf8") if asctime else ""))
+            else:
+                others += 1
+
+    return {"filepath": filepath, "tweets": tweets, "controls": controls, "others": others}
+
+
+class LogIndex:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        index = read_json(filepath, default={})
+        self.files: Dict[str, dict] = index.get("files", {})          # Fingerprint -> path, scanned size, counts and controls
+        self.tweets: Dict[str, list] = index.get("tweets", {})        # Tweet ID -> [fingerprint, byte offset]
+
+    def build(self, filepaths: List[str], workers: Optional[int] = None) -> Dict[str, int]:
+        '''
+        Scans the new bytes of every file in parallel and merges the results into the index
+        '''
+        ranges = []
+        fingerprints = {filepath: fingerprint(filepath) for filepath in filepaths}
+        self.forget_stale(fingerprints)
+
+        for filepath, key in fingerprints.items():
+            entry = self.files.setdefault(key, {"scanned": 0, "others": 0, "controls": []})
+            entry["path"] = filepath        # Follows the file across rotations
+            ranges.extend(split_ranges(filepath, entry["scanned"]))
+
+        stats = {"ranges": len(ranges), "tweets": 0, "controls": 0}
+        if ranges:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(scan_range, *zip(*ranges))
+                for (filepath, _, end), result in zip(ranges, results):
+                    key = fingerprints[filepath]
+                    entry = self.files[key]
+                    for tweet_id, offset in result["tweets"]:
+                        self.tweets[tweet_id] = [key, offset]
+                    entry["controls"].extend(result["controls"])
+                    entry["others"] += result["others"]
+                    entry["scanned"] = max(entry["scanned"], end)
+                    stats["tweets"] += len(result["tweets"])
+                    stats["controls"] += len(result["controls"])
+        return stats
+
+    def forget_stale(self, fingerprints: Dict[str, str]) -> None:
+        '''
+        Drops the entries of paths whose content no longer matches (e.g. a small file whose first bytes were still being written)
+        '''
+        current = set(fingerprints.values())
+        stale = {key for key, entry in self.files.items() if entry.get("path") in fingerprints and key not in current}
+        for key in stale:
+            del self.files[key]
+        if stale:
+            self.tweets = {tweet_id: location for tweet_id, location in self.tweets.items() if location[0] not in stale}
+
+    def save(self) -> None:
+        write_json_atomic(self.filepath, {"files": self.files, "tweets": self.tweets})
+
+    def locate(self, tweet_id: str) -> Optional[Tuple[str, int]]:
+        location = self.tweets.get(str(tweet_id))
+        if location is None:
+            return None
+        key, offset = location
+        return self.files[key]["path"], offset
+
+    def get(self, tweet_id: str) -> Optional[dict]:
+        '''
+        Reads a single tweet record by seeking to its indexed offset
+        '''
+        location = self.locate(tweet_id)
+        if location is None:
+            return None
+        filepath, offset = location
+        with open(filepath, "rb") as f:
+            f.seek(offset)
+            _, message = split_message(f.readline().rstrip(b"\r\n"))
+        return json.loads(message)
+
+    def controls(self, filepath: Optional[str] = None) -> Iterator[Tuple[str, str, str, dict]]:
+        '''
+        Yields the (path, asctime, kind, payload) control records, optionally of a single file
+        '''
+        for entry in self.files.values():
+            if filepath is not None and entry["path"] != filepath:
+                continue
+            with open(entry["path"], "rb") as f:
+                for offset, kind, asctime in entry["controls"]:
+                    f.seek(offset)
+                    _, message = split_message(f.readline().rstrip(b"\r\n"))
+                    payload = message.split(b":", 1)[1].strip()
+                    yield entry["path"], asctime, kind, json.loads(payload) if payload.startswith(b"{") else {}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog="log_reader", description="Index and query the rotated tweet log files")
+    arg_parser.add_argument("--index", default="data/log_index.json", help="Path of the persistent offset index")
+    subparsers = arg_parser.add_subparsers(dest="subcommand", required=True)
+    build_parser = subparsers.add_parser("build", help="Index new and appended log files")
+    build_parser.add_argument("files", nargs="+")
+    build_parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    get_parser = subparsers.add_parser("get", help="Print a tweet record by ID")
+    get_parser.add_argument("tweet_id")
+    controls_parser = subparsers.add_parser("controls", help="Print the rule management records")
+    controls_parser.add_argument("file", nargs="?", default=None)
+    args = arg_parser.parse_args()
+
+    index = LogIndex(args.index)
+    if args.subcommand == "build":
+        stats = index.build(args.files, workers=args.workers)
+        index.save()
+        print(f"Indexed {stats['tweets']} tweets and {stats['controls']} control records from {stats['ranges']} ranges "
+              f"({len(index.tweets)} tweets in index)")
+    elif args.subcommand == "get":
+        tweet = index.get(args.tweet_id)
+        if tweet is None:
+            sys.exit(f"Tweet {args.tweet_id} not found in {args.index}")
+        print(json.dumps(tweet, sort_keys=True))
+    else:
+        for path, asctime, kind, payload in index.controls(args.file):
+            print(f"{path} [{asctime}] {kind}: {json.dumps(payload, sort_keys=True)}")
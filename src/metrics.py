@@ -0,0 +1,302 @@
+import json
+import time
+import bisect
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .utils import RawConfigParser, write_json_atomic
+
+'''
+In-process metrics of the collectors: counters, latency histograms and gauges, shared by every service of the process.
+Updating a metric only takes a lock and a dict update, so they are safe to use from the event loop and the writer threads.
+The exporter serves them in the Prometheus text format on METRICS host:port (GET /metrics, or /metrics.json), and writes
+a JSON snapshot to FILEPATHS metrics_file every METRICS snapshot_interval seconds, with the per-second rate of every counter
+over the interval (e.g. tweets written per second).
+Metrics are per process: in the sharded and parallel stream modes, the workers' own metrics are not exported, while the
+main process covers the merged writes.
+'''
+
+PREFIX = "twitterscraper_"
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+WRITE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+LAG_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values))]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.description = description
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], object] = {}
+        self.lock = threading.Lock()
+
+    def samples(self) -> List[Tuple[Tuple[str, ...], float]]:
+        with self.lock:
+            return sorted(self.values.items())
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in self.samples():
+            yield f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}"
+
+    def to_json(self) -> List[dict]:
+        return [{"labels": dict(zip(self.labels, labels)), "value": value} for labels, value in self.samples()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, function: Callable[[], float], *labels: str) -> None:
+        '''
+        Samples the gauge by calling 'function' whenever it is read, e.g. the depth of a queue
+        '''
+        with self.lock:
+            self.values[labels] = function
+
+    def remove(self, *labels: str) -> None:
+        with self.lock:
+            self.values.pop(labels, None)
+
+    def samples(self) -> List[Tuple[Tuple[str, ...], float]]:
+        return [(labels, value() if callable(value) else value) for labels, value in super().samples()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]      # Bucket counts, sum, count
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self) -> List[Tuple[Tuple[str, ...], list]]:
+        with self.lock:
+            return sorted((labels, [list(state[0]), state[1], state[2]]) for labels, state in self.values.items())
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, (counts, total, count) in self.samples():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(self.labels, labels, 'le="' + format_value(bound) + '"')
+                yield f"{self.name}_bucket{bucket_labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {count}"
+
+    def to_json(self) -> List[dict]:
+        return [{
+            "labels": dict(zip(self.labels, labels)),
+            "count": count,
+            "sum": total,
+            "buckets": dict(zip((format_value(bound) for bound in self.buckets + (float("inf"),)), counts)),
+        } for labels, (counts, total, count) in self.samples()]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name: str, description: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name: str, description: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self) -> str:
+        '''
+        Returns every metric in the Prometheus text exposition format
+        '''
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+    def to_json(self) -> Dict[str, dict]:
+        return {name: {"type": metric.kind, "help": metric.description, "samples": metric.to_json()} for name, metric in self.metrics.items()}
+
+
+registry = MetricsRegistry()        # Shared by every service of the process
+
+http_request_seconds = registry.histogram(
+    "http_request_duration_seconds", "Time until the response headers of Twitter API requests", ("endpoint", "status"))
+stream_connections = registry.counter("stream_connections_total", "Stream connections established, reconnects included")
+stream_lag_seconds = registry.histogram(
+    "stream_lag_seconds", "Time between the creation of a streamed tweet and its receipt", buckets=LAG_BUCKETS)
+retries = registry.counter("retries_total", "Retried failures per service and error class", ("service", "error_class"))
+writer_records = registry.counter("writer_records_total", "Records handled by the writers per outcome", ("writer", "outcome"))
+writer_queue_depth = registry.gauge("writer_queue_depth", "Records queued in the writers", ("writer",))
+writer_flush_seconds = registry.histogram("writer_flush_seconds", "Time to write a batch to every sink", ("writer",), WRITE_BUCKETS)
+sink_write_seconds = registry.histogram("sink_write_seconds", "Time to write a batch to each sink", ("sink",), WRITE_BUCKETS)
+log_write_seconds = registry.histogram("log_write_seconds", "Time blocked writing a record to a service log", ("log",), WRITE_BUCKETS)
+
+
+class MeteredRotatingFileHandler(RotatingFileHandler):
+    '''
+    RotatingFileHandler which records the time spent in every write (and rollover) in log_write_seconds
+    '''
+    def emit(self, record: logging.LogRecord) -> None:
+        with log_write_seconds.time(record.name):
+            super().emit(record)
+
+
+class MetricsExporter:
+    def __init__(self, logger: logging.Logger, host: str = "127.0.0.1", port: int = 9108, snapshot_filepath: Optional[str] = None,
+                 snapshot_interval: float = 60, metrics: MetricsRegistry = registry):
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.snapshot_filepath = snapshot_filepath
+        self.snapshot_interval = snapshot_interval
+        self.metrics = metrics
+        self.last_counters: Dict[Tuple[str, Tuple[str, ...]], float] = {}
+        self.last_snapshot = time.monotonic()
+
+    @staticmethod
+    def from_config(config: RawConfigParser, logger: logging.Logger) -> "MetricsExporter":
+        return MetricsExporter(
+            logger,
+            host=config.get("METRICS", "host", fallback="127.0.0.1"),
+            port=config.getint("METRICS", "port", fallback=9108),
+            snapshot_filepath=config.get("FILEPATHS", "metrics_file", fallback="data/metrics.json"),
+            snapshot_interval=config.getfloat("METRICS", "snapshot_interval", fallback=60),
+        )
+
+    async def run(self, coroutine) -> None:
+        '''
+        Exports the metrics while running the (service) coroutine, then writes a final snapshot
+        '''
+        server = None
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            self.logger.error(f"Metrics Server Failed - {e}")      # Collecting matters more than exporting
+        snapshot_task = asyncio.create_task(self.write_snapshots())
+        try:
+            return await coroutine
+        finally:
+            snapshot_task.cancel()
+            await asyncio.gather(snapshot_task, return_exceptions=True)
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+            await asyncio.to_thread(self.write_snapshot)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Answers a single HTTP request: GET /metrics (Prometheus text format) or GET /metrics.json
+        '''
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b"\r\n", b"\n", b""):
+                pass        # The headers are not needed
+            method, path = (request_line.decode("latin1").split() + ["", ""])[:2]
+            path = path.split("?")[0]
+            if method != "GET":
+                status, content_type, body = "405 Method Not Allowed", "text/plain", b"Method Not Allowed\n"
+            elif path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.metrics.render().encode("utf8")
+            elif path == "/metrics.json":
+                status, content_type, body = "200 OK", "application/json", json.dumps(self.snapshot(update_rates=False)).encode("utf8")
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not Found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def snapshot(self, update_rates: bool = True) -> dict:
+        '''
+        Returns every metric, plus the per-second rate of every counter since the previous snapshot
+        '''
+        now = time.monotonic()
+        elapsed = max(now - self.last_snapshot, 1e-9)
+        counters = {}
+        rates = {}
+        for metric in self.metrics.metrics.values():
+            if isinstance(metric, Counter):
+                for labels, value in metric.samples():
+                    key = (metric.name, labels)
+                    counters[key] = value
+                    rate = (value - self.last_counters.get(key, 0)) / elapsed
+                    rates.setdefault(metric.name, []).append({"labels": dict(zip(metric.labels, labels)), "per_second": round(rate, 3)})
+        if update_rates:
+            self.last_counters = counters
+            self.last_snapshot = now
+        return {
+            "generated_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "interval_seconds": round(elapsed, 3),
+            "rates": rates,
+            "metrics": self.metrics.to_json(),
+        }
+
+    def write_snapshot(self) -> None:
+        if self.snapshot_filepath:
+            write_json_atomic(self.snapshot_filepath, self.snapshot())
+
+    async def write_snapshots(self) -> None:
+        while self.snapshot_interval > 0:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await asyncio.to_thread(self.write_snapshot)
+            except OSError as e:
+                self.logger.error(f"Metrics Snapshot Failed - {e}")
@@ -0,0 +1,248 @@
+import os
+import ast
+import heapq
+import queue
+import time
+import asyncio
+import logging
+import multiprocessing
+from typing import Dict, List, Tuple
+
+from .http_client import run_with_client
+from .records import TweetRecord
+from .retry import RetryPolicy
+from .sharding import TOKEN_VARIABLE, create_worker_logger, run_process
+from .storage import open_store
+from .supervisor import Supervisor
+from .twitter_stream import TwitterStream
+from .utils import RawConfigParser
+from .writer import AsyncWriter
+
+'''
+Parallel consumption of the filtered stream over several connections, for rule sets whose volume exceeds what a single
+connection (and a single core framing and decoding it) can keep up with during spikes.
+Stream rules belong to the app of a bearer token, so with STREAMTWEET connections > 1 the (rule, tag) pairs of config.ini are
+partitioned round-robin across as many tokens (Bearer_Token, Bearer_Token_1, ...). Each connection runs in its own worker
+process, which synchronises its rule subset (with its own rule cache and backfill checkpoints in
+FILEPATHS stream_connection_dir/<connection>/), reads, frames and decodes its stream, and sends batches of
+(tweet ID, raw message, received_at) to the main process over a bounded queue.
+
+The main process merges the connections through a reorder buffer: tweets are held for STREAMTWEET reorder_window seconds and
+released in tweet ID order, and a tweet received on several connections (matching rules of different partitions) is merged
+into a single message carrying all of its matching rules. The merged output goes through the usual writer and sinks,
+where the deduplication drops anything released earlier.
+'''
+
+class QueueSink:
+    '''
+    Store of a connection worker: sends every batch to the main process instead of writing it
+    '''
+    def __init__(self, messages: multiprocessing.Queue):
+        self.messages = messages
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        # Decoding the tweet ID here keeps the JSON parsing in the worker process
+        self.messages.put([(record.tweet_id, record.raw, record.received_at) for record in records])
+
+    def close(self) -> None:
+        pass
+
+
+class StreamConnection(TwitterStream):
+    def __init__(self, bearer_token: str, config: RawConfigParser, logger: logging.Logger, messages: multiprocessing.Queue):
+        super().__init__(bearer_token, config, logger)
+        self.messages = messages
+
+    def open_store(self) -> QueueSink:
+        return QueueSink(self.messages)
+
+
+def run_connection(connection: int, bearer_token: str, sections: Dict[str, Dict[str, str]], messages: multiprocessing.Queue,
+                   formatter: logging.Formatter) -> None:
+    '''
+    Entry point of a worker process: runs one stream connection over its rule subset on its own event loop
+    '''
+    config = RawConfigParser()
+    config.read_dict(sections)
+
+    connection_logger = create_worker_logger(
+        os.path.join(os.path.dirname(config["FILEPATHS"]["stream_tweet_log_file"]), "connection.log"), f"{__name__}.connection{connection}", formatter)
+    stream_logger = TwitterStream.create_logger(config, formatter)
+    retry_policy = RetryPolicy.from_config(config)
+
+    supervisor = Supervisor.from_config(config, connection_logger)
+    supervisor.add(f"StreamConnection{connection}", lambda: retry_policy.run(
+        lambda: StreamConnection(bearer_token, config, stream_logger, messages).main(), connection_logger, f"Stream Connection {connection}"))
+    try:
+        asyncio.run(run_with_client(supervisor.run()))
+    finally:
+        messages.put(None)      # Tells the main process that this connection has finished
+        logging.shutdown()
+
+
+class ReorderBuffer:
+    def __init__(self, window: float):
+        self.window = window
+        self.heap: List[Tuple[int, str]] = []               # (numeric tweet ID, tweet ID), smallest ID first
+        self.pending: Dict[str, Tuple[TweetRecord, float]] = {}  # Tweet ID -> (record, arrival time)
+        self.merged = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add(self, tweet_id: str, record: TweetRecord) -> None:
+        '''
+        Buffers a tweet, merging the matching rules of a tweet already buffered from another connection
+        '''
+        if tweet_id not in self.pending:
+            self.pending[tweet_id] = (record, time.monotonic())
+            heapq.heappush(self.heap, (int(tweet_id), tweet_id))
+            return
+
+        buffered, arrived_at = self.pending[tweet_id]
+        try:
+            message = buffered.json
+            matching_rules = message.get("matching_rules", [])
+            known = {(rule.get("id"), rule.get("tag")) for rule in matching_rules}
+            extra = [rule for rule in record.json.get("matching_rules", []) if (rule.get("id"), rule.get("tag")) not in known]
+        except ValueError:
+            return
+        if extra:
+            merged = TweetRecord.from_json({**message, "matching_rules": matching_rules + extra}, received_at=buffered.received_at)
+            self.pending[tweet_id] = (merged, arrived_at)
+        self.merged += 1
+
+    def release(self, force: bool = False) -> List[TweetRecord]:
+        '''
+        Returns the buffered tweets, in ID order, up to the first one received less than 'window' seconds ago (or all if forced)
+        '''
+        released = []
+        cutoff = time.monotonic() - self.window
+        while self.heap:
+            _, tweet_id = self.heap[0]
+            record, arrived_at = self.pending[tweet_id]
+            if not force and arrived_at > cutoff:
+                break
+            heapq.heappop(self.heap)
+            del self.pending[tweet_id]
+            released.append(record)
+        return released
+
+
+class ParallelStream:
+    def __init__(self, bearer_tokens: List[str], config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter):
+        if not bearer_tokens:
+            raise ValueError(f"No bearer token found in environment, expected {TOKEN_VARIABLE} (and optionally {TOKEN_VARIABLE}_1, ...)")
+        self.bearer_tokens = bearer_tokens
+        self.config = config
+        self.logger = logger
+        self.formatter = formatter
+        self.connections = config.getint("STREAMTWEET", "connections", fallback=1)
+        self.connection_dir = config.get("FILEPATHS", "stream_connection_dir", fallback="data/stream_connections")
+        self.store = open_store(config, "stream", raw=config.getboolean("STREAMTWEET", "raw_passthrough", fallback=False))
+        self.writer = AsyncWriter.from_config(self.write_records, config, logger, name="stream")
+        self.buffer = ReorderBuffer(config.getfloat("STREAMTWEET", "reorder_window", fallback=2))
+        self.workers_exited = False
+
+    # Define service coroutine
+    @staticmethod
+    async def create_service(bearer_tokens: List[str], config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter) -> None:
+        '''
+        Creates a service coroutine to consume the stream over STREAMTWEET connections worker processes
+        '''
+        await ParallelStream(bearer_tokens, config, logger, formatter).main()
+
+    def write_records(self, records: List[TweetRecord]) -> None:
+        self.store.write_batch(records)
+        TwitterStream.observe_lag(records)      # Measured from the receipt by the connection, not the merge
+
+    def partition_rules(self, connections: int) -> List[Tuple[List[str], List[str]]]:
+        '''
+        Splits the (rule, tag) pairs of config.ini round-robin into 'connections' lists of rules and tags
+        '''
+        config_rule = ast.literal_eval(self.config["STREAMTWEET"]["rule"])
+        config_tag = ast.literal_eval(self.config["STREAMTWEET"]["tag"])
+        partitions: List[Tuple[List[str], List[str]]] = [([], []) for _ in range(connections)]
+        for index, (rule, tag) in enumerate(zip(config_rule, config_tag)):
+            partitions[index % connections][0].append(rule)
+            partitions[index % connections][1].append(tag)
+        return partitions
+
+    def create_connection_config(self, connection: int, rules: List[str], tags: List[str]) -> Dict[str, Dict[str, str]]:
+        '''
+        Returns the config sections of a connection: its rule subset, and its own state files within its connection directory
+        '''
+        sections = {section: dict(self.config[section]) for section in self.config.sections()}
+        directory = os.path.join(self.connection_dir, str(connection))
+        os.makedirs(directory, exist_ok=True)
+        for option in ("stream_tweet_log_file", "stream_checkpoint_file", "stream_rule_cache_file"):
+            sections["FILEPATHS"][option] = os.path.join(directory, os.path.basename(self.config["FILEPATHS"][option]))
+        sections["STREAMTWEET"].update({"rule": repr(rules), "tag": repr(tags), "connections": "1"})
+        sections.setdefault("STORE", {}).update({"backend": "segments", "parquet_export": "False", "dedup": "False"})
+        sections.setdefault("ANALYTICS", {}).update({"enabled": "False"})       # Counted once, by the main process
+        sections.setdefault("GRAPH", {}).update({"enabled": "False"})
+        sections.setdefault("SEARCH", {}).update({"enabled": "False"})
+        return sections
+
+    async def main(self) -> None:
+        '''
+        Performs the following in sequence:
+        1. Partition the rules across the connections, one bearer token each
+        2. Run every connection in its own worker process, while merging their messages into the writer
+        3. Once every connection has finished (or on cancellation, once they have flushed), release the buffered tweets
+        '''
+        connections = min(self.connections, len(self.bearer_tokens))
+        if connections < self.connections:
+            # Rules belong to the token's app, so two connections on one token would receive the same tweets twice
+            self.logger.warning(f"Stream Tweet: {self.connections} connections requested but only {len(self.bearer_tokens)} bearer tokens found, "
+                                f"using {connections} connections")
+
+        messages = multiprocessing.get_context("spawn").Queue(maxsize=self.config.getint("STREAMTWEET", "connection_queue_size", fallback=1000))
+        partitions = [(connection, rules, tags) for connection, (rules, tags) in enumerate(self.partition_rules(connections)) if rules]
+
+        self.writer.start()
+        merge_task = asyncio.create_task(self.merge(messages, len(partitions)))
+        try:
+            exit_codes = await asyncio.gather(*(
+                run_process(run_connection, f"StreamConnection{connection}",
+                    (connection, self.bearer_tokens[connection], self.create_connection_config(connection, rules, tags), messages, self.formatter))
+                for connection, rules, tags in partitions))
+            for (connection, _, _), exit_code in zip(partitions, exit_codes):
+                if exit_code != 0:
+                    self.logger.error(f"Stream Tweet Failed for connection {connection} - worker exited with code {exit_code}")
+        finally:
+            self.workers_exited = True
+            await merge_task
+            await self.writer.close()
+            self.store.close()
+            self.logger.info(f"Stream Tweet: Merged {self.buffer.merged} tweets received on several connections")
+
+    async def merge(self, messages: multiprocessing.Queue, connections: int) -> None:
+        '''
+        Moves the batches of the connections through the reorder buffer into the writer, until every connection has finished
+        (or every worker has exited) and the queue is drained
+        '''
+        finished = 0
+        while finished < connections:
+            try:
+                batch = await asyncio.to_thread(messages.get, True, min(self.buffer.window, 1) or 0.1)
+            except queue.Empty:
+                if self.workers_exited:
+                    break       # A worker was killed before it could report
+                batch = []
+
+            if batch is None:
+                finished += 1
+                batch = []
+            for tweet_id, raw, received_at in batch:
+                record = TweetRecord(raw, received_at)
+                if tweet_id is None:
+                    await self.writer.put(record)       # Not a tweet (e.g. a stream error), nothing to order
+                else:
+                    self.buffer.add(tweet_id, record)
+
+            for record in self.buffer.release():
+                await self.writer.put(record)
+
+        for record in self.buffer.release(force=True):
+            await self.writer.put(record)
@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:     # Optional dependency, only required for the Parquet export
+    pa = None
+    pq = None
+
+from .records import TweetRecord
+from .utils import parse_log_line, parse_timestamp
+
+'''
+Columnar export of the collected tweets for analytics.
+Each tweet is flattened into typed columns (data, public_metrics, entities and matching_rules) and written as
+zstd-compressed Parquet files, partitioned Hive-style by date and rule tag:
+    <parquet_dir>/date=YYYY-MM-DD/tag=<tag>/part-<timestamp>-<sequence>.parquet
+so that analytical scans only read the partitions and columns they need, e.g. with
+    pyarrow.dataset.dataset("data/parquet", partitioning="hive").to_table(columns=["created_at", "hashtags"])
+A tweet matching several rules appears once per tag. Tweets without matching rules (user tweets) go under tag=untagged.
+
+Can be used as a streaming sink (STORE parquet_export) or as a converter of existing logs and segments. As a sink, rows are
+buffered until STORE parquet_max_rows, so it is a best-effort export of the segments or database (rows buffered when the
+process is killed are lost, and can be recovered by converting the segments):
+    python -m src.parquet_export data/prev_data/twitter_stream_data.log* data/stream_tweets/*.jsonl --out data/parquet
+Requires pyarrow (pip install -r requirements-optional.txt).
+'''
+
+UNTAGGED = "untagged"
+
+
+def require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError("The Parquet export requires pyarrow, install it with: pip install -r requirements-optional.txt")
+
+
+def tweet_schema() -> "pa.Schema":
+    require_pyarrow()
+    return pa.schema([
+        ("id", pa.int64()),
+        ("author_id", pa.string()),
+        ("conversation_id", pa.string()),
+        ("in_reply_to_user_id", pa.string()),
+        ("created_at", pa.timestamp("ms", tz="UTC")),
+        ("received_at", pa.timestamp("ms", tz="UTC")),
+        ("lang", pa.string()),
+        ("source", pa.string()),
+        ("possibly_sensitive", pa.bool_()),
+        ("text", pa.string()),
+        ("retweet_count", pa.int64()),
+        ("reply_count", pa.int64()),
+        ("like_count", pa.int64()),
+        ("quote_count", pa.int64()),
+        ("hashtags", pa.list_(pa.string())),
+        ("mentions", pa.list_(pa.string())),
+        ("urls", pa.list_(pa.string())),
+        ("referenced_tweet_types", pa.list_(pa.string())),
+        ("referenced_tweet_ids", pa.list_(pa.string())),
+        ("rule_id", pa.string()),
+    ])
+
+
+def flatten_tweet(message: dict, received_at: Optional[float] = None) -> List[Tuple[str, str, dict]]:
+    '''
+    Flattens a {"data": tweet, "matching_rules": [...]} message into (date, tag, row) tuples, one per matching rule.
+    Returns an empty list for messages which are not tweets (e.g. stream errors).
+    '''
+    tweet = message.get("data")
+    if not isinstance(tweet, dict) or "id" not in tweet:
+        return []
+
+    received = datetime.fromtimestamp(received_at, timezone.utc) if received_at is not None else None
+    created = parse_timestamp(tweet.get("created_at")) or received
+    metrics = tweet.get("public_metrics", {})
+    entities = tweet.get("entities", {})
+    references = tweet.get("referenced_tweets", [])
+
+    row = {
+        "id": int(tweet["id"]),
+        "author_id": tweet.get("author_id"),
+        "conversation_id": tweet.get("conversation_id"),
+        "in_reply_to_user_id": tweet.get("in_reply_to_user_id"),
+        "created_at": created,
+        "received_at": received,
+        "lang": tweet.get("lang"),
+        "source": tweet.get("source"),
+        "possibly_sensitive": tweet.get("possibly_sensitive"),
+        "text": tweet.get("text"),
+        "retweet_count": metrics.get("retweet_count"),
+        "reply_count": metrics.get("reply_count"),
+        "like_count": metrics.get("like_count"),
+        "quote_count": metrics.get("quote_count"),
+        "hashtags": [hashtag["tag"] for hashtag in entities.get("hashtags", [])],
+        "mentions": [mention["username"] for mention in entities.get("mentions", [])],
+        "urls": [url.get("expanded_url") or url.get("url") for url in entities.get("urls", [])],
+        "referenced_tweet_types": [reference["type"] for reference in references],
+        "referenced_tweet_ids": [reference["id"] for reference in references],
+        "rule_id": None,
+    }
+    date = created.strftime("%Y-%m-%d") if created is not None else "unknown"
+
+    rules = message.get("matching_rules") or [{}]
+    return [(date, rule.get("tag") or UNTAGGED, {**row, "rule_id": rule.get("id")}) for rule in rules]
+
+
+class ParquetSink:
+    def __init__(self, directory: str, max_rows: int = 50000, compression: str = "zstd"):
+        require_pyarrow()
+        self.directory = directory
+        self.max_rows = max_rows
+        self.compression = compression
+        self.schema = tweet_schema()
+        self.lock = threading.Lock()        # Batches may be written from different worker threads
+        self.partitions: Dict[Tuple[str, str], List[dict]] = {}
+        self.pending_rows = 0
+        self.sequence = 0
+
+    def add(self, message: dict, received_at: Optional[float] = None) -> None:
+        for date, tag, row in flatten_tweet(message, received_at):
+            self.partitions.setdefault((date, tag), []).append(row)
+            self.pending_rows += 1
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        with self.lock:
+            for record in records:
+                try:
+                    self.add(record.json, record.received_at)
+                except ValueError:
+                    continue
+            if self.pending_rows >= self.max_rows:
+                self.flush()
+
+    def flush(self) -> None:
+        '''
+        Writes one file per buffered partition. Files are immutable, so every flush adds new parts.
+        '''
+        for (date, tag), rows in self.partitions.items():
+            directory = os.path.join(self.directory, f"date={date}", f"tag={quote(tag, safe='')}")
+            os.makedirs(directory, exist_ok=True)
+            filepath = os.path.join(directory, f"part-{int(time.time() * 1000)}-{self.sequence:06d}.parquet")
+            self.sequence += 1
+            pq.write_table(pa.Table.from_pylist(rows, schema=self.schema), filepath, compression=self.compression)
+        self.partitions = {}
+        self.pending_rows = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.flush()
+
+
+def read_messages(filepath: str) -> Iterator[Tuple[dict, Optional[float]]]:
+    '''
+    Yields (message, received_at) from a legacy log file ('[asctime]: INFO:{json}' lines) or a JSONL segment.
+    Control records (e.g. "Get Rules: ...") and undecodable lines are skipped.
+    '''
+    with open(filepath, encoding="utf8") as f:
+        for line in f:
+            received_at = None
+            parsed = parse_log_line(line)
+            if parsed is not None:
+                asctime, _, line = parsed
+                received_at = datetime.strptime(asctime, "%Y-%m-%d %H:%M:%S,%f").timestamp()
+            if not line.startswith("{"):
+                continue
+            try:
+                yield json.loads(line), received_at
+            except ValueError:
+                continue
+
+
+def convert(filepaths: Iterable[str], directory: str, max_rows: int = 50000) -> int:
+    '''
+    Converts log files and JSONL segments into the partitioned Parquet dataset, returning the number of tweets exported
+    '''
+    sink = ParquetSink(directory, max_rows=max_rows)
+    count = 0
+    for filepath in filepaths:
+        for message, received_at in read_messages(filepath):
+            if "data" in message:
+                count += 1
+            sink.add(message, received_at)
+            if sink.pending_rows >= sink.max_rows:
+                sink.flush()
+    sink.close()
+    return count
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(prog="parquet_export", description="Convert collected tweets into a partitioned Parquet dataset")
+    arg_parser.add_argument("files", nargs="+", help="Log files and/or JSONL segments to convert")
+    arg_parser.add_argument("--out", default="data/parquet", help="Output directory of the dataset")
+    args = arg_parser.parse_args()
+
+    try:
+        print(f"Exported {convert(args.files, args.out)} tweets to {args.out}")
+    except ImportError as e:
+        sys.exit(str(e))
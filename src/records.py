@@ -0,0 +1,50 @@
+import json
+import time
+from typing import Optional
+
+'''
+A tweet (or any stream message) as received from the API.
+The raw bytes are kept as the source of truth and written to the sinks untouched; decoding into a dict and
+canonicalising (sorted keys) only happen lazily, the first time a consumer actually needs the fields.
+'''
+
+
+class TweetRecord:
+    __slots__ = ("raw", "received_at", "_json")
+
+    def __init__(self, raw: bytes, received_at: Optional[float] = None):
+        self.raw = raw
+        self.received_at = time.time() if received_at is None else received_at
+        self._json = None
+
+    @classmethod
+    def from_json(cls, data: dict, received_at: Optional[float] = None) -> "TweetRecord":
+        record = cls(json.dumps(data, sort_keys=True).encode("utf8"), received_at)
+        record._json = data
+        return record
+
+    @property
+    def json(self) -> dict:
+        if self._json is None:
+            self._json = json.loads(self.raw)
+        return self._json
+
+    @property
+    def tweet_id(self) -> Optional[str]:
+        '''
+        Returns the ID of the tweet, or None if the message is not a tweet (e.g. a stream error) or cannot be decoded
+        '''
+        try:
+            tweet = self.json.get("data")
+        except ValueError:
+            return None
+        return tweet.get("id") if isinstance(tweet, dict) else None
+
+    def canonical(self) -> str:
+        '''
+        Returns the message re-serialised with sorted keys, as previously written to the logs
+        '''
+        return json.dumps(self.json, sort_keys=True)
+
+    def text(self) -> str:
+        return self.raw.decode("utf8")
@@ -0,0 +1,150 @@
+import re
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from typing import Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from .utils import RawConfigParser
+from .metrics import retries
+
+'''
+Shared retry, backoff and rate-limit handling for all services.
+- Retries back off exponentially with jitter, with separate schedules per error class
+  (network errors, HTTP 420/429 rate limiting and HTTP 5xx errors).
+  Other HTTP 4xx errors, such as 400, 401 or 403, are permanent and raised
+- Rate-limit budgets are tracked per token and endpoint from the x-rate-limit-* response headers. Once an endpoint's budget
+  is exhausted, further requests to it wait asynchronously until the reset time, so a throttled service never blocks the
+  thread or the event loop used by the other services.
+'''
+
+RATE_LIMIT_STATUS_CODES = (420, 429)
+ID_SEGMENT_PATTERN = re.compile(r"/\d{4,}(?=/|$)")     # User and tweet IDs, not the API version
+
+
+class RateLimits:
+    def __init__(self):
+        self.budgets: Dict[str, dict] = {}      # Endpoint key -> {"limit", "remaining", "reset"}
+
+    @staticmethod
+    def endpoint_key(request: httpx.Request) -> str:
+        '''
+        Identifies the budget of a request: rate limits apply per token and per endpoint, with IDs in the path collapsed
+        '''
+        token = hashlib.sha1(request.headers.get("Authorization", "").encode("utf8")).hexdigest()[:8]
+        return f"{token} {request.method} {ID_SEGMENT_PATTERN.sub('/:id', request.url.path)}"
+
+    def seconds_until_available(self, key: str) -> float:
+        budget = self.budgets.get(key)
+        if budget is None or budget["remaining"] > 0:
+            return 0
+        return max(0.0, budget["reset"] - time.time())
+
+    async def wait(self, request: httpx.Request) -> None:
+        '''
+        Request hook: waits (asynchronously) until the endpoint's budget resets if it is exhausted
+        '''
+        key = self.endpoint_key(request)
+        delay = self.seconds_until_available(key)
+        if delay > 0:
+            logging.getLogger(__name__).warning(f"Rate limit of {key} exhausted, waiting {delay:.0f} seconds until reset")
+            await asyncio.sleep(delay)
+            self.budgets.pop(key, None)
+
+    async def update(self, response: httpx.Response) -> None:
+        '''
+        Response hook: records the endpoint's budget from the x-rate-limit-* headers
+        '''
+        headers = response.headers
+        if "x-rate-limit-reset" not in headers:
+            return
+        remaining = int(headers.get("x-rate-limit-remaining", 1))
+        if response.status_code in RATE_LIMIT_STATUS_CODES:
+            remaining = 0
+        self.budgets[self.endpoint_key(response.request)] = {
+            "limit": int(headers.get("x-rate-limit-limit", 0)),
+            "remaining": remaining,
+            "reset": int(headers["x-rate-limit-reset"]),
+        }
+
+
+rate_limits = RateLimits()      # Shared by every client of the process
+
+
+class Backoff:
+    def __init__(self, initial: float, maximum: float, factor: float = 2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+
+    def delay(self, attempt: int) -> float:
+        '''
+        Exponential delay for the given attempt (starting at 0), with "equal jitter": between half and all of the delay
+        '''
+        delay = min(self.maximum, self.initial * self.factor ** attempt)
+        return delay * random.uniform(0.5, 1)
+
+
+class RetryPolicy:
+    def __init__(self, network: Backoff, http: Backoff, rate_limit: Backoff, reset_after: float = 60):
+        self.backoffs = {"network": network, "http": http, "rate_limit": rate_limit}
+        self.reset_after = reset_after
+
+    @staticmethod
+    def from_config(config: RawConfigParser) -> "RetryPolicy":
+        return RetryPolicy(
+            network=Backoff(config.getfloat("RETRY", "network_initial", fallback=1), config.getfloat("RETRY", "network_max", fallback=16)),
+            http=Backoff(config.getfloat("RETRY", "http_initial", fallback=5), config.getfloat("RETRY", "http_max", fallback=320)),
+            rate_limit=Backoff(config.getfloat("RETRY", "rate_limit_initial", fallback=60), config.getfloat("RETRY", "rate_limit_max", fallback=900)),
+            reset_after=config.getfloat("RETRY", "reset_after", fallback=60),
+        )
+
+    @staticmethod
+    def classify(error: Exception) -> Optional[str]:
+        '''
+        Returns the error class of a retryable error, or None if the error should not be retried
+        '''
+        if isinstance(error, httpx.RequestError):
+            return "network"
+        if isinstance(error, httpx.HTTPStatusError):
+            if error.response.status_code in RATE_LIMIT_STATUS_CODES:
+                return "rate_limit"
+            if error.response.status_code >= 500:
+                return "http"
+        return None     # Other errors, including the remaining 4xx (bad request, unauthorized, ...), are permanent
+
+    def delay(self, error: Exception, attempt: int) -> float:
+        error_class = self.classify(error)
+        delay = self.backoffs[error_class].delay(attempt)
+        if error_class == "rate_limit" and "x-rate-limit-reset" in error.response.headers:
+            # Never retry before the reset time, plus a little jitter so that services do not retry in lockstep
+            delay = max(delay, int(error.response.headers["x-rate-limit-reset"]) - time.time() + random.uniform(1, 5))
+        return delay
+
+    async def run(self, factory: Callable[[], Awaitable], logger: logging.Logger, name: str):
+        '''
+        Runs the coroutine created by 'factory' until it completes, retrying retryable errors after a backoff.
+        The attempt count (hence the backoff) resets once an attempt ran longer than RETRY reset_after seconds,
+        e.g. a stream which was connected for a while before disconnecting.
+        Non-retryable errors are raised.
+        '''
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                return await factory()
+            except Exception as e:
+                error_class = self.classify(e)
+                if error_class is None:
+                    raise
+                retries.inc(name, error_class)
+                if time.monotonic() - started > self.reset_after:
+                    attempt = 0
+                delay = self.delay(e, attempt)
+                attempt += 1
+                logger.error(f"{name} Failed - {e}")
+                logger.error(f"Retrying {name} in {delay:.1f} seconds ...")
+                await asyncio.sleep(delay)
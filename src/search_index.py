@@ -0,0 +1,507 @@
+import os
+import re
+import sys
+import mmap
+import heapq
+import struct
+import argparse
+import threading
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .log_reader import fingerprint
+from .records import TweetRecord
+from .utils import parse_timestamp, read_json, write_json_atomic
+
+'''
+Full-text inverted index over the text of the collected tweets, updated incrementally as records are written.
+- Tokenisation keeps hashtags (#oneteam), mentions (@user) and URLs as single tokens, and lowercases words
+- Each term's postings hold the doc numbers (delta-encoded), term frequencies and positions (delta-encoded),
+  all as varints, in three separate blocks so that boolean queries never decode the positions
+- New tweets are buffered in memory and written as an immutable segment every SEARCH segment_max_docs tweets (and on close).
+  Once there are more than SEARCH max_segments segments, the smallest are merged term by term, never requiring a full reindex.
+  The manifest (index.json) lists the live segments, and is replaced atomically after every flush or merge.
+- Segments are memory-mapped and terms are found by binary search, so a query only reads the postings of its terms
+
+Queries support AND (implicit), OR, NOT (or -term), parentheses and "quoted phrases", filtered by created_at:
+
+    python -m src.search_index search '#oneteam AND ("love where" OR @twitter) -hiring' --since 2022-11-01 --until 2022-12-01
+    python -m src.search_index add data/stream_tweets/*.jsonl data/prev_data/twitter_stream_data.log*
+'''
+
+TOKEN_PATTERN = re.compile(r"https?://\S+|[#@]\w+|\w+", re.UNICODE)
+URL_TRAILING = ".,;:!?)]}'\""
+QUERY_PATTERN = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+MAGIC = b"TWIX\x01"
+HEADER = struct.Struct("<5sQQ")
+SECTIONS = (("tweet_ids", "Q"), ("timestamps", "q"), ("term_starts", "Q"), ("doc_freqs", "I"),
+            ("doc_starts", "Q"), ("freq_starts", "Q"), ("position_starts", "Q"))
+
+Posting = Tuple[int, List[int]]     # (doc number, positions)
+
+
+def tokenize(text: str) -> List[str]:
+    # URLs keep their case (paths are case-sensitive), less any trailing punctuation
+    return [token.rstrip(URL_TRAILING) if token.startswith("http") else token.lower() for token in TOKEN_PATTERN.findall(text)]
+
+
+def encode_varints(values: Iterable[int], output: bytearray) -> None:
+    values = list(values)
+    if not values or max(values) < 0x80:
+        output += bytes(values)     # Fast path: every value fits in a single byte
+        return
+    for value in values:
+        while value >= 0x80:
+            output.append(value & 0x7F | 0x80)
+            value >>= 7
+        output.append(value)
+
+
+def decode_varints(data, start: int, end: int) -> List[int]:
+    chunk = data[start:end]
+    if not chunk or max(chunk) < 0x80:
+        return list(chunk)      # Fast path: every value fits in a single byte
+    values = []
+    value = shift = 0
+    for byte in chunk:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def to_little_endian(values: array) -> bytes:
+    values = array(values.typecode, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_segment(filepath: str, tweet_ids: array, timestamps: array, terms: Iterator[Tuple[bytes, List[Posting]]]) -> None:
+    '''
+    Writes an immutable segment from its docs and its (term, postings) sorted by term
+    '''
+    arrays = {name: array(typecode) for name, typecode in SECTIONS}
+    arrays["tweet_ids"], arrays["timestamps"] = tweet_ids, timestamps
+    blob = bytearray()
+    postings_blob = bytearray()
+
+    for term, postings in terms:
+        arrays["term_starts"].append(len(blob))
+        blob += term
+        arrays["doc_freqs"].append(len(postings))
+        doc_deltas, freqs, position_deltas = [], [], []
+        previous_doc = 0
+        for doc, positions in postings:
+            doc_deltas.append(doc - previous_doc)
+            previous_doc = doc
+            freqs.append(len(positions))
+            previous_position = 0
+            for position in positions:
+                position_deltas.append(position - previous_position)
+                previous_position = position
+        arrays["doc_starts"].append(len(postings_blob))
+        encode_varints(doc_deltas, postings_blob)
+        arrays["freq_starts"].append(len(postings_blob))
+        encode_varints(freqs, postings_blob)
+        arrays["position_starts"].append(len(postings_blob))
+        encode_varints(position_deltas, postings_blob)
+    arrays["term_starts"].append(len(blob))
+    arrays["doc_starts"].append(len(postings_blob))
+
+    temp_filepath = f"{filepath}.tmp"
+    with open(temp_filepath, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(tweet_ids), len(arrays["doc_freqs"])))
+        for name, _ in SECTIONS:
+            data = to_little_endian(arrays[name])
+            f.write(struct.pack("<Q", len(data)))
+            f.write(data)
+        for data in (blob, postings_blob):
+            f.write(struct.pack("<Q", len(data)))
+            f.write(data)
+    os.replace(temp_filepath, filepath)
+
+
+class MemorySegment:
+    '''
+    The tweets indexed since the last flush, searchable like a segment
+    '''
+    def __init__(self):
+        self.tweet_ids = array("Q")
+        self.timestamps = array("q")
+        self.postings: Dict[bytes, List[Posting]] = {}
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.tweet_ids)
+
+    def add(self, tweet_id: int, timestamp: int, text: str) -> None:
+        doc = len(self.tweet_ids)
+        self.tweet_ids.append(tweet_id)
+        self.timestamps.append(timestamp)
+        positions: Dict[str, List[int]] = {}
+        for position, token in enumerate(tokenize(text)):
+            positions.setdefault(token, []).append(position)
+        for token, token_positions in positions.items():
+            self.postings.setdefault(token.encode("utf8"), []).append((doc, token_positions))
+
+    def docs(self, term: bytes) -> List[int]:
+        return [doc for doc, _ in self.postings.get(term, [])]
+
+    def positions(self, term: bytes) -> Dict[int, List[int]]:
+        return dict(self.postings.get(term, []))
+
+    def iter_terms(self) -> Iterator[Tuple[bytes, List[Posting]]]:
+        for term in sorted(self.postings):
+            yield term, self.postings[term]
+
+
+class DiskSegment:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.file = open(filepath, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.doc_count, self.term_count = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filepath} is not a search index segment")
+
+        offset = HEADER.size
+        for name, typecode in SECTIONS:
+            length, = struct.unpack_from("<Q", self.data, offset)
+            values = array(typecode)
+            values.frombytes(self.data[offset + 8:offset + 8 + length])
+            if sys.byteorder == "big":
+                values.byteswap()
+            setattr(self, name, values)
+            offset += 8 + length
+        length, = struct.unpack_from("<Q", self.data, offset)
+        self.blob_offset = offset + 8
+        self.postings_offset = self.blob_offset + length + 8
+
+    def close(self) -> None:
+        self.data.close()
+        self.file.close()
+
+    def term_at(self, index: int) -> bytes:
+        return self.data[self.blob_offset + self.term_starts[index]:self.blob_offset + self.term_starts[index + 1]]
+
+    def find(self, term: bytes) -> Optional[int]:
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.term_at(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < self.term_count and self.term_at(low) == term else None
+
+    def docs_of(self, index: int) -> List[int]:
+        deltas = decode_varints(self.data, self.postings_offset + self.doc_starts[index], self.postings_offset + self.freq_starts[index])
+        docs = []
+        doc = 0
+        for delta in deltas:
+            doc += delta
+            docs.append(doc)
+        return docs
+
+    def docs(self, term: bytes) -> List[int]:
+        index = self.find(term)
+        return self.docs_of(index) if index is not None else []
+
+    def postings_of(self, index: int) -> List[Posting]:
+        docs = self.docs_of(index)
+        freqs = decode_varints(self.data, self.postings_offset + self.freq_starts[index], self.postings_offset + self.position_starts[index])
+        deltas = decode_varints(self.data, self.postings_offset + self.position_starts[index], self.postings_offset + self.doc_starts[index + 1])
+        postings = []
+        cursor = 0
+        for doc, freq in zip(docs, freqs):
+            positions = []
+            position = 0
+            for delta in deltas[cursor:cursor + freq]:
+                position += delta
+                positions.append(position)
+            cursor += freq
+            postings.append((doc, positions))
+        return postings
+
+    def positions(self, term: bytes) -> Dict[int, List[int]]:
+        index = self.find(term)
+        return dict(self.postings_of(index)) if index is not None else {}
+
+    def iter_terms(self, doc_offset: int = 0) -> Iterator[Tuple[bytes, List[Posting]]]:
+        for index in range(self.term_count):
+            yield self.term_at(index), [(doc + doc_offset, positions) for doc, positions in self.postings_of(index)]
+
+
+def parse_query(query: str) -> tuple:
+    '''
+    Parses a query into a tree of ("term", token), ("phrase", tokens), ("not", node), ("and", nodes) and ("or", nodes)
+    '''
+    tokens = QUERY_PATTERN.findall(query)
+    position = 0
+
+    def peek() -> Optional[str]:
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_or() -> tuple:
+        nonlocal position
+        nodes = [parse_and()]
+        while peek() == "OR":
+            position += 1
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def parse_and() -> tuple:
+        nonlocal position
+        nodes = [parse_unary()]
+        while peek() not in (None, ")", "OR"):
+            if peek() == "AND":
+                position += 1
+            nodes.append(parse_unary())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def parse_unary() -> tuple:
+        nonlocal position
+        token = peek()
+        if token is None:
+            raise ValueError(f"Unexpected end of query: {query}")
+        position += 1
+        if token == "NOT":
+            return ("not", parse_unary())
+        if token == "(":
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError(f"Missing closing parenthesis in query: {query}")
+            position += 1
+            return node
+        if token == "-":
+            return ("not", parse_unary())
+        if token.startswith("-"):
+            tokens.insert(position, token[1:])
+            return ("not", parse_unary())
+        words = tokenize(token.strip('"'))
+        if not words:
+            raise ValueError(f"Nothing to search for in {token}")
+        return ("term", words[0]) if len(words) == 1 else ("phrase", words)
+
+    node = parse_or()
+    if peek() is not None:
+        raise ValueError(f"Unexpected {peek()} in query: {query}")
+    return node
+
+
+def evaluate(node: tuple, segment) -> Set[int]:
+    kind = node[0]
+    if kind == "term":
+        return set(segment.docs(node[1].encode("utf8")))
+    if kind == "phrase":
+        postings = [segment.positions(word.encode("utf8")) for word in node[1]]
+        matches = set()
+        for doc in set(postings[0]).intersection(*postings[1:]):
+            # Shift every word's positions back by its offset in the phrase: a common position is a match
+            starts = set(postings[0][doc])
+            for offset in range(1, len(postings)):
+                starts &= {position - offset for position in postings[offset][doc]}
+            if starts:
+                matches.add(doc)
+        return matches
+    if kind == "not":
+        return set(range(segment.doc_count)) - evaluate(node[1], segment)
+    results = [evaluate(child, segment) for child in node[1]]
+    return set.intersection(*results) if kind == "and" else set.union(*results)
+
+
+class SearchIndex:
+    _indexes: Dict[str, "SearchIndex"] = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, directory: str, segment_max_docs: int = 50000, max_segments: int = 16):
+        self.directory = directory
+        self.segment_max_docs = segment_max_docs
+        self.max_segments = max_segments
+        self.lock = threading.RLock()       # Batches may be written from different worker threads
+        self.manifest = read_json(self.manifest_filepath, default={"segments": [], "next_segment": 0, "files": {}})
+        self.segments: Dict[str, DiskSegment] = {}
+        self.buffer = MemorySegment()
+
+    @classmethod
+    def shared(cls, directory: str, segment_max_docs: int = 50000, max_segments: int = 16) -> "SearchIndex":
+        '''
+        Returns the index of 'directory' shared by every sink of the process, so that services never overwrite each other
+        '''
+        with cls._indexes_lock:
+            if directory not in cls._indexes:
+                cls._indexes[directory] = SearchIndex(directory, segment_max_docs, max_segments)
+            return cls._indexes[directory]
+
+    @staticmethod
+    def from_config(config) -> "SearchIndex":
+        return SearchIndex.shared(
+            config["FILEPATHS"]["search_index_dir"],
+            segment_max_docs=config.getint("SEARCH", "segment_max_docs", fallback=50000),
+            max_segments=config.getint("SEARCH", "max_segments", fallback=16),
+        )
+
+    @property
+    def manifest_filepath(self) -> str:
+        return os.path.join(self.directory, "index.json")
+
+    def segment(self, name: str) -> DiskSegment:
+        if name not in self.segments:
+            self.segments[name] = DiskSegment(os.path.join(self.directory, name))
+        return self.segments[name]
+
+    def refresh(self) -> None:
+        '''
+        Rereads the manifest, picking up the segments written by another process
+        '''
+        with self.lock:
+            self.manifest = read_json(self.manifest_filepath, default=self.manifest)
+            for name in set(self.segments) - set(self.manifest["segments"]):
+                self.segments.pop(name).close()
+
+    def add(self, message: dict, received_at: Optional[float] = None) -> None:
+        tweet = message.get("data")
+        if not isinstance(tweet, dict) or "id" not in tweet or not tweet.get("text"):
+            return
+        try:
+            created_at = parse_timestamp(tweet.get("created_at"))
+        except ValueError:
+            created_at = None
+        timestamp = created_at.timestamp() if created_at is not None else received_at or 0
+        with self.lock:
+            self.buffer.add(int(tweet["id"]), int(timestamp), tweet["text"])
+            if self.buffer.doc_count >= self.segment_max_docs:
+                self.flush()
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        with self.lock:
+            for record in records:
+                try:
+                    self.add(record.json, record.received_at)
+                except ValueError:
+                    continue
+
+    def new_segment_name(self) -> str:
+        name = f"segment-{self.manifest['next_segment']:06d}.idx"
+        self.manifest["next_segment"] += 1
+        return name
+
+    def commit(self, added: List[str], removed: List[str]) -> None:
+        self.manifest["segments"] = [name for name in self.manifest["segments"] if name not in removed] + added
+        write_json_atomic(self.manifest_filepath, self.manifest)
+        for name in removed:
+            if name in self.segments:
+                self.segments.pop(name).close()
+            os.remove(os.path.join(self.directory, name))
+
+    def flush(self) -> None:
+        '''
+        Writes the buffered tweets as a new segment, merging the smallest segments if there are too many
+        '''
+        with self.lock:
+            if self.buffer.doc_count == 0:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            name = self.new_segment_name()
+            write_segment(os.path.join(self.directory, name), self.buffer.tweet_ids, self.buffer.timestamps, self.buffer.iter_terms())
+            self.buffer = MemorySegment()
+            self.commit([name], [])
+            if len(self.manifest["segments"]) > self.max_segments:
+                self.merge(sorted(self.manifest["segments"], key=lambda name: self.segment(name).doc_count)[:len(self.manifest["segments"]) // 2 + 1])
+
+    def merge(self, names: List[str]) -> None:
+        '''
+        Merges segments into one: their docs are concatenated, and their sorted term lists merged term by term
+        '''
+        with self.lock:
+            if len(names) < 2:
+                return
+            segments = [self.segment(name) for name in names]
+            tweet_ids = array("Q")
+            timestamps = array("q")
+            iterators = []
+            for segment in segments:
+                iterators.append(segment.iter_terms(doc_offset=len(tweet_ids)))
+                tweet_ids.extend(segment.tweet_ids)
+                timestamps.extend(segment.timestamps)
+
+            def merged_terms() -> Iterator[Tuple[bytes, List[Posting]]]:
+                current, postings = None, []
+                for term, term_postings in heapq.merge(*iterators, key=lambda item: item[0]):
+                    if term != current and current is not None:
+                        yield current, postings
+                        postings = []
+                    current = term
+                    postings.extend(term_postings)      # Segments are merged in doc order, so the postings stay sorted
+                if current is not None:
+                    yield current, postings
+
+            name = self.new_segment_name()
+            write_segment(os.path.join(self.directory, name), tweet_ids, timestamps, merged_terms())
+            self.commit([name], names)
+
+    def search(self, query: str, since: Optional[float] = None, until: Optional[float] = None, before: Optional[int] = None,
+               limit: Optional[int] = 100) -> List[str]:
+        '''
+        Returns the IDs of the tweets matching the query and created within [since, until), newest first.
+        With 'before' (a tweet ID), only the older tweets are returned, which pages through the results.
+        '''
+        node = parse_query(query)
+        with self.lock:
+            segments = [self.segment(name) for name in self.manifest["segments"]] + [self.buffer]
+            tweet_ids = set()
+            for segment in segments:
+                for doc in evaluate(node, segment):
+                    timestamp = segment.timestamps[doc]
+                    if (since is None or timestamp >= since) and (until is None or timestamp < until):
+                        tweet_ids.add(segment.tweet_ids[doc])
+            if before is not None:
+                tweet_ids = {tweet_id for tweet_id in tweet_ids if tweet_id < before}
+        return [str(tweet_id) for tweet_id in sorted(tweet_ids, reverse=True)[:limit]]
+
+    def close(self) -> None:
+        self.flush()
+
+
+def parse_date(value: str) -> float:
+    return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+
+if __name__ == "__main__":
+    from .parquet_export import read_messages
+
+    arg_parser = argparse.ArgumentParser(prog="search_index", description="Search the text of the collected tweets")
+    arg_parser.add_argument("--dir", default="data/search_index", help="Directory of the index")
+    subparsers = arg_parser.add_subparsers(dest="subcommand", required=True)
+    search_parser = subparsers.add_parser("search", help="Print the IDs of the matching tweets, newest first")
+    search_parser.add_argument("query")
+    search_parser.add_argument("--since", type=parse_date, default=None, help="Created on or after this date (YYYY-MM-DD)")
+    search_parser.add_argument("--until", type=parse_date, default=None, help="Created before this date (YYYY-MM-DD)")
+    search_parser.add_argument("--limit", type=int, default=100)
+    add_parser = subparsers.add_parser("add", help="Index existing log files and JSONL segments (files already indexed are skipped)")
+    add_parser.add_argument("files", nargs="+")
+    subparsers.add_parser("optimize", help="Merge every segment into one")
+    args = arg_parser.parse_args()
+
+    index = SearchIndex(args.dir)
+    if args.subcommand == "search":
+        for tweet_id in index.search(args.query, since=args.since, until=args.until, limit=args.limit):
+            print(tweet_id)
+    elif args.subcommand == "add":
+        for filepath in args.files:
+            key = f"{fingerprint(filepath)}:{os.path.getsize(filepath)}"
+            if key in index.manifest["files"].values():
+                continue
+            for message, received_at in read_messages(filepath):
+                index.add(message, received_at)
+            index.flush()
+            index.manifest["files"][filepath] = key
+            write_json_atomic(index.manifest_filepath, index.manifest)
+        print(f"{len(index.manifest['segments'])} segments")
+    else:
+        index.merge(list(index.manifest["segments"]))
@@ -0,0 +1,230 @@
+import os
+import ast
+import zlib
+import shutil
+import asyncio
+import logging
+import multiprocessing
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Dict, List, Mapping, Optional
+
+from .checkpoints import Checkpoints
+from .http_client import run_with_client
+from .records import TweetRecord
+from .storage import open_store
+from .supervisor import Supervisor
+from .tweet_store import SegmentStore
+from .twitter_user import TwitterUser
+from .user_cache import UserCache
+from .utils import RawConfigParser
+
+'''
+Sharded execution mode of the user tweet service, for username lists too large for a single process and a single token.
+With USERTWEET shards > 1, the usernames are partitioned across worker processes by a stable hash (so that every username
+keeps its shard, and its shard state, between runs). Each worker runs its own TwitterUser service with its own bearer token
+and therefore its own rate-limit budget, taken from the environment as Bearer_Token, Bearer_Token_1, Bearer_Token_2, ...
+
+Every shard keeps its state (log, user cache, checkpoints and JSONL segments) in FILEPATHS shard_dir/<shard>/.
+The caches and checkpoints are seeded from the main ones before the workers start, and once all workers have exited,
+the shard segments are merged into the main user store (through the deduplication and every configured sink) and the
+shard caches and checkpoints are merged back into the main ones.
+'''
+
+TOKEN_VARIABLE = "Bearer_Token"
+TERMINATE_TIMEOUT = 30      # Seconds given to a worker to flush its writes once terminated, before it is killed
+
+
+def get_bearer_tokens(environ: Mapping[str, str] = os.environ) -> List[str]:
+    '''
+    Returns Bearer_Token followed by Bearer_Token_1, Bearer_Token_2, ... up to the first missing one
+    '''
+    tokens = [environ[TOKEN_VARIABLE]] if TOKEN_VARIABLE in environ else []
+    while f"{TOKEN_VARIABLE}_{len(tokens)}" in environ:
+        tokens.append(environ[f"{TOKEN_VARIABLE}_{len(tokens)}"])
+    return tokens
+
+
+def shard_of(username: str, shards: int) -> int:
+    # crc32 rather than hash(), which is randomised per process
+    return zlib.crc32(username.lower().encode("utf8")) % shards
+
+
+async def run_process(target: Callable, name: str, args: tuple) -> Optional[int]:
+    '''
+    Runs 'target' in a worker process until it exits, returning its exit code.
+    On cancellation, the worker is terminated (which lets it flush its writes) and, failing that, killed.
+    '''
+    # Spawned rather than forked, as forking the running event loop (and its open connections) is unsafe
+    process = multiprocessing.get_context("spawn").Process(target=target, name=name, args=args)
+    process.start()
+    try:
+        await asyncio.to_thread(process.join)
+    finally:
+        if process.is_alive():
+            process.terminate()
+            await asyncio.to_thread(process.join, TERMINATE_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+                await asyncio.to_thread(process.join)
+    return process.exitcode
+
+
+def create_worker_logger(filepath: str, name: str, formatter: logging.Formatter) -> logging.Logger:
+    '''
+    Creates the error logger of a worker process, as the main.log handler is not shared across processes
+    '''
+    logger_file_handler = RotatingFileHandler(
+        filepath,
+        mode="a",
+        maxBytes=1024 * 1024,
+        backupCount=100,
+        encoding="utf8",
+    )
+    logger_file_handler.setLevel(logging.WARNING)
+    logger_file_handler.setFormatter(formatter)
+    worker_logger = logging.getLogger(name)
+    worker_logger.setLevel(logging.WARNING)
+    worker_logger.addHandler(logger_file_handler)
+    return worker_logger
+
+
+def run_shard(shard: int, bearer_token: str, sections: Dict[str, Dict[str, str]], formatter: logging.Formatter) -> None:
+    '''
+    Entry point of a worker process: runs the user tweet service over the shard's usernames on its own event loop
+    '''
+    config = RawConfigParser()
+    config.read_dict(sections)
+
+    shard_logger = create_worker_logger(
+        os.path.join(os.path.dirname(config["FILEPATHS"]["user_tweet_log_file"]), "shard.log"), f"{__name__}.shard{shard}", formatter)
+
+    supervisor = Supervisor.from_config(config, shard_logger)
+    supervisor.add(f"UserTweetShard{shard}", lambda: TwitterUser.create_service(bearer_token, config, shard_logger, formatter))
+    asyncio.run(run_with_client(supervisor.run()))
+    logging.shutdown()
+
+
+class ShardedUserCollector:
+    def __init__(self, bearer_tokens: List[str], config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter):
+        if not bearer_tokens:
+            raise ValueError(f"No bearer token found in environment, expected {TOKEN_VARIABLE} (and optionally {TOKEN_VARIABLE}_1, ...)")
+        self.bearer_tokens = bearer_tokens
+        self.config = config
+        self.logger = logger
+        self.formatter = formatter
+        self.shards = config.getint("USERTWEET", "shards", fallback=1)
+        self.shard_dir = config.get("FILEPATHS", "shard_dir", fallback="data/shards")
+
+    # Define service coroutine
+    @staticmethod
+    async def create_service(bearer_tokens: List[str], config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter) -> None:
+        '''
+        Creates a service coroutine to run the user tweet service across USERTWEET shards worker processes
+        '''
+        await ShardedUserCollector(bearer_tokens, config, logger, formatter).main()
+
+    def get_shard_dir(self, shard: int) -> str:
+        return os.path.join(self.shard_dir, str(shard))
+
+    def partition_usernames(self) -> List[List[str]]:
+        partitions: List[List[str]] = [[] for _ in range(self.shards)]
+        for username in ast.literal_eval(self.config["USERTWEET"]["username"]):
+            partitions[shard_of(username, self.shards)].append(username)
+        return partitions
+
+    def create_shard_config(self, shard: int, usernames: List[str]) -> Dict[str, Dict[str, str]]:
+        '''
+        Returns the config sections of a shard: its usernames, and its own state files within its shard directory.
+        Shards only write JSONL segments; the sinks, Parquet export, graph, search index and deduplication run once, when the segments are merged.
+        '''
+        sections = {section: dict(self.config[section]) for section in self.config.sections()}
+        directory = self.get_shard_dir(shard)
+        for option in ("user_tweet_log_file", "user_cache_file", "user_checkpoint_file", "user_tweet_store_dir"):
+            sections["FILEPATHS"][option] = os.path.join(directory, os.path.basename(self.config["FILEPATHS"][option]))
+        sections["USERTWEET"].update({"username": repr(usernames), "shards": "1"})
+        sections.setdefault("STORE", {}).update({"backend": "segments", "parquet_export": "False", "dedup": "False"})
+        sections.setdefault("GRAPH", {}).update({"enabled": "False"})
+        sections.setdefault("SEARCH", {}).update({"enabled": "False"})
+        return sections
+
+    def seed_shard_state(self, sections: Dict[str, Dict[str, str]]) -> None:
+        '''
+        Copies the main user cache and checkpoints into the shard, so that a change in the number of shards loses no state
+        '''
+        os.makedirs(sections["FILEPATHS"]["user_tweet_store_dir"], exist_ok=True)
+        for option in ("user_cache_file", "user_checkpoint_file"):
+            if os.path.exists(self.config["FILEPATHS"][option]):
+                shutil.copyfile(self.config["FILEPATHS"][option], sections["FILEPATHS"][option])
+
+    async def main(self) -> None:
+        '''
+        Performs the following in sequence:
+        1. Partition the usernames by shard, and seed every shard with the main user cache and checkpoints
+        2. Run every non-empty shard in its own worker process, with the bearer tokens assigned round-robin
+        3. Merge the shard segments, user caches and checkpoints into the main ones, even if a shard failed
+        '''
+        if len(self.bearer_tokens) < self.shards:
+            self.logger.warning(f"User Tweet: {self.shards} shards share {len(self.bearer_tokens)} bearer tokens, "
+                                f"so some shards share a rate-limit budget")
+
+        shard_sections = {}
+        for shard, usernames in enumerate(self.partition_usernames()):
+            if usernames:
+                shard_sections[shard] = self.create_shard_config(shard, usernames)
+                self.seed_shard_state(shard_sections[shard])
+
+        try:
+            exit_codes = await asyncio.gather(*(
+                run_process(run_shard, f"UserTweetShard{shard}", (shard, self.bearer_tokens[shard % len(self.bearer_tokens)], sections, self.formatter))
+                for shard, sections in shard_sections.items()))
+            for shard, exit_code in zip(shard_sections, exit_codes):
+                if exit_code != 0:
+                    self.logger.error(f"User Tweet Failed for shard {shard} - worker exited with code {exit_code}")
+        finally:
+            merged = await asyncio.to_thread(self.merge, shard_sections)
+            self.logger.info(f"User Tweet: Merged {merged} tweets from {len(shard_sections)} shards")
+
+    def merge(self, shard_sections: Dict[int, Dict[str, Dict[str, str]]]) -> int:
+        '''
+        Merges the state of the shards into the main user store, user cache and checkpoints, returning the number of tweets merged.
+        Merged segments are deleted only once the main store is closed; should the merge be interrupted, the remaining
+        segments are merged again on the next run, with any tweet already merged dropped by the deduplication.
+        '''
+        batch_size = self.config.getint("WRITER", "batch_size", fallback=500)
+        store = open_store(self.config, "user")
+        merged_segments = []
+        count = 0
+        try:
+            for sections in shard_sections.values():
+                for segment in SegmentStore(sections["FILEPATHS"]["user_tweet_store_dir"], "user").segments():
+                    with open(segment, "rb") as f:
+                        batch = []
+                        for line in f:
+                            line = line.rstrip(b"\r\n")
+                            if line:
+                                batch.append(TweetRecord(line))
+                            if len(batch) >= batch_size:
+                                store.write_batch(batch)
+                                count += len(batch)
+                                batch = []
+                        if batch:
+                            store.write_batch(batch)
+                            count += len(batch)
+                    merged_segments.append(segment)
+        finally:
+            store.close()
+        for segment in merged_segments:
+            os.remove(segment)
+
+        user_cache = UserCache(
+            self.config.get("FILEPATHS", "user_cache_file", fallback="data/user_cache.json"),
+            ttl=self.config.getfloat("USERTWEET", "user_cache_ttl", fallback=0),
+            store_profiles=self.config.getboolean("USERTWEET", "user_cache_profiles", fallback=True),
+        )
+        checkpoints = Checkpoints(self.config.get("FILEPATHS", "user_checkpoint_file", fallback="data/user_checkpoints.json"))
+        for sections in shard_sections.values():
+            user_cache.merge(UserCache(sections["FILEPATHS"]["user_cache_file"], ttl=user_cache.ttl))
+            checkpoints.merge(Checkpoints(sections["FILEPATHS"]["user_checkpoint_file"]))
+        user_cache.save()
+        checkpoints.save()
+        return count
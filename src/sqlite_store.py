@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import List
+
+from .records import TweetRecord
+
+'''
+Optional SQLite sink for the collected tweets, enabled with STORE backend = sqlite (or both).
+The database runs in WAL mode so that readers (e.g. a dashboard) never block the writers, inserts one writer batch per
+transaction, and upserts by tweet ID so that re-polled or re-streamed tweets are deduplicated.
+Matching rule tags live in their own table, so that "tweets matching tag X in the last day" is an index lookup.
+'''
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tweets (
+    id          INTEGER PRIMARY KEY,
+    author_id   TEXT,
+    created_at  TEXT NOT NULL,
+    text        TEXT,
+    source      TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    payload     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tweets_author_id ON tweets (author_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_tweets_created_at ON tweets (created_at);
+
+CREATE TABLE IF NOT EXISTS tweet_rules (
+    tweet_id    INTEGER NOT NULL,
+    tag         TEXT NOT NULL,
+    rule_id     TEXT,
+    PRIMARY KEY (tweet_id, tag)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_tweet_rules_tag ON tweet_rules (tag, tweet_id);
+"""
+
+UPSERT_TWEET = """
+INSERT INTO tweets (id, author_id, created_at, text, source, received_at, payload)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    author_id = COALESCE(excluded.author_id, tweets.author_id),
+    text = COALESCE(excluded.text, tweets.text),
+    payload = excluded.payload
+"""
+
+INSERT_RULE = "INSERT OR IGNORE INTO tweet_rules (tweet_id, tag, rule_id) VALUES (?, ?, ?)"
+
+
+def to_iso(timestamp: float) -> str:
+    '''
+    Formats a UNIX timestamp like the API's created_at, so that both sort together
+    '''
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class SqliteStore:
+    def __init__(self, filepath: str, source: str):
+        self.filepath = filepath
+        self.source = source
+        self.lock = threading.Lock()        # Batches may be written from different worker threads
+        self.connection = None
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.filepath, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")     # Durable across application crashes in WAL mode
+        connection.executescript(SCHEMA)
+        return connection
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        tweets = []
+        rules = []
+        for record in records:
+            try:
+                message = record.json
+            except ValueError:
+                continue
+            tweet = message.get("data")
+            if not isinstance(tweet, dict) or "id" not in tweet:
+                continue        # Not a tweet, e.g. a stream error message
+
+            tweet_id = int(tweet["id"])
+            tweets.append((
+                tweet_id,
+                tweet.get("author_id"),
+                tweet.get("created_at") or to_iso(record.received_at),
+                tweet.get("text"),
+                self.source,
+                record.received_at,
+                record.raw.decode("utf8"),
+            ))
+            for rule in message.get("matching_rules", []):
+                rules.append((tweet_id, rule.get("tag") or "", rule.get("id")))
+
+        if not tweets:
+            return
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            with self.connection:       # One transaction per batch
+                self.connection.executemany(UPSERT_TWEET, tweets)
+                self.connection.executemany(INSERT_RULE, rules)
+
+    def recent_tweet_ids(self, limit: int) -> List[int]:
+        '''
+        Returns the IDs of up to 'limit' tweets of this service, newest first
+        '''
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.connect()
+            rows = self.connection.execute("SELECT id FROM tweets WHERE source = ? ORDER BY id DESC LIMIT ?", (self.source, limit))
+            return [tweet_id for tweet_id, in rows.fetchall()]
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
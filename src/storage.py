@@ -0,0 +1,112 @@
+import os
+import logging
+from typing import List, Optional
+
+from .records import TweetRecord
+from .tweet_store import SegmentStore
+from .sqlite_store import SqliteStore
+from .dedup import TweetDeduplicator
+from .analytics import StreamAnalytics
+from .graph import InteractionGraph
+from .search_index import SearchIndex
+from .metrics import sink_write_seconds
+
+'''
+Opens the tweet sinks of a service according to STORE backend:
+- segments: append-only JSONL segments (default)
+- sqlite: SQLite database at FILEPATHS tweets_db_file
+- both: every batch goes to the segments and the database
+Additionally, STORE parquet_export streams every batch into the partitioned Parquet dataset at FILEPATHS parquet_dir,
+ANALYTICS enabled feeds the stream's tweets into the incremental analytics (see analytics.py), and GRAPH enabled
+feeds the tweets of both services into the user interaction graph (see graph.py). SEARCH enabled indexes the text of the
+tweets of both services (see search_index.py).
+With STORE dedup enabled, tweets already written by the service (in this run or a previous one) are dropped before any sink.
+Their IDs are only recorded as seen once the storage sinks (segments, database) have written the batch, so that a
+failed batch is written again when the tweets are received again. The seen IDs are loaded from their saved state, or
+otherwise seeded from the tweets already in the segments (or the database), as the state is not committed.
+The derived sinks (Parquet export, analytics, graph, search) are best-effort and isolated: a failure in one is logged,
+without affecting the others or the batch.
+'''
+
+BACKENDS = ("segments", "sqlite", "both")
+
+
+class FanoutStore:
+    def __init__(self, stores: list, dedup: Optional[TweetDeduplicator] = None, derived: Optional[list] = None):
+        self.stores = stores
+        self.dedup = dedup
+        self.derived = derived or []
+        self.logger = logging.getLogger(__name__)
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        if self.dedup is not None:
+            with sink_write_seconds.time(type(self.dedup).__name__):
+                records = self.dedup.filter(records)
+        if not records:
+            return
+        for store in self.stores:
+            with sink_write_seconds.time(type(store).__name__):
+                store.write_batch(records)       # Raises, leaving the IDs unrecorded
+
+        for store in self.derived:
+            try:
+                with sink_write_seconds.time(type(store).__name__):
+                    store.write_batch(records)
+            except Exception as e:
+                self.logger.error(f"{type(store).__name__} Failed to write {len(records)} records - {e}")
+        if self.dedup is not None:
+            self.dedup.commit(records)
+
+    def close(self) -> None:
+        for store in self.stores:
+            store.close()
+        for store in self.derived:
+            try:
+                store.close()
+            except Exception as e:
+                self.logger.error(f"{type(store).__name__} Failed to close - {e}")
+        if self.dedup is not None:
+            self.dedup.save()
+
+
+def open_store(config, service: str, raw: bool = True) -> FanoutStore:
+    '''
+    Opens the sinks for 'service' (either "stream" or "user")
+    '''
+    backend = config.get("STORE", "backend", fallback="segments")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown STORE backend {backend}, expected one of {BACKENDS}")
+
+    stores = []
+    if backend in ("segments", "both"):
+        stores.append(SegmentStore.from_config(config, f"{service}_tweet_store_dir", service, raw=raw))
+    if backend in ("sqlite", "both"):
+        filepath = config["FILEPATHS"]["tweets_db_file"]
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        stores.append(SqliteStore(filepath, service))
+
+    derived = []
+    if config.getboolean("STORE", "parquet_export", fallback=False):
+        from .parquet_export import ParquetSink     # Imported lazily, as pyarrow is optional
+        derived.append(ParquetSink(config["FILEPATHS"]["parquet_dir"], max_rows=config.getint("STORE", "parquet_max_rows", fallback=50000)))
+    if service == "stream" and config.getboolean("ANALYTICS", "enabled", fallback=False):
+        derived.append(StreamAnalytics.from_config(config))
+    if config.getboolean("GRAPH", "enabled", fallback=False):
+        derived.append(InteractionGraph.from_config(config))
+    if config.getboolean("SEARCH", "enabled", fallback=False):
+        derived.append(SearchIndex.from_config(config))
+
+    dedup = None
+    if config.getboolean("STORE", "dedup", fallback=False):
+        dedup = TweetDeduplicator(
+            config["FILEPATHS"][f"{service}_seen_ids_file"],
+            capacity=config.getint("STORE", "dedup_capacity", fallback=1000000),
+            window=config.getint("STORE", "dedup_window", fallback=10000),
+        )
+        if not os.path.exists(dedup.filepath):
+            # No saved state, e.g. in GitHub Actions: rebuilt from the tweets already written
+            for store in stores:
+                if hasattr(store, "recent_tweet_ids"):
+                    dedup.seed(store.recent_tweet_ids(dedup.capacity))
+                    break
+    return FanoutStore(stores, dedup, derived)
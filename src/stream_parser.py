@@ -0,0 +1,47 @@
+import time
+from typing import List
+
+'''
+Incremental framing of the filtered stream body.
+The stream delivers one JSON message per CRLF-terminated line plus a bare CRLF keep-alive heartbeat every ~20 seconds,
+but network chunks do not follow message boundaries: one chunk may hold part of a message, or several messages at once.
+The framer buffers the raw bytes and only hands out complete lines.
+'''
+
+
+class LineFramer:
+    def __init__(self, max_line_bytes: int = 16 * 1024 * 1024):
+        self.buffer = bytearray()           # Reused across chunks, only the consumed prefix is discarded
+        self.max_line_bytes = max_line_bytes
+        self.heartbeats = 0
+        self.last_activity = time.monotonic()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        '''
+        Appends a chunk of the byte stream and returns the complete, non-empty lines it terminates (without line endings).
+        Empty lines are keep-alive heartbeats, which are counted but not returned.
+        '''
+        self.last_activity = time.monotonic()
+        self.buffer += chunk
+
+        lines = []
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line = bytes(self.buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            if line.strip():
+                lines.append(line)
+            else:
+                self.heartbeats += 1
+
+        if start:
+            del self.buffer[:start]
+        if len(self.buffer) > self.max_line_bytes:
+            raise ValueError(f"Stream line exceeds {self.max_line_bytes} bytes without a line ending")
+        return lines
+
+    def seconds_since_activity(self) -> float:
+        return time.monotonic() - self.last_activity
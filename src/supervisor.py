@@ -0,0 +1,91 @@
+import signal
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict
+
+from .retry import Backoff
+from .utils import RawConfigParser
+
+'''
+Runs every service as a task on a single event loop, replacing the thread-per-service model.
+All services therefore share one connection pool and one set of rate-limit budgets.
+- Retryable (network / HTTP) errors are handled within each service by its RetryPolicy
+- A service crashing with any other error is restarted after a backoff, up to SUPERVISOR max_restarts times
+- On SIGTERM / SIGINT (e.g. the GitHub Actions timeout), every service is cancelled and given the chance to flush
+  its pending writes before the loop exits
+'''
+
+
+class Supervisor:
+    def __init__(self, logger: logging.Logger, max_restarts: int = 5, backoff: Backoff = Backoff(10, 300)):
+        self.logger = logger
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        self.services: Dict[str, Callable[[], Awaitable]] = {}
+        self.stopping = False
+
+    @staticmethod
+    def from_config(config: RawConfigParser, logger: logging.Logger) -> "Supervisor":
+        return Supervisor(
+            logger,
+            max_restarts=config.getint("SUPERVISOR", "max_restarts", fallback=5),
+            backoff=Backoff(config.getfloat("SUPERVISOR", "restart_initial", fallback=10), config.getfloat("SUPERVISOR", "restart_max", fallback=300)),
+        )
+
+    def add(self, name: str, factory: Callable[[], Awaitable]) -> None:
+        '''
+        Registers a service, 'factory' creating a new coroutine of the service for every (re)start
+        '''
+        self.services[name] = factory
+
+    async def supervise(self, name: str, factory: Callable[[], Awaitable]) -> None:
+        restarts = 0
+        while True:
+            try:
+                await factory()
+                self.logger.info(f"{name} completed")
+                return
+            except Exception as e:
+                if restarts >= self.max_restarts:
+                    self.logger.error(f"{name} crashed, giving up after {restarts} restarts - {e}")
+                    return
+                delay = self.backoff.delay(restarts)
+                restarts += 1
+                self.logger.exception(f"{name} crashed, restarting in {delay:.1f} seconds - {e}")
+                await asyncio.sleep(delay)
+
+    def stop(self, tasks: Dict[str, asyncio.Task]) -> None:
+        if self.stopping:
+            return
+        self.stopping = True
+        self.logger.warning("Shutdown requested, stopping all services ...")
+        for task in tasks.values():
+            task.cancel()
+
+    async def run(self) -> None:
+        '''
+        Runs all registered services until they complete or a shutdown signal is received
+        '''
+        loop = asyncio.get_running_loop()
+        tasks = {name: asyncio.create_task(self.supervise(name, factory), name=name) for name, factory in self.services.items()}
+
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signal_number, self.stop, tasks)
+            except (NotImplementedError, RuntimeError):      # Unsupported on Windows and outside the main thread
+                pass
+
+        for name, task in tasks.items():
+            self.logger.info(f"{name} started")
+        try:
+            results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        finally:
+            for signal_number in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.remove_signal_handler(signal_number)
+                except (NotImplementedError, RuntimeError):
+                    pass
+
+        for name, result in zip(tasks, results):
+            if isinstance(result, asyncio.CancelledError):
+                self.logger.info(f"{name} stopped")
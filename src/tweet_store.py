@@ -0,0 +1,139 @@
+import os
+import time
+import glob
+import threading
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from .records import TweetRecord
+
+'''
+Append-only tweet store, replacing the logger-as-database pattern.
+Tweets are written one JSON document per line (JSONL) into segment files named <prefix>-<UTC creation time>-<sequence>.jsonl,
+so readers can scan them line by line without stripping any log prefix. Segments roll over by size or age and are never deleted.
+Each batch is appended with a single write, and fsync runs at most every STORE fsync_interval seconds
+(0 to fsync every batch, -1 to leave it to the operating system).
+'''
+
+SEGMENT_SUFFIX = ".jsonl"
+SEGMENT_TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+
+
+class SegmentStore:
+    def __init__(self, directory: str, prefix: str, max_bytes: int = 64 * 1024 * 1024, max_age: float = 24 * 60 * 60,
+                 fsync_interval: float = 5, raw: bool = True):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_interval = fsync_interval
+        self.raw = raw
+        self.lock = threading.Lock()        # Batches may be written from different worker threads
+        self.file = None
+        self.filepath: Optional[str] = None
+        self.opened_at = 0.0
+        self.last_fsync = 0.0
+
+    @staticmethod
+    def from_config(config, directory_option: str, prefix: str, raw: bool = True) -> "SegmentStore":
+        return SegmentStore(
+            config["FILEPATHS"][directory_option],
+            prefix,
+            max_bytes=config.getint("STORE", "segment_max_bytes", fallback=64 * 1024 * 1024),
+            max_age=config.getfloat("STORE", "segment_max_age", fallback=24 * 60 * 60),
+            fsync_interval=config.getfloat("STORE", "fsync_interval", fallback=5),
+            raw=raw,
+        )
+
+    def segments(self) -> List[str]:
+        '''
+        Returns the segment files of this store, oldest first
+        '''
+        return sorted(glob.glob(os.path.join(self.directory, f"{self.prefix}-*{SEGMENT_SUFFIX}")))
+
+    def recent_tweet_ids(self, limit: int) -> List[int]:
+        '''
+        Returns the IDs of up to 'limit' tweets, most recently written first
+        '''
+        tweet_ids = []
+        for filepath in reversed(self.segments()):
+            with open(filepath, "rb") as f:
+                lines = f.read().split(b"\n")
+            for line in reversed(lines):
+                tweet_id = TweetRecord(line).tweet_id if line else None
+                if tweet_id is not None:
+                    tweet_ids.append(int(tweet_id))
+                    if len(tweet_ids) >= limit:
+                        return tweet_ids
+        return tweet_ids
+
+    def segment_created_at(self, filepath: str) -> float:
+        timestamp = os.path.basename(filepath)[len(self.prefix) + 1:].split("-")[0]
+        return datetime.strptime(timestamp, SEGMENT_TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+    def open_segment(self) -> None:
+        '''
+        Resumes the latest segment if it is still within the rollover limits, otherwise starts a new one
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        now = time.time()
+
+        if segments and os.path.getsize(segments[-1]) < self.max_bytes and now - self.segment_created_at(segments[-1]) < self.max_age:
+            self.filepath = segments[-1]
+            self.opened_at = self.segment_created_at(self.filepath)
+        else:
+            self.filepath = os.path.join(
+                self.directory,
+                f"{self.prefix}-{datetime.fromtimestamp(now, timezone.utc).strftime(SEGMENT_TIME_FORMAT)}-{len(segments):06d}{SEGMENT_SUFFIX}")
+            self.opened_at = now
+
+        self.file = open(self.filepath, "ab")
+        if self.file.tell() > 0:
+            # Terminate a line left partial by a crash, so that it cannot corrupt the next record
+            with open(self.filepath, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write(b"\n")
+
+    def should_rollover(self) -> bool:
+        return self.file.tell() >= self.max_bytes or time.time() - self.opened_at >= self.max_age
+
+    def serialise(self, record: TweetRecord) -> bytes:
+        return record.raw if self.raw else record.canonical().encode("utf8")
+
+    def write_batch(self, records: List[TweetRecord]) -> None:
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.serialise(record))
+            except ValueError:
+                continue        # Undecodable message, only possible when canonicalising
+        if not lines:
+            return
+        lines.append(b"")
+
+        with self.lock:
+            if self.file is None:
+                self.open_segment()
+            elif self.should_rollover():
+                self.close_segment()
+                self.open_segment()
+
+            self.file.write(b"\n".join(lines))
+            self.file.flush()
+            if self.fsync_interval >= 0 and time.monotonic() - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.file.fileno())
+                self.last_fsync = time.monotonic()
+
+    def close_segment(self) -> None:
+        self.file.flush()
+        if self.fsync_interval >= 0:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.close_segment()
@@ -7,8 +7,18 @@ import time
 import logging
 from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
-
-from .utils import log_wrapper, RawConfigParser
+from typing import Dict, List
+
+from .utils import parse_timestamp, read_json, write_json_atomic, RawConfigParser
+from .http_client import SharedClient, run_with_client
+from .retry import RetryPolicy
+from .stream_parser import LineFramer
+from .records import TweetRecord
+from .writer import AsyncWriter
+from .storage import open_store
+from .checkpoints import Checkpoints
+from .backfill import Backfill
+from .metrics import MeteredRotatingFileHandler, stream_connections, stream_lag_seconds
 
 '''
 Currently aims to retrieve realtime streams of tweets filtered according to rules specified in config.ini file.
@@ -19,18 +29,30 @@ By default, entry via CLI will listen for tweets related to Twitter's layoffs in
 
 
 class TwitterStream:
-    # Define thread function
+    # Define service coroutine
     @staticmethod
-    @log_wrapper
-    def create_thread(bearer_token: str, config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter) -> None:
+    async def create_service(bearer_token: str, config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter) -> None:
         '''
-        Creates a thread to:
+        Creates a service coroutine to:
         1. Create a logger object
         2. Initialise a TwitterStream class
-        3. Run the main function of the class asynchronously
+        3. Run the main function of the class, retrying with backoff per error class
         4. Handles all errors from this object
         '''
-        logger_file_handler = RotatingFileHandler(
+        stream_logger = TwitterStream.create_logger(config, formatter)
+
+        # Retries (with backoff per error class) wait inside the event loop, so that they never block the thread
+        retry_policy = RetryPolicy.from_config(config)
+        try:
+            await retry_policy.run(lambda: TwitterStream(bearer_token, config, stream_logger).main(), logger, "Stream Tweet")
+
+        except Exception as e:
+            logger.error(f"Stream Tweet Failed - {e}")
+            raise
+
+    @staticmethod
+    def create_logger(config: RawConfigParser, formatter: logging.Formatter) -> logging.Logger:
+        logger_file_handler = MeteredRotatingFileHandler(
             config["FILEPATHS"]["stream_tweet_log_file"],
             mode='a',
             maxBytes=1024 * 1024,
@@ -43,51 +65,47 @@ class TwitterStream:
         stream_logger = logging.getLogger(f"{__name__}.stream_tweets")  # Initialise Parent-Child logger relationship
         stream_logger.propagate = True  # By default, propagate is True
         stream_logger.setLevel(logging.INFO)
-        stream_logger.addHandler(logger_file_handler)
-
-        interval = 5
-
-        while True:
-            try:
-                twitter_stream = TwitterStream(bearer_token, config, stream_logger)
-                asyncio.run(twitter_stream.main())
-                break
-
-            except httpx.RequestError as e:   # Handle request errors
-                logger.error(f"Stream Tweet Failed - {e}")
-                logger.error(f"Retrying Stream Tweet in {interval} seconds ...")
-            
-            except httpx.HTTPStatusError as e:   # Handle response errors
-                # If rate limit has been reached, wait until reset time
-                if e.response.status_code == 429:
-                    logger.error(f"Rate limit reached, waiting until reset time: {e.response.headers['x-rate-limit-reset']}")
-                    time.sleep(int(e.response.headers["x-rate-limit-reset"]) - time.time())
-                logger.error(f"Stream Tweet Failed - {e}")
-                logger.error(f"Retrying Stream Tweet in {interval} seconds ...")
-
-            except Exception as e:
-                logger.error(f"Stream Tweet Failed - {e}")
-                break
-
-            time.sleep(interval)
+        if not stream_logger.handlers:   # Services restarted by the supervisor reuse the logger
+            stream_logger.addHandler(logger_file_handler)
+        else:
+            logger_file_handler.close()
+        return stream_logger
 
     def __init__(self, bearer_token: str, config: RawConfigParser, logger: logging.Logger):
         self.bearer_token = bearer_token
         self.config = config
         self.logger = logger
-    
+        # Opened by main(), as every retry attempt runs on a new instance
+        self.store = None
+        self.writer = None
+        self.checkpoints = None
+        self.backfill = None
+
+    def open_store(self):
+        # Tweets are appended to the segment store (written exactly as received in STREAMTWEET raw_passthrough mode), while
+        # rule management and errors remain in the service log
+        return open_store(self.config, "stream", raw=self.config.getboolean("STREAMTWEET", "raw_passthrough", fallback=False))
+
     async def main(self) -> None:
         '''
         Performs the following in sequence:
-        1. Get all stream rules for user's twitter account
-        2. Delete all stream rules for user's twitter account
-        3. Set new stream rules for user's twitter account
-        4. Get stream of tweets based on the new stream rules
+        1. Synchronise the stream rules of user's twitter account with config.ini, only adding / deleting the differences
+        2. Get stream of tweets based on the synchronised stream rules
+        The store, writer and checkpoints are opened for this attempt only, and flushed and closed however it ends.
         '''
-        rules = await self.get_rules()
-        delete = await self.delete_all_rules(rules)
-        set = await self.set_rules(delete)
-        await self.get_stream(set)
+        self.store = self.open_store()
+        try:
+            self.writer = AsyncWriter.from_config(self.write_records, self.config, self.logger, name="stream")
+            self.checkpoints = Checkpoints(self.config["FILEPATHS"]["stream_checkpoint_file"])
+            self.backfill = Backfill(self.config, self.bearer_oauth, self.writer, self.checkpoints, self.logger)
+            await self.sync_rules()
+            await self.get_stream()
+        finally:
+            if self.writer is not None:
+                await self.writer.close()     # Flush the queued tweets, including on disconnects
+            self.store.close()
+            if self.checkpoints is not None:
+                self.checkpoints.save()
 
     def bearer_oauth(self, r: httpx.AsyncClient) -> httpx.AsyncClient:
         """
@@ -99,9 +117,8 @@ class TwitterStream:
 
 
     async def get_rules(self) -> dict:
-        session = httpx.AsyncClient(timeout=30)
+        session = SharedClient.get(self.config)
         response = await session.get(self.config["LINKS"]["twitter_stream_rules_link"], auth=self.bearer_oauth)
-        await session.aclose()
 
         if response.status_code != 200:
             raise httpx.HTTPStatusError(f"Cannot get rules (HTTP {response.status_code}): {response.text}",
@@ -111,25 +128,20 @@ class TwitterStream:
         return response.json()
 
 
-    async def delete_all_rules(self, rules) -> None:
-        if rules is None or "data" not in rules:
-            return None
-
-        ids = list(map(lambda rule: rule["id"], rules["data"]))
+    async def delete_rules(self, ids: List[str]) -> None:
         payload = {"delete": {"ids": ids}}
 
-        session = httpx.AsyncClient(timeout=30)
+        session = SharedClient.get(self.config)
         response = await session.post(self.config["LINKS"]["twitter_stream_rules_link"], auth=self.bearer_oauth, json=payload)
-        await session.aclose()
 
         if response.status_code != 200:
             raise httpx.HTTPStatusError(f"Cannot delete rules (HTTP {response.status_code}): {response.text}",
                 request=response.request,
                 response=response)
-        self.logger.info(f"Delete All Rules: {json.dumps(response.json(), sort_keys=True)}")
+        self.logger.info(f"Delete Rules: {json.dumps(response.json(), sort_keys=True)}")
 
 
-    async def set_rules(self, delete) -> dict:
+    def get_config_rules(self) -> List[Dict[str, str]]:
         rules = []
 
         # Deprecated - Rules are no longer stored under STREAMRULE section
@@ -139,49 +151,143 @@ class TwitterStream:
         config_tag = ast.literal_eval(self.config["STREAMTWEET"]["tag"])      # require ast.literal to process data in config.ini
         for rule, tag in zip(config_rule, config_tag):
             rules.append({"value": rule, "tag": tag})
+        return rules
+
 
+    async def set_rules(self, rules: List[Dict[str, str]]) -> dict:
         payload = {"add": rules}
 
-        session = httpx.AsyncClient(timeout=30)
+        session = SharedClient.get(self.config)
         response = await session.post(self.config["LINKS"]["twitter_stream_rules_link"], auth=self.bearer_oauth, json=payload)
-        await session.aclose()
 
         if response.status_code != 201:
             raise httpx.HTTPStatusError(f"Cannot add rules (HTTP {response.status_code}): {response.text}",
                 request=response.request,
                 response=response)
         self.logger.info(f"Set Rules: {json.dumps(response.json(), sort_keys=True)}")
+        return response.json()
+
+
+    async def sync_rules(self) -> None:
+        '''
+        Reconciles the server's stream rules with the (rule, tag) pairs of config.ini:
+        1. If the last-applied rule set (cached in FILEPATHS stream_rule_cache_file) matches config.ini and was verified within
+           STREAMTWEET rule_cache_ttl seconds, nothing is requested
+        2. Otherwise the current rules are fetched, the missing ones are added first and the extra ones deleted afterwards,
+           so that there is never a window without active rules
+        '''
+        desired = {(rule["value"], rule["tag"]) for rule in self.get_config_rules()}
+        cache_file = self.config["FILEPATHS"]["stream_rule_cache_file"]
+        cache = read_json(cache_file, default={})
+
+        cached = {(rule["value"], rule.get("tag", "")) for rule in cache.get("rules", [])}
+        if cached == desired and time.time() - cache.get("verified_at", 0) < self.config.getfloat("STREAMTWEET", "rule_cache_ttl", fallback=0):
+            self.logger.info("Sync Rules: Unchanged since last verification, skipping")
+            return
+
+        current = (await self.get_rules()).get("data", [])
+        kept = []
+        delete_ids = []
+        seen = set()
+        for rule in current:
+            pair = (rule["value"], rule.get("tag", ""))
+            if pair in desired and pair not in seen:
+                kept.append(rule)
+                seen.add(pair)
+            else:
+                delete_ids.append(rule["id"])       # Not in config.ini, or a duplicate
+
+        add = [{"value": value, "tag": tag} for value, tag in sorted(desired - seen)]
+        if add:
+            added = await self.set_rules(add)
+            kept.extend(added.get("data", []))
+            for error in added.get("errors", []):
+                self.logger.error(f"Sync Rules: Cannot add rule - {json.dumps(error, sort_keys=True)}")
+        if delete_ids:
+            await self.delete_rules(delete_ids)
+
+        self.logger.info(f"Sync Rules: {len(kept)} active, {len(add)} added, {len(delete_ids)} deleted")
+        write_json_atomic(cache_file, {"rules": kept, "verified_at": time.time()})
 
 
     async def process_chunk(self, response: httpx.Response) -> None:
-        async for response_line in response.aiter_text():
-            if response_line and response_line != "\r\n" and response_line != "\n":
-                json_response = json.loads(response_line)
-                self.logger.info(json.dumps(json_response, sort_keys=True))
+        '''
+        Frames the raw byte stream into newline-delimited messages, since network chunks do not follow message boundaries.
+        Messages are handed to the writer queue, so the socket is read without waiting on disk writes.
+        '''
+        framer = LineFramer()
+        async for chunk in response.aiter_bytes():
+            for response_line in framer.feed(chunk):
+                await self.writer.put(TweetRecord(response_line))
 
-    async def get_stream(self, set) -> None:
-        session = httpx.AsyncClient(timeout=30)
+    def write_records(self, records: List[TweetRecord]) -> None:
+        '''
+        Sink of the writer, run in a worker thread: stores the records, then advances the per-rule backfill checkpoints
+        '''
+        self.store.write_batch(records)
+        self.observe_lag(records)
+        if self.config.getboolean("STREAMTWEET", "backfill", fallback=False):
+            self.backfill.record_received(records)
 
-        async with session.stream("GET", self.config["LINKS"]["twitter_stream_link"], auth=self.bearer_oauth) as response:
+    @staticmethod
+    def observe_lag(records: List[TweetRecord]) -> None:
+        '''
+        Records the time between the creation and the receipt of every streamed tweet.
+        Backfilled tweets are not streamed (their matching rules carry no rule ID), hence left out.
+        '''
+        for record in records:
+            try:
+                message = record.json
+                tweet = message.get("data")
+                if not isinstance(tweet, dict) or not any("id" in rule for rule in message.get("matching_rules", [])):
+                    continue
+                created_at = parse_timestamp(tweet.get("created_at"))
+            except ValueError:
+                continue
+            if created_at is not None:
+                stream_lag_seconds.observe(max(0.0, record.received_at - created_at.timestamp()))
+
+    def get_stream_params(self) -> dict:
+        # Request the same tweet fields as user tweets, so that stream tweets carry author_id, created_at, entities, etc.
+        tweetfields_section = self.config["TWEETFIELDS"]
+        tweetsfields = [key for key in tweetfields_section if tweetfields_section[key] == "True"]
+        return {"tweet.fields": ",".join(tweetsfields)}
+
+    async def get_stream(self) -> None:
+        session = SharedClient.get(self.config)
+
+        async with session.stream("GET", self.config["LINKS"]["twitter_stream_link"], params=self.get_stream_params(), auth=self.bearer_oauth) as response:
             if response.status_code != 200:
                 raise httpx.HTTPStatusError(f"Cannot get stream (HTTP {response.status_code}): {response.aiter_raw()}",
                     request=response.request,
                     response=response)
+            stream_connections.inc()
 
             timeout = self.config.getint("STREAMTWEET", "duration")
 
-            # If timeout is set to -1, stream will run indefinitely. Otherwise, stream will run for the specified duration
-            if timeout == -1:
-                await self.process_chunk(response)
-            else:
-                try:
-                    await asyncio.wait_for(self.process_chunk(response), timeout=timeout)
-                except asyncio.TimeoutError:
-                    self.logger.info(f"Stream Tweet: Stream timer has reached {timeout} seconds")
-                except Exception as e:
-                    self.logger.error(f"Stream Tweet Failed - {e}")
-
-        await session.aclose()
+            # Recover the tweets missed while disconnected, alongside the live stream (duplicates are dropped by the store)
+            # The gaps are recorded before the writer starts, as the live tweets advance the checkpoints past them
+            backfill_task = None
+            if self.config.getboolean("STREAMTWEET", "backfill", fallback=False):
+                self.backfill.open_gaps(self.get_config_rules())
+            self.writer.start()
+            if self.config.getboolean("STREAMTWEET", "backfill", fallback=False):
+                backfill_task = asyncio.create_task(self.backfill.run(self.get_config_rules()))
+            try:
+                # If timeout is set to -1, stream will run indefinitely. Otherwise, stream will run for the specified duration
+                if timeout == -1:
+                    await self.process_chunk(response)
+                else:
+                    try:
+                        await asyncio.wait_for(self.process_chunk(response), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        self.logger.info(f"Stream Tweet: Stream timer has reached {timeout} seconds")
+                    except Exception as e:
+                        self.logger.error(f"Stream Tweet Failed - {e}")
+            finally:
+                if backfill_task is not None:
+                    backfill_task.cancel()
+                    await asyncio.gather(backfill_task, return_exceptions=True)
 
 if __name__ == "__main__":
     # Initialize logging, config and environment variables
@@ -209,16 +315,9 @@ if __name__ == "__main__":
     logger_file_handler.setFormatter(formatter)
     logger.addHandler(logger_file_handler)
 
-    while True:
-        try:
-            twitter_stream = TwitterStream(bearer_token, config, logger)
-            asyncio.run(twitter_stream.main())
-            break
-
-        except (httpx.ProtocolError, httpx.HTTPStatusError) as e:
-            logger.error(f"Stream Tweet Failed - {e}")
-            logger.info(f"Retrying Stream Tweet")
-
-        except Exception as e:
-            logger.error(f"Stream Tweet Failed - {e}")
-            break
\ No newline at end of file
+    # Same retries as the service (backoff per error class, permanent errors raised)
+    retry_policy = RetryPolicy.from_config(config)
+    try:
+        asyncio.run(run_with_client(retry_policy.run(lambda: TwitterStream(bearer_token, config, logger).main(), logger, "Stream Tweet")))
+    except Exception as e:
+        logger.error(f"Stream Tweet Failed - {e}")
\ No newline at end of file
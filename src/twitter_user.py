@@ -3,12 +3,20 @@ import asyncio
 import os
 import json
 import ast
-import time
 import logging
 from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
+from typing import AsyncIterator, List, Optional, Tuple
 
-from .utils import log_wrapper, RawConfigParser
+from .utils import chunked, gather_bounded, RawConfigParser
+from .http_client import SharedClient, run_with_client
+from .retry import RetryPolicy
+from .user_cache import UserCache
+from .checkpoints import Checkpoints
+from .records import TweetRecord
+from .writer import AsyncWriter
+from .storage import open_store
+from .metrics import MeteredRotatingFileHandler
 
 '''
 Currently aims to retrieve the tweets of Twitter users specified in config.ini file.
@@ -16,24 +24,40 @@ By default, entry via CLI will retrieve elon musk, and donald trump
 # TODO: Add support for user tweet count (currently default to 5)
 # TODO: Remove the nextToken from data log, as it is sensitive
 # TODO: Listen to user tweets realtime
-# TODO: (Tentative, may not implement if realtime preferred) Specify the rate limit for the API / Use pagination
-# Refer to: https://developer.twitter.com/en/docs/twitter-api/pagination
+# TODO: (Tentative, may not implement if realtime preferred) Specify the rate limit for the API
+# Pagination follows: https://developer.twitter.com/en/docs/twitter-api/pagination
 '''
 
+USERS_LOOKUP_LIMIT = 100    # Maximum number of usernames per users/by request
+TWEETS_PAGE_MIN = 5         # Minimum max_results per users/{id}/tweets page
+TWEETS_PAGE_MAX = 100       # Maximum max_results per users/{id}/tweets page
+
 
 class TwitterUser:
-    # Define thread function
+    # Define service coroutine
     @staticmethod
-    @log_wrapper
-    def create_thread(bearer_token: str, config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter) -> None:
+    async def create_service(bearer_token: str, config: RawConfigParser, logger: logging.Logger, formatter: logging.Formatter) -> None:
         '''
-        Creates a thread to:
+        Creates a service coroutine to:
         1. Create a logger object
         2. Initialise a TwitterUser class
-        3. Run the main function of the class asynchronously
+        3. Run the main function of the class, retrying with backoff per error class
         4. Handles all errors from this object
         '''
-        logger_file_handler = RotatingFileHandler(
+        user_logger = TwitterUser.create_logger(config, formatter)
+
+        # Retries (with backoff per error class) wait inside the event loop, so that they never block the thread
+        retry_policy = RetryPolicy.from_config(config)
+        try:
+            await retry_policy.run(lambda: TwitterUser(bearer_token, config, user_logger).main(), logger, "User Tweet")
+
+        except Exception as e:
+            logger.error(f"User Tweet Failed - {e}")
+            raise
+
+    @staticmethod
+    def create_logger(config: RawConfigParser, formatter: logging.Formatter) -> logging.Logger:
+        logger_file_handler = MeteredRotatingFileHandler(
             config["FILEPATHS"]["user_tweet_log_file"],
             mode='a',
             maxBytes=1024 * 1024,
@@ -46,66 +70,126 @@ class TwitterUser:
         user_logger = logging.getLogger(f"{__name__}.user_tweets")  # Initialise Parent-Child logger relationship
         user_logger.propagate = True  # By default, propagate is True
         user_logger.setLevel(logging.INFO)
-        user_logger.addHandler(logger_file_handler)
-
-        interval = 5
-
-        while True:
-            try:
-                twitter_user = TwitterUser(bearer_token, config, user_logger)
-                asyncio.run(twitter_user.main())
-                break
-            
-            except httpx.RequestError as e:   # Handle request errors
-                logger.error(f"Stream Tweet Failed - {e}")
-                logger.error(f"Retrying User Tweet in {interval} seconds ...")
-            
-            except httpx.HTTPStatusError as e:   # Handle response errors
-                logger.error(f"User Tweet Failed - {e}")
-                logger.error(f"Retrying User Tweet in {interval} seconds ...")
-
-            except Exception as e:
-                logger.error(f"User Tweet Failed - {e}")
-                break
-
-            time.sleep(interval)
+        if not user_logger.handlers:   # Services restarted by the supervisor reuse the logger
+            user_logger.addHandler(logger_file_handler)
+        else:
+            logger_file_handler.close()
+        return user_logger
 
     def __init__(self, bearer_token: str, config: RawConfigParser, logger: logging.Logger):
         self.bearer_token = bearer_token
         self.config = config
         self.logger = logger
+        self.user_cache = UserCache(
+            config.get("FILEPATHS", "user_cache_file", fallback="data/user_cache.json"),
+            ttl=config.getfloat("USERTWEET", "user_cache_ttl", fallback=0),
+            store_profiles=config.getboolean("USERTWEET", "user_cache_profiles", fallback=True),
+        )
+        self.incremental = config.getboolean("USERTWEET", "incremental", fallback=False)
+        self.checkpoints = Checkpoints(config.get("FILEPATHS", "user_checkpoint_file", fallback="data/user_checkpoints.json"))
+        # Opened by main(), as every retry attempt runs on a new instance
+        self.store = None
+        self.writer = None
 
     async def main(self) -> None:
         '''
         Performs the following in sequence:
-        1. Retrieve the IDs for specified usernames
+        1. Retrieve the IDs for specified usernames from the user cache, looking up the rest (batched by USERTWEET lookup_batch_size)
         2. Separate the IDs into successful and errorneous
-        3. For each successful ID, retrieve top 5 tweets
+        3. For each successful ID, retrieve the latest USERTWEET count tweets page by page, concurrently (bounded by USERTWEET concurrency)
+        The store and writer are opened for this attempt only, and flushed and closed however it ends.
         '''
-        # Retrieve the user IDs
-        users_url = self.create_users_url()
-        users_params = self.get_users_params()
-        users_response = await self.connect_to_endpoint(users_url, users_params)
+        # Tweets are appended to the segment store, while user lookups and errors remain in the service log
+        self.store = open_store(self.config, "user")
+        try:
+            self.writer = AsyncWriter.from_config(self.store.write_batch, self.config, self.logger, name="user")
+            await self.collect()
+        finally:
+            if self.writer is not None:
+                await self.writer.close()
+            self.store.close()
 
-        # Separate successful and errorneous user IDs 
-        users_id = {}
-        for item in users_response.get("data", []):
-            users_id[item["id"]] = item
+    async def collect(self) -> None:
+        '''
+        Resolves the users and retrieves their tweets into the writer
+        '''
+        # Retrieve the user IDs from the cache, and look up the remaining ones in batches of at most 100 usernames per request
+        cached_users, missing_usernames = self.user_cache.resolve(self.get_usernames())
+        users_id, error_data = await self.lookup_users(missing_usernames) if missing_usernames else ({}, {})
+
+        self.user_cache.update(users_id.values())
+        self.user_cache.save()
+        users_id.update(cached_users)
 
-        error_data = {}
-        for item in users_response.get("errors", []):
-            error_data[item.get("resource_id", "Unknown")] = item
-        
         self.logger.info(f"users_id = {json.dumps(users_id, sort_keys=True)}")
         self.logger.info(f"error_data = {json.dumps(error_data, sort_keys=True)}")
         
-        # Retrieve the tweets for each successful user ID
-        for user_id in users_id:
-            tweets_url = self.create_tweets_url(user_id)
-            tweets_params = self.get_tweets_params()
+        # Retrieve the tweets for each successful user ID, failures of one user do not abort the others
+        user_ids = list(users_id)
+        concurrency = self.config.getint("USERTWEET", "concurrency", fallback=10)
+        self.writer.start()
+        try:
+            tweets_counts = await gather_bounded((self.get_user_tweets(user_id) for user_id in user_ids), concurrency)
+        finally:
+            await self.writer.close()       # Flushed before the checkpoints are saved
+
+        failed = 0
+        for user_id, tweets_count in zip(user_ids, tweets_counts):
+            if isinstance(tweets_count, BaseException):
+                failed += 1
+                self.logger.error(f"User Tweet Failed for user {user_id} - {tweets_count}")
+                continue
+            self.logger.info(f"User Tweet: Retrieved {tweets_count} tweets for user {user_id}")
+
+        if failed:
+            self.logger.warning(f"User Tweet: {failed} of {len(user_ids)} users failed")
+
+        if self.incremental:
+            self.checkpoints.save()
+
+    async def get_user_tweets(self, user_id: str) -> int:
+        '''
+        Retrieves up to USERTWEET count tweets of a single user ID, writing each page to the store as it arrives.
+        In incremental mode, only the tweets newer than the user's checkpoint are requested (all of them, see iter_tweet_pages),
+        and the checkpoint is advanced once every page has been retrieved. Returns the number of tweets retrieved.
+        '''
+        since_id = self.checkpoints.get_newest_id(user_id) if self.incremental else None
+        newest_id = None
+        tweets_count = 0
+
+        async for tweets_response in self.iter_tweet_pages(user_id, since_id):
+            for tweet in tweets_response.get("data", []):
+                await self.writer.put(TweetRecord.from_json({"data": tweet}))      # Same envelope as stream messages
+            for error in tweets_response.get("errors", []):
+                self.logger.error(f"tweets_error = {json.dumps(error, sort_keys=True)}")
+            newest_id = newest_id or tweets_response.get("meta", {}).get("newest_id")     # The first page holds the newest tweets
+            tweets_count += tweets_response.get("meta", {}).get("result_count", len(tweets_response.get("data", [])))
+
+        if self.incremental:
+            self.checkpoints.advance(user_id, newest_id)
+        return tweets_count
+
+    async def iter_tweet_pages(self, user_id: str, since_id: Optional[str] = None) -> AsyncIterator[dict]:
+        '''
+        Yields the pages of a user's timeline, following the pagination_token until USERTWEET count tweets have been
+        retrieved, the timeline is exhausted, or the USERTWEET start_time bound is reached.
+        With a since_id (incremental mode), every tweet newer than it is retrieved regardless of USERTWEET count, in pages of
+        the maximum size, since the checkpoint then moves to the newest tweet and a truncated range would never be fetched.
+        Only one page is held in memory at a time.
+        '''
+        remaining = ast.literal_eval(self.config["USERTWEET"]["count"]) if since_id is None else float("inf")
+        tweets_url = self.create_tweets_url(user_id)
+        pagination_token = None
 
+        while remaining > 0:
+            tweets_params = self.get_tweets_params(since_id, pagination_token, max_results=min(remaining, TWEETS_PAGE_MAX))
             tweets_response = await self.connect_to_endpoint(tweets_url, tweets_params)
-            self.logger.info(f"tweets_response = {json.dumps(tweets_response, sort_keys=True)}")
+            yield tweets_response
+
+            remaining -= tweets_response.get("meta", {}).get("result_count", len(tweets_response.get("data", [])))
+            pagination_token = tweets_response.get("meta", {}).get("next_token")
+            if pagination_token is None:
+                break
 
     # Handles Twitter authetification and the connection to Twitter's Streaming API
     def bearer_oauth(self, r: httpx.AsyncClient) -> httpx.AsyncClient:
@@ -120,7 +204,7 @@ class TwitterUser:
         """
         Connects to the endpoint and returns the response.
         """
-        session = httpx.AsyncClient(timeout=30)
+        session = SharedClient.get(self.config)
 
         response = await session.request("GET", url, auth=self.bearer_oauth, params=params)
         if response.status_code != 200:
@@ -128,7 +212,6 @@ class TwitterUser:
                 request=response.request,
                 response=response)
 
-        await session.aclose()
         return response.json()
 
 
@@ -138,20 +221,64 @@ class TwitterUser:
         userfields = [key for key in userfields_section if userfields_section[key] == "True"]
         return {"user.fields": ",".join(userfields)}
 
-    def create_users_url(self) -> str:
+    def get_usernames(self) -> List[str]:
         # Deprecated - usernames are now stored in config.ini, not in a text file
         # with open(self.config["FILEPATHS"]["usernames_file"]) as f:
         #     usernames = f.read().splitlines()
-        usernames = ast.literal_eval(self.config["USERTWEET"]["username"])      # Avoid eval() for security reasons; require ast.literal to process data in config.ini
-        return self.config["LINKS"]["twitter_user_link"].format(",".join(usernames)) 
+        return ast.literal_eval(self.config["USERTWEET"]["username"])      # Avoid eval() for security reasons; require ast.literal to process data in config.ini
+
+    def create_users_url(self, usernames: List[str]) -> str:
+        return self.config["LINKS"]["twitter_user_link"].format(",".join(usernames))
+
+    async def lookup_users(self, usernames: List[str]) -> Tuple[dict, dict]:
+        '''
+        Looks up the usernames in chunks of at most 100 (the API limit per request), issued concurrently.
+        Returns the merged successful users keyed by ID, and the errors keyed by resource ID.
+        If every chunk fails, the first error is raised so that the caller can retry.
+        '''
+        batch_size = min(self.config.getint("USERTWEET", "lookup_batch_size", fallback=USERS_LOOKUP_LIMIT), USERS_LOOKUP_LIMIT)
+        concurrency = self.config.getint("USERTWEET", "concurrency", fallback=10)
+        batches = list(chunked(usernames, batch_size))
+        users_params = self.get_users_params()
 
+        users_responses = await gather_bounded(
+            (self.connect_to_endpoint(self.create_users_url(batch), users_params) for batch in batches),
+            concurrency)
+
+        users_id = {}
+        error_data = {}
+        failures = [response for response in users_responses if isinstance(response, BaseException)]
+        if batches and len(failures) == len(batches):
+            raise failures[0]
+
+        for batch, users_response in zip(batches, users_responses):
+            if isinstance(users_response, BaseException):
+                self.logger.error(f"User Lookup Failed for {len(batch)} usernames - {users_response}")
+                for username in batch:
+                    error_data[username] = {"value": username, "detail": str(users_response)}
+                continue
+
+            for item in users_response.get("data", []):
+                users_id[item["id"]] = item
+            for item in users_response.get("errors", []):
+                error_data[item.get("resource_id", "Unknown")] = item
+
+        return users_id, error_data
 
     # Handles the API URLs and parameters for tweets
-    def get_tweets_params(self) -> dict:
+    def get_tweets_params(self, since_id: Optional[str] = None, pagination_token: Optional[str] = None, max_results: Optional[int] = None) -> dict:
         tweetfields_section = self.config["TWEETFIELDS"]
         tweetsfields = [key for key in tweetfields_section if tweetfields_section[key] == "True"]
-        tweetcount = ast.literal_eval(self.config["USERTWEET"]["count"])
-        return {"tweet.fields": ",".join(tweetsfields), "max_results":tweetcount}
+        tweetcount = ast.literal_eval(self.config["USERTWEET"]["count"]) if max_results is None else max_results
+        tweetcount = min(max(tweetcount, TWEETS_PAGE_MIN), TWEETS_PAGE_MAX)    # The API only accepts 5 to 100 tweets per page
+        params = {"tweet.fields": ",".join(tweetsfields), "max_results":tweetcount}
+        if since_id is not None:
+            params["since_id"] = since_id
+        if pagination_token is not None:
+            params["pagination_token"] = pagination_token
+        if self.config.get("USERTWEET", "start_time", fallback=""):
+            params["start_time"] = self.config["USERTWEET"]["start_time"]
+        return params
 
     def create_tweets_url(self, user_id) -> str:
         return self.config["LINKS"]["twitter_user_tweets_link"].format(user_id)
@@ -183,16 +310,9 @@ if __name__ == "__main__":
     logger_file_handler.setFormatter(formatter)
     logger.addHandler(logger_file_handler)
 
-    while True:
-        try:
-            twitter_user = TwitterUser(bearer_token, config, logger)
-            asyncio.run(twitter_user.main())
-            break
-
-        except (httpx.ProtocolError, httpx.HTTPStatusError) as e:
-            logger.error(f"User Tweet Failed - {e}")
-            logger.info(f"Retrying User Tweet sassadasdas")
-
-        except Exception as e:
-            logger.error(f"User Tweet Failed - {e}")
-            break
\ No newline at end of file
+    # Same retries as the service (backoff per error class, permanent errors raised)
+    retry_policy = RetryPolicy.from_config(config)
+    try:
+        asyncio.run(run_with_client(retry_policy.run(lambda: TwitterUser(bearer_token, config, logger).main(), logger, "User Tweet")))
+    except Exception as e:
+        logger.error(f"User Tweet Failed - {e}")
\ No newline at end of file
@@ -0,0 +1,77 @@
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from .utils import read_json, write_json_atomic
+
+'''
+Persistent cache of username -> user ID (and optionally the profile metadata) resolutions.
+User IDs never change, so repeat runs can skip the users/by lookup for every username that was resolved within the TTL.
+Usernames are case-insensitive on Twitter, hence entries are keyed by the lowercased username.
+'''
+
+
+class UserCache:
+    def __init__(self, filepath: str, ttl: float, store_profiles: bool = True):
+        self.filepath = filepath
+        self.ttl = ttl
+        self.store_profiles = store_profiles
+        self.entries: Dict[str, dict] = read_json(filepath, default={}) if self.enabled else {}
+        self.evict_expired()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def is_fresh(self, entry: dict, now: float) -> bool:
+        return now - entry.get("cached_at", 0) < self.ttl
+
+    def evict_expired(self) -> int:
+        '''
+        Removes the entries older than the TTL, returning the number of evicted entries
+        '''
+        now = time.time()
+        expired = [username for username, entry in self.entries.items() if not self.is_fresh(entry, now)]
+        for username in expired:
+            del self.entries[username]
+        return len(expired)
+
+    def resolve(self, usernames: Iterable[str]) -> Tuple[Dict[str, dict], List[str]]:
+        '''
+        Splits the usernames into cached users (keyed by user ID, like TwitterUser's users_id) and usernames still to be looked up
+        '''
+        now = time.time()
+        cached_users = {}
+        missing = []
+        for username in usernames:
+            entry = self.entries.get(username.lower())
+            if entry is not None and self.is_fresh(entry, now):
+                cached_users[entry["user"]["id"]] = entry["user"]
+            else:
+                missing.append(username)
+        return cached_users, missing
+
+    def update(self, users: Iterable[dict]) -> None:
+        '''
+        Caches the users returned by the users/by endpoint
+        '''
+        if not self.enabled:
+            return
+        now = time.time()
+        for user in users:
+            if "username" not in user:
+                continue
+            cached_user = user if self.store_profiles else {"id": user["id"], "username": user["username"]}
+            self.entries[user["username"].lower()] = {"user": cached_user, "cached_at": now}
+
+    def merge(self, other: "UserCache") -> None:
+        '''
+        Adds the entries of 'other' (e.g. written by another process), keeping the most recently cached entry per username
+        '''
+        for username, entry in other.entries.items():
+            current = self.entries.get(username)
+            if current is None or current.get("cached_at", 0) < entry.get("cached_at", 0):
+                self.entries[username] = entry
+
+    def save(self) -> None:
+        if self.enabled:
+            write_json_atomic(self.filepath, self.entries)
@@ -1,5 +1,11 @@
+import os
+import re
+import json
+import asyncio
 import logging
+from datetime import datetime
 from configparser import RawConfigParser, NoSectionError
+from typing import Awaitable, Iterable, Iterator, List, Optional, Tuple
 
 def log_wrapper(original_function):
     '''
@@ -13,6 +19,8 @@ def log_wrapper(original_function):
             kwargs.get("logger", logging).exception(f"Failed to execute {original_function.__name__} - {e}")
     return wrapper_function
 
+LOG_LINE_PATTERN = re.compile(r"^\[(?P<asctime>[^\]]+)\]:\s*(?P<levelname>[A-Z]+):(?P<message>.*)$", re.DOTALL)
+
 
 class RawConfigParser(RawConfigParser):
     def options(self, section, no_defaults=False, **kwargs):
@@ -22,4 +30,80 @@ class RawConfigParser(RawConfigParser):
             except KeyError:
                 raise NoSectionError(section)
         else:
-            return super().options(section, **kwargs)
\ No newline at end of file
+            return super().options(section, **kwargs)
+
+
+async def gather_bounded(coroutines: Iterable[Awaitable], limit: int) -> list:
+    '''
+    Runs the coroutines concurrently with at most 'limit' of them in flight at any time.
+    Results are returned in the same order as the input, with exceptions returned in place of results instead of raised,
+    so that a single failure does not abort the rest of the batch.
+    '''
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def bounded(coroutine: Awaitable):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(bounded(coroutine) for coroutine in coroutines), return_exceptions=True)
+
+
+def chunked(items: Iterable, size: int) -> Iterator[List]:
+    '''
+    Splits the items into consecutive lists of at most 'size' items
+    '''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_json(filepath: str, default=None):
+    '''
+    Reads a JSON state file, returning 'default' if the file does not exist or cannot be decoded
+    '''
+    try:
+        with open(filepath, encoding="utf8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logging.getLogger(__name__).warning(f"Failed to read {filepath}, ignoring it - {e}")
+        return default
+
+
+def write_json_atomic(filepath: str, data) -> None:
+    '''
+    Writes a JSON state file atomically (write to a temporary file, then rename), so that a crash never leaves a truncated file
+    '''
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_filepath = f"{filepath}.tmp"
+    with open(temp_filepath, "w", encoding="utf8") as f:
+        json.dump(data, f, sort_keys=True, indent=1)
+    os.replace(temp_filepath, filepath)
+
+
+def parse_log_line(line: str) -> Optional[Tuple[str, str, str]]:
+    '''
+    Splits a line written with the '[%(asctime)s]:%(levelname)5s:%(message)s' format into (asctime, levelname, message).
+    Returns None for lines in any other format.
+    '''
+    match = LOG_LINE_PATTERN.match(line.rstrip("\r\n"))
+    if match is None:
+        return None
+    return match.group("asctime"), match.group("levelname"), match.group("message")
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    '''
+    Parses the API's created_at (e.g. 2022-11-20T08:15:30.000Z) into an aware datetime
+    '''
+    if not value:
+        return None
+    return datetime.strptime(value.replace("Z", "+0000"), "%Y-%m-%dT%H:%M:%S.%f%z")
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+from .records import TweetRecord
+from .metrics import writer_flush_seconds, writer_queue_depth, writer_records
+
+'''
+Decouples receiving tweets from writing them to disk.
+The receiver puts records into a bounded queue and returns immediately, while a dedicated writer task drains the queue
+in batches and hands each batch to the sink in a worker thread, so disk flushes and rollovers never block the event loop
+that reads the stream socket. When the queue is full, the overflow policy decides between backpressure and dropping:
+- block: the receiver waits for space (no data loss, but the server may disconnect a slow reader)
+- drop_newest: the incoming record is dropped
+- drop_oldest: the oldest queued record is dropped to make room
+'''
+
+OVERFLOW_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+
+class AsyncWriter:
+    def __init__(self,
+                 write_batch: Callable[[List[TweetRecord]], None],
+                 logger: logging.Logger,
+                 queue_size: int = 10000,
+                 batch_size: int = 500,
+                 overflow: str = "block",
+                 name: str = "writer"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}, expected one of {OVERFLOW_POLICIES}")
+        self.write_batch = write_batch
+        self.logger = logger
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.name = name                # Label of the writer's metrics
+        self.counters: Dict[str, int] = {"received": 0, "written": 0, "dropped": 0, "blocked": 0, "batches": 0, "failed": 0}
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def from_config(write_batch: Callable[[List[TweetRecord]], None], config, logger: logging.Logger, name: str = "writer") -> "AsyncWriter":
+        return AsyncWriter(
+            write_batch,
+            logger,
+            queue_size=config.getint("WRITER", "queue_size", fallback=10000),
+            batch_size=config.getint("WRITER", "batch_size", fallback=500),
+            overflow=config.get("WRITER", "overflow", fallback="block"),
+            name=name,
+        )
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def start(self) -> None:
+        '''
+        Starts the writer task on the running event loop (the queue is created here, as it binds to the loop)
+        '''
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.task = asyncio.create_task(self.run())
+        writer_queue_depth.set_function(lambda: self.depth, self.name)      # Sampled whenever the metrics are read
+
+    async def put(self, record: TweetRecord) -> None:
+        self.counters["received"] += 1
+        writer_records.inc(self.name, "received")
+
+        if not self.queue.full():
+            self.queue.put_nowait(record)
+        elif self.overflow == "block":
+            self.counters["blocked"] += 1
+            writer_records.inc(self.name, "blocked")
+            await self.queue.put(record)
+        elif self.overflow == "drop_newest":
+            self.counters["dropped"] += 1
+            writer_records.inc(self.name, "dropped")
+        else:
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.counters["dropped"] += 1
+            writer_records.inc(self.name, "dropped")
+            self.queue.put_nowait(record)
+
+    async def run(self) -> None:
+        '''
+        Drains the queue in batches of up to WRITER batch_size records until the closing sentinel is received
+        '''
+        closing = False
+        while not closing:
+            batch = []
+            record = await self.queue.get()
+            while True:
+                if record is None:
+                    closing = True
+                else:
+                    batch.append(record)
+                self.queue.task_done()
+                if closing or len(batch) >= self.batch_size or self.queue.empty():
+                    break
+                record = self.queue.get_nowait()
+
+            if batch:
+                await self.flush(batch)
+
+    async def flush(self, batch: List[TweetRecord]) -> None:
+        try:
+            with writer_flush_seconds.time(self.name):
+                await asyncio.to_thread(self.write_batch, batch)
+            self.counters["written"] += len(batch)
+            self.counters["batches"] += 1
+            writer_records.inc(self.name, "written", amount=len(batch))
+        except Exception as e:
+            self.counters["failed"] += len(batch)
+            writer_records.inc(self.name, "failed", amount=len(batch))
+            self.logger.error(f"Writer failed to write {len(batch)} records - {e}")
+
+    async def close(self) -> None:
+        '''
+        Writes every queued record, then stops the writer task
+        '''
+        if self.task is None:
+            return
+        if not self.task.done():
+            await self.queue.put(None)      # The sentinel is queued behind every pending record
+            await self.task
+        self.task = None
+        writer_queue_depth.remove(self.name)
+        self.logger.info(f"Writer closed: {self.counters}")